@@ -0,0 +1,61 @@
+"""Benchmark of SpikeDataOrganizer.get_reordering as a function of the
+number of clusters.
+
+The per-cluster loop that was used before (one `np.nonzero` per cluster) is
+timed as a reference.
+
+Usage: python bench_reordering.py [nspikes]
+
+"""
+import os
+import sys
+import time
+
+import numpy as np
+import numpy.random as rdn
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'spiky'))
+from views.common import SpikeDataOrganizer
+
+
+NCLUSTERS = [10, 50, 100, 500, 1000, 2000]
+
+
+def get_reordering_loop(clusters, clusters_unique):
+    """Former implementation, O(nspikes x nclusters)."""
+    permutation = []
+    for cluster in clusters_unique:
+        permutation.append(np.nonzero(clusters == cluster)[0])
+    return np.hstack(permutation)
+
+
+def timeit(fun, repeat=3):
+    best = np.inf
+    for _ in xrange(repeat):
+        t0 = time.time()
+        fun()
+        best = min(best, time.time() - t0)
+    return best
+
+
+def run(nspikes=1000000, nclusters_list=NCLUSTERS, nchannels=4):
+    data = rdn.randn(nspikes, 1).astype(np.float32)
+    masks = np.ones((nspikes, nchannels), dtype=np.float32)
+    print "%10s %12s %12s" % ("nclusters", "vectorized", "loop")
+    for nclusters in nclusters_list:
+        clusters = rdn.randint(low=0, high=nclusters, size=nspikes)
+        organizer = SpikeDataOrganizer(data, clusters=clusters, masks=masks,
+                                       nchannels=nchannels)
+        t_vec = timeit(organizer.get_reordering)
+        t_loop = timeit(lambda: get_reordering_loop(organizer.clusters,
+                                                    organizer.clusters_unique),
+                        repeat=1)
+        print "%10d %11.4fs %11.4fs" % (nclusters, t_vec, t_loop)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        run(nspikes=int(float(sys.argv[1])))
+    else:
+        run()
@@ -0,0 +1,368 @@
+"""Benchmark of the data preparation of the views, on synthetic data.
+
+The data managers and highlight managers of the views are wired together
+with a paint manager which does not upload anything, so that the benchmark
+runs without a GPU or a display. The benchmarks whose estimated memory
+exceeds a budget run on the largest number of spikes which fits in it, which
+is reported in the results (nspikes_run), or are skipped if even a small
+number of spikes does not fit.
+
+The results are saved in a JSON file, which can be compared with the
+results of another commit:
+
+Usage: python bench_views.py [--nspikes 1e4,1e5] [--nchannels 32,128]
+           [--nclusters 10,100] [--output results.json]
+           [--compare previous.json]
+
+"""
+import argparse
+import gc
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'spiky'))
+from views.common import SpikeDataOrganizer
+from views.waveformview import (WaveformDataManager, WaveformPositionManager,
+    WaveformHighlightManager)
+from views.featureview import FeatureDataManager, FeatureHighlightManager
+from views.correlogramsview import get_histogram_points
+from views.correlationmatrixview import colormap
+
+from synthetic import generate_data
+
+
+NSPIKES = [10000, 100000, 1000000, 10000000]
+NCHANNELS = [32, 128, 384]
+NCLUSTERS = [10, 100, 2000]
+NSAMPLES = 20
+FETDIM = 3
+NBINS = 50
+
+# benchmarks whose estimated memory is larger run on fewer spikes
+MAX_MEMORY = 4e9
+# minimum number of spikes of a benchmark run on fewer spikes
+MIN_SUBSET = 1000
+
+
+class DummyPaintManager(object):
+    """Paint manager without any OpenGL context: the datasets are not
+    created and the uploads are ignored."""
+    def create_dataset(self, *args, **kwargs):
+        return None
+
+    def set_data(self, *args, **kwargs):
+        pass
+
+
+def wire(**managers):
+    """Give every manager a reference to all the others, as GalryWidget
+    does with its companion classes."""
+    for manager in managers.itervalues():
+        for name, other in managers.iteritems():
+            setattr(manager, name, other)
+
+
+def create_waveform_managers():
+    data_manager = WaveformDataManager()
+    wire(data_manager=data_manager,
+         position_manager=WaveformPositionManager(),
+         highlight_manager=WaveformHighlightManager(),
+         paint_manager=DummyPaintManager())
+    return data_manager
+
+
+def create_feature_managers():
+    data_manager = FeatureDataManager()
+    wire(data_manager=data_manager,
+         highlight_manager=FeatureHighlightManager(),
+         paint_manager=DummyPaintManager())
+    return data_manager
+
+
+def timeit(fun, repeat=3, setup=None):
+    """Return the durations of several calls of a function, calling setup
+    before each call outside of the timing."""
+    times = []
+    for _ in xrange(repeat):
+        if setup is not None:
+            setup()
+        t0 = time.time()
+        fun()
+        times.append(time.time() - t0)
+    return times
+
+
+def get_polygon(radius=.3, nvertices=20):
+    angles = np.linspace(0., 2 * np.pi, nvertices, endpoint=False)
+    return radius * np.vstack((np.cos(angles), np.sin(angles))).T
+
+
+# Benchmarks
+# ----------
+# Every benchmark takes the synthetic data (or only the number of clusters,
+# for the benchmarks which do not depend on the spikes) and the number of
+# repetitions, and returns the durations.
+def bench_organizer(data, repeat):
+    features = data['features']
+    nchannels = data['masks'].shape[1]
+    return timeit(lambda: SpikeDataOrganizer(features,
+        clusters=data['clusters'], cluster_colors=data['cluster_colors'],
+        masks=data['masks'], nchannels=nchannels), repeat)
+
+
+def bench_prepare_waveform_data(data, repeat):
+    dm = create_waveform_managers()
+    dm.set_data(data['waveforms'], clusters=data['clusters'],
+        cluster_colors=data['cluster_colors'], masks=data['masks'])
+    return timeit(dm.prepare_waveform_data, repeat)
+
+
+def bench_waveform_selection(data, repeat):
+    dm = create_waveform_managers()
+    dm.set_data(data['waveforms'], clusters=data['clusters'],
+        cluster_colors=data['cluster_colors'], masks=data['masks'])
+    box = (-.2, -.2, .2, .2)
+    return timeit(lambda: dm.highlight_manager.find_enclosed_spikes(box),
+                  repeat)
+
+
+def bench_set_projection_cold(data, repeat):
+    """Projection computed on each call."""
+    dm = create_feature_managers()
+    dm.set_data(data['features'], fetdim=FETDIM, clusters=data['clusters'],
+        cluster_colors=data['cluster_colors'], masks=data['masks'])
+    return timeit(lambda: dm.set_projection(0, 1, 0, 0), repeat,
+                  setup=dm.projection_cache.clear)
+
+
+def bench_set_projection_warm(data, repeat):
+    """Projection found in the cache on each call."""
+    dm = create_feature_managers()
+    dm.set_data(data['features'], fetdim=FETDIM, clusters=data['clusters'],
+        cluster_colors=data['cluster_colors'], masks=data['masks'])
+    dm.set_projection(0, 1, 0, 0)
+    return timeit(lambda: dm.set_projection(0, 1, 0, 0), repeat)
+
+
+def bench_feature_selection(data, repeat):
+    dm = create_feature_managers()
+    dm.set_data(data['features'], fetdim=FETDIM, clusters=data['clusters'],
+        cluster_colors=data['cluster_colors'], masks=data['masks'])
+    box = (-.1, -.1, .1, .1)
+    return timeit(lambda: dm.highlight_manager.find_enclosed_spikes(box),
+                  repeat)
+
+
+def bench_lasso_selection(data, repeat):
+    dm = create_feature_managers()
+    dm.set_data(data['features'], fetdim=FETDIM, clusters=data['clusters'],
+        cluster_colors=data['cluster_colors'], masks=data['masks'])
+    polygon = get_polygon()
+    return timeit(lambda: dm.highlight_manager.find_spikes_in_polygon(polygon),
+                  repeat)
+
+
+def bench_histogram_points(nclusters, repeat):
+    # the correlograms view shows the pairs (i, j) with j <= i
+    histograms = np.random.rand(nclusters * (nclusters + 1) // 2, NBINS)
+    return timeit(lambda: get_histogram_points(histograms), repeat)
+
+
+def bench_colormap(nclusters, repeat):
+    matrix = np.random.rand(nclusters, nclusters)
+    return timeit(lambda: colormap(matrix), repeat)
+
+
+# name, function, data needed (None for the benchmarks which only depend on
+# the number of clusters), and rough estimate of the memory in bytes as a
+# function of nspikes, nchannels and nclusters, including the synthetic
+# data.
+BENCHMARKS = [
+    ('organizer', bench_organizer, 'features',
+        lambda s, c, k: 16. * s * c * FETDIM + 8. * s * c),
+    ('prepare_waveform_data', bench_prepare_waveform_data, 'waveforms',
+        lambda s, c, k: 66. * s * c * NSAMPLES + 8. * s * c),
+    ('waveform_selection', bench_waveform_selection, 'waveforms',
+        lambda s, c, k: 46. * s * c * NSAMPLES + 8. * s * c),
+    ('set_projection_cold', bench_set_projection_cold, 'features',
+        lambda s, c, k: 16. * s * c * FETDIM + 4. * s * c + 64. * s),
+    ('set_projection_warm', bench_set_projection_warm, 'features',
+        lambda s, c, k: 16. * s * c * FETDIM + 4. * s * c + 64. * s),
+    ('feature_selection', bench_feature_selection, 'features',
+        lambda s, c, k: 16. * s * c * FETDIM + 4. * s * c + 64. * s),
+    ('lasso_selection', bench_lasso_selection, 'features',
+        lambda s, c, k: 16. * s * c * FETDIM + 4. * s * c + 64. * s),
+    ('histogram_points', bench_histogram_points, None,
+        lambda s, c, k: 45. * k * (k + 1) * NBINS),
+    ('colormap', bench_colormap, None,
+        lambda s, c, k: 230. * k * k),
+    ]
+
+
+def get_subset_size(estimate, nspikes, nchannels, nclusters, max_memory):
+    """Return the largest number of spikes, at most nspikes, for which the
+    estimated memory of a benchmark fits in max_memory, or 0 if it does not
+    fit with MIN_SUBSET spikes."""
+    if estimate(nspikes, nchannels, nclusters) <= max_memory:
+        return nspikes
+    fixed = estimate(0, nchannels, nclusters)
+    per_spike = (estimate(nspikes, nchannels, nclusters) - fixed) / nspikes
+    if per_spike <= 0:
+        return 0
+    n = int((max_memory - fixed) / per_spike)
+    if n < min(MIN_SUBSET, nspikes):
+        return 0
+    return n
+
+
+def get_info():
+    """Return the environment of the benchmark."""
+    info = dict(python=platform.python_version(), numpy=np.__version__,
+                platform=platform.platform(), date=time.strftime('%c'))
+    try:
+        info['commit'] = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        info['commit'] = None
+    return info
+
+
+def run(nspikes_list=NSPIKES, nchannels_list=NCHANNELS,
+        nclusters_list=NCLUSTERS, names=None, repeat=3,
+        max_memory=MAX_MEMORY):
+    """Run the benchmarks on all combinations of the data dimensions, and
+    return a list of results (dictionaries). The benchmarks which do not
+    depend on the spikes run once for every number of clusters."""
+    benchmarks = [b for b in BENCHMARKS if names is None or b[0] in names]
+    results = []
+    for nclusters in nclusters_list:
+        for name, fun, needed, estimate in benchmarks:
+            if needed is not None:
+                continue
+            result = dict(benchmark=name, nclusters=nclusters)
+            memory = estimate(0, 0, nclusters)
+            if memory > max_memory:
+                result['skipped'] = "estimated memory %.1f GB" % (
+                    memory / 1e9)
+            else:
+                times = fun(nclusters, repeat)
+                result.update(time=min(times), times=times)
+            results.append(result)
+            print_result(result)
+    benchmarks = [b for b in benchmarks if b[2] is not None]
+    for nspikes in nspikes_list:
+        for nchannels in nchannels_list:
+            for nclusters in nclusters_list:
+                case = dict(nspikes=nspikes, nchannels=nchannels,
+                            nclusters=nclusters)
+                sizes = dict([(name, get_subset_size(estimate, nspikes,
+                    nchannels, nclusters, max_memory))
+                        for name, _, _, estimate in benchmarks])
+                case_results = {}
+                # the benchmarks run on the same number of spikes share the
+                # same synthetic data
+                for size in sorted(set(sizes.values()) - set([0]),
+                                   reverse=True):
+                    todo = [b for b in benchmarks if sizes[b[0]] == size]
+                    needed = set([b[2] for b in todo])
+                    data = generate_data(nspikes=size,
+                        nchannels=nchannels, nclusters=nclusters,
+                        nsamples=NSAMPLES, fetdim=FETDIM,
+                        waveforms='waveforms' in needed,
+                        features='features' in needed)
+                    for name, fun, _, _ in todo:
+                        result = dict(case, benchmark=name)
+                        if size < nspikes:
+                            result['nspikes_run'] = size
+                        times = fun(data, repeat)
+                        result.update(time=min(times), times=times)
+                        case_results[name] = result
+                        # the managers reference each other
+                        gc.collect()
+                    del data
+                for name, _, _, estimate in benchmarks:
+                    if name in case_results:
+                        result = case_results[name]
+                    else:
+                        result = dict(case, benchmark=name,
+                            skipped="estimated memory %.1f GB" % (
+                                estimate(nspikes, nchannels, nclusters) / 1e9))
+                    results.append(result)
+                    print_result(result)
+    return results
+
+
+def get_case(result):
+    """Return the description of the data dimensions of a result."""
+    if 'nspikes' not in result:
+        return "%-22s %34s %5d clusters" % (result['benchmark'], '',
+                                             result['nclusters'])
+    return "%-22s %9d spikes %4d channels %5d clusters" % (
+        result['benchmark'], result['nspikes'], result['nchannels'],
+        result['nclusters'])
+
+
+def print_result(result):
+    if 'skipped' in result:
+        value = "skipped (%s)" % result['skipped']
+    else:
+        value = "%.4fs" % result['time']
+        if 'nspikes_run' in result:
+            value += " (on %d spikes)" % result['nspikes_run']
+    print "%s: %s" % (get_case(result), value)
+    sys.stdout.flush()
+
+
+def compare(results, filename):
+    """Print the ratio between the durations of the results and those of a
+    previous run."""
+    with open(filename, 'r') as f:
+        previous = json.load(f)['results']
+    # the durations are only comparable on the same number of spikes
+    key = lambda r: (r['benchmark'], r.get('nspikes'), r.get('nchannels'),
+                     r['nclusters'], r.get('nspikes_run', r.get('nspikes')))
+    previous = dict([(key(r), r) for r in previous if 'time' in r])
+    print "\nComparison with %s (new time / previous time):" % filename
+    for result in results:
+        if 'time' in result and key(result) in previous:
+            print "%s: %.2f" % (get_case(result),
+                result['time'] / previous[key(result)]['time'])
+
+
+def parse_list(s, type=int):
+    return [type(float(x)) for x in s.split(',')]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--nspikes', default=NSPIKES, type=parse_list)
+    parser.add_argument('--nchannels', default=NCHANNELS, type=parse_list)
+    parser.add_argument('--nclusters', default=NCLUSTERS, type=parse_list)
+    parser.add_argument('--benchmarks', default=None,
+        type=lambda s: s.split(','),
+        help="comma-separated names among: %s" % ', '.join(
+            [b[0] for b in BENCHMARKS]))
+    parser.add_argument('--repeat', default=3, type=int)
+    parser.add_argument('--max-memory', default=MAX_MEMORY, type=float,
+        help="run the benchmarks whose estimated memory (bytes) is larger "
+             "on fewer spikes")
+    parser.add_argument('--output', default='bench_views.json')
+    parser.add_argument('--compare', default=None,
+        help="JSON file with the results of a previous run")
+    args = parser.parse_args()
+
+    results = run(nspikes_list=args.nspikes, nchannels_list=args.nchannels,
+        nclusters_list=args.nclusters, names=args.benchmarks,
+        repeat=args.repeat, max_memory=args.max_memory)
+    with open(args.output, 'w') as f:
+        json.dump(dict(info=get_info(), results=results), f, indent=2)
+    if args.compare:
+        compare(results, args.compare)
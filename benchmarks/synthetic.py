@@ -0,0 +1,104 @@
+"""Scalable synthetic data for the benchmarks, in the layout of the
+DataHolder filled by MockDataProvider.load.
+
+The spikes of every cluster are drawn around a random center, so that the
+clusters are separated in the feature space and the selections are not
+trivial. Large arrays are generated block by block, in single precision.
+
+"""
+import numpy as np
+import numpy.random as rdn
+
+
+__all__ = ['generate_data', 'generate_features', 'generate_waveforms']
+
+
+# number of spikes generated at once
+BLOCK_SIZE = 100000
+
+
+def generate_clusters(nspikes, nclusters, state):
+    """Return the cluster of every spike, with cluster sizes following a
+    power law as in real recordings, every cluster having at least one
+    spike."""
+    weights = 1. / np.arange(1, nclusters + 1)
+    weights /= weights.sum()
+    clusters = state.choice(nclusters, size=nspikes, p=weights).astype(np.int32)
+    n = min(nspikes, nclusters)
+    clusters[:n] = np.arange(n)
+    state.shuffle(clusters)
+    return clusters
+
+
+def generate_masks(nspikes, nchannels, state):
+    masks = np.empty((nspikes, nchannels), dtype=np.float32)
+    for start in xrange(0, nspikes, BLOCK_SIZE):
+        end = min(start + BLOCK_SIZE, nspikes)
+        masks[start:end] = state.rand(end - start, nchannels)
+    masks[masks < .25] = 0
+    return masks
+
+
+def generate_features(clusters, nchannels, fetdim=3, state=None):
+    """Return a nspikes x (nchannels * fetdim + 1) array, the last column
+    being the spike time."""
+    if state is None:
+        state = rdn.RandomState()
+    nspikes = len(clusters)
+    nfeatures = nchannels * fetdim
+    centers = 3 * state.randn(clusters.max() + 1, nfeatures)
+    features = np.empty((nspikes, nfeatures + 1), dtype=np.float32)
+    for start in xrange(0, nspikes, BLOCK_SIZE):
+        end = min(start + BLOCK_SIZE, nspikes)
+        features[start:end,:-1] = (centers[clusters[start:end]] +
+                                   state.randn(end - start, nfeatures))
+    features[:,-1] = np.linspace(0., 1., nspikes)
+    return features
+
+
+def generate_waveforms(clusters, nsamples, nchannels, state=None):
+    """Return a nspikes x nsamples x nchannels array, every cluster having
+    its own mean waveform."""
+    if state is None:
+        state = rdn.RandomState()
+    nspikes = len(clusters)
+    t = np.linspace(-1., 1., nsamples).reshape((1, -1, 1))
+    amplitudes = state.rand(clusters.max() + 1, 1, nchannels)
+    means = -amplitudes * np.exp(-20 * t ** 2)
+    waveforms = np.empty((nspikes, nsamples, nchannels), dtype=np.float32)
+    for start in xrange(0, nspikes, BLOCK_SIZE):
+        end = min(start + BLOCK_SIZE, nspikes)
+        waveforms[start:end] = (means[clusters[start:end]] +
+            .1 * state.randn(end - start, nsamples, nchannels))
+    return waveforms
+
+
+def generate_data(nspikes=10000, nchannels=32, nclusters=10, nsamples=20,
+                  fetdim=3, waveforms=True, features=True, masks=True,
+                  seed=0):
+    """Return a dictionary with synthetic clusters, cluster_colors, masks,
+    and optionally features and waveforms.
+
+    Arguments:
+      * nspikes, nchannels, nclusters, nsamples, fetdim: the dimensions of
+        the data
+      * waveforms=True, features=True, masks=True: whether to generate the
+        waveforms, the features and the masks, which are the largest arrays
+      * seed=0: the seed of the random generator, so that the data is the
+        same across runs
+
+    """
+    state = rdn.RandomState(seed)
+    data = {}
+    data['clusters'] = generate_clusters(nspikes, nclusters, state)
+    data['cluster_colors'] = state.rand(len(np.unique(data['clusters'])),
+                                        3).astype(np.float32)
+    if masks:
+        data['masks'] = generate_masks(nspikes, nchannels, state)
+    if features:
+        data['features'] = generate_features(data['clusters'], nchannels,
+                                             fetdim=fetdim, state=state)
+    if waveforms:
+        data['waveforms'] = generate_waveforms(data['clusters'], nsamples,
+                                               nchannels, state=state)
+    return data
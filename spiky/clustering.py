@@ -0,0 +1,48 @@
+import numpy as np
+
+
+__all__ = ['group_by_cluster', 'sum_by_cluster']
+
+
+def group_by_cluster(clusters):
+    """Group spikes by cluster, with a stable sort of their clusters.
+    
+    Returns:
+      * order: the spike indices sorted by cluster, in increasing order
+        within each cluster
+      * clusters_unique: the sorted clusters present in clusters
+      * starts: the position in order of the first spike of each cluster
+      * counts: the number of spikes of each cluster
+    
+    """
+    clusters = np.asarray(clusters)
+    order = np.argsort(clusters, kind='mergesort')
+    if len(order) == 0:
+        empty = np.zeros(0, dtype=np.int64)
+        return order, clusters[:0], empty, empty
+    clusters_sorted = clusters[order]
+    starts = np.hstack(([0], np.nonzero(np.diff(clusters_sorted))[0] + 1))
+    starts = starts.astype(np.int64)
+    counts = np.diff(np.hstack((starts, [len(clusters)])))
+    return order, clusters_sorted[starts], starts, counts
+    
+    
+def sum_by_cluster(data, clusters):
+    """Return the sums and sums of squares of data (one row per spike),
+    grouped by cluster.
+    
+    Returns:
+      * clusters_unique: the sorted clusters present in clusters
+      * counts: the number of spikes of each cluster
+      * sums, sums2: arrays with the sums and sums of squares of each
+        cluster, with the shape of data except for the first dimension
+    
+    """
+    order, clusters_unique, starts, counts = group_by_cluster(clusters)
+    data = np.asarray(data, dtype=np.float64)
+    shape = (len(starts),) + data.shape[1:]
+    if len(starts) == 0:
+        return clusters_unique, counts, np.zeros(shape), np.zeros(shape)
+    data = data[order]
+    return (clusters_unique, counts, np.add.reduceat(data, starts),
+            np.add.reduceat(data ** 2, starts))
@@ -0,0 +1,165 @@
+import numpy as np
+
+from clustering import sum_by_cluster
+
+
+__all__ = [
+    'compute_correlationmatrix',
+    'compute_similarity_pairs',
+    'get_cluster_statistics',
+    ]
+
+
+def get_cluster_statistics(features, masks, clusters_rel, nclusters,
+                           chunk_size=100000):
+    """Compute the mean and variance of the features, and the mean mask, of
+    every cluster.
+
+    The spikes are processed by chunks of contiguous rows, so that features
+    and masks can be memory-mapped arrays or HDF5 proxies.
+
+    Returns:
+      * means: a nclusters x nfeatures array
+      * variances: a nclusters x nfeatures array
+      * masks_mean: a nclusters x nchannels array
+
+    """
+    nspikes, nfeatures = features.shape
+    nchannels = masks.shape[1]
+    sums = np.zeros((nclusters, nfeatures))
+    sums2 = np.zeros((nclusters, nfeatures))
+    sums_masks = np.zeros((nclusters, nchannels))
+    for start in xrange(0, nspikes, chunk_size):
+        end = min(start + chunk_size, nspikes)
+        # features and masks are grouped by cluster together, the sums of
+        # squares of the masks being ignored
+        chunk = np.hstack((np.asarray(features[start:end], dtype=np.float64),
+                           np.asarray(masks[start:end], dtype=np.float64)))
+        chunk_unique, _, chunk_sums, chunk_sums2 = sum_by_cluster(chunk,
+            clusters_rel[start:end])
+        sums[chunk_unique] += chunk_sums[:,:nfeatures]
+        sums2[chunk_unique] += chunk_sums2[:,:nfeatures]
+        sums_masks[chunk_unique] += chunk_sums[:,nfeatures:]
+    sizes = np.bincount(clusters_rel, minlength=nclusters).reshape((-1, 1))
+    sizes = np.maximum(sizes, 1)
+    means = sums / sizes
+    variances = np.maximum(sums2 / sizes - means ** 2, 0)
+    return means, variances, sums_masks / sizes
+
+
+# number of float64 arrays of size npairs x nfeatures allocated at once when
+# computing the distances between pairs of clusters
+PAIR_ARRAYS = 8
+
+
+def get_pairs_batch_size(nfeatures, max_bytes):
+    """Return the number of pairs whose distance can be computed at once
+    within max_bytes bytes."""
+    return max(1, int(max_bytes // (PAIR_ARRAYS * 8 * max(nfeatures, 1))))
+
+
+def compute_similarity_pairs(means, variances, channels, fetdim,
+                             block_size=256, max_bytes=64e6):
+    """Compute the similarity of all pairs of clusters sharing at least one
+    unmasked channel.
+
+    The similarity of two clusters is exp(-d2/2), where d2 is the squared
+    distance between their mean features normalized by the sum of their
+    variances, averaged over the features of the channels unmasked in both
+    clusters. Pairs without any common unmasked channel are skipped, and the
+    clusters are processed by blocks, so that the memory used is proportional
+    to the number of non-trivial pairs.
+
+    Arguments:
+      * means, variances: nclusters x nfeatures arrays with the statistics of
+        the features of each cluster (the features of channel c being the
+        columns c * fetdim to (c + 1) * fetdim - 1)
+      * channels: a nclusters x nchannels boolean array with the unmasked
+        channels of each cluster
+      * fetdim: the number of features per channel
+      * block_size: the number of clusters processed at once
+      * max_bytes: the approximate memory used by the computation of the
+        distances, which determines the number of pairs processed at once
+
+    Returns:
+      * rows, cols, values: three arrays with the relative indices of the
+        clusters and the similarity of every non-trivial pair, both (i, j)
+        and (j, i) being included.
+
+    """
+    nclusters, nchannels = channels.shape
+    nfeatures = nchannels * fetdim
+    means = means[:,:nfeatures]
+    variances = variances[:,:nfeatures]
+    channels_int = channels.astype(np.int32)
+    max_pairs = get_pairs_batch_size(nfeatures, max_bytes)
+    rows, cols, values = [], [], []
+    for start in xrange(0, nclusters, block_size):
+        end = min(start + block_size, nclusters)
+        # number of common unmasked channels between the clusters of the
+        # block and the clusters after them (upper triangle only)
+        overlap = np.dot(channels_int[start:end], channels_int.T)
+        overlap[np.arange(end - start).reshape((-1, 1)) + start >=
+                np.arange(nclusters).reshape((1, -1))] = 0
+        block_i, block_j = np.nonzero(overlap)
+        block_i += start
+        for k in xrange(0, len(block_i), max_pairs):
+            i = block_i[k:k + max_pairs]
+            j = block_j[k:k + max_pairs]
+            # features unmasked in both clusters
+            common = np.repeat(channels[i] & channels[j], fetdim, axis=1)
+            d2 = (means[i] - means[j]) ** 2 / (variances[i] + variances[j] +
+                                               1e-12)
+            d2 = (d2 * common).sum(axis=1) / common.sum(axis=1)
+            rows.append(i)
+            cols.append(j)
+            values.append(np.exp(-d2 / 2))
+    if rows:
+        rows = np.hstack(rows)
+        cols = np.hstack(cols)
+        values = np.hstack(values)
+    else:
+        rows = cols = np.zeros(0, dtype=np.int64)
+        values = np.zeros(0)
+    # symmetric pairs, and diagonal
+    diagonal = np.arange(nclusters)
+    return (np.hstack((rows, cols, diagonal)),
+            np.hstack((cols, rows, diagonal)),
+            np.hstack((values, values, np.ones(nclusters))))
+
+
+def compute_correlationmatrix(features, masks, clusters, fetdim,
+                              clusters_unique=None, mask_threshold=.25,
+                              block_size=256):
+    """Compute the similarity matrix between all clusters, from the features
+    and masks of the spikes, as used by CorrelationMatrixView.
+
+    Arguments:
+      * features: a nspikes x (nchannels * fetdim + 1) array
+      * masks: a nspikes x nchannels array
+      * clusters: a nspikes array with the cluster absolute indices
+      * fetdim: the number of features per channel
+      * clusters_unique=None: the sorted cluster absolute indices, defining
+        the relative indices. By default, the unique values in clusters.
+      * mask_threshold=.25: a channel is unmasked in a cluster when the mean
+        mask of its spikes on this channel is greater than this threshold.
+      * block_size=256: number of clusters processed at once
+
+    Returns:
+      * matrix: a nclusters x nclusters array with values in [0, 1]
+
+    """
+    clusters = np.asarray(clusters)
+    if clusters_unique is None:
+        clusters_unique = np.unique(clusters)
+    nclusters = len(clusters_unique)
+    clusters_rel = np.searchsorted(clusters_unique, clusters)
+
+    means, variances, masks_mean = get_cluster_statistics(features, masks,
+        clusters_rel, nclusters)
+    rows, cols, values = compute_similarity_pairs(means, variances,
+        masks_mean > mask_threshold, fetdim, block_size=block_size)
+
+    matrix = np.zeros((nclusters, nclusters))
+    matrix[rows, cols] = values
+    return matrix
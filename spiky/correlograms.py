@@ -0,0 +1,470 @@
+import multiprocessing
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+
+__all__ = [
+    'CorrelogramsCache',
+    'compute_correlograms',
+    'compute_correlograms_clusters',
+    'get_correlograms_index',
+    'normalize_correlograms',
+    ]
+
+
+def get_correlograms_index(i, j):
+    """Return the row of the correlogram of the clusters with relative indices
+    i and j, with j <= i, in the correlograms array.
+
+    The rows are ordered as the pairs [(i, j) for i in xrange(nclusters)
+    for j in xrange(nclusters) if j <= i], which is the order used by
+    CorrelogramsView.
+
+    """
+    return i * (i + 1) // 2 + j
+
+
+def accumulate(counts, indices):
+    """Add the number of occurrences of each index to counts, without
+    allocating an array as large as counts when there are few indices."""
+    if len(indices) == 0:
+        return
+    if len(indices) * 4 >= counts.size:
+        counts += np.bincount(indices, minlength=counts.size)
+    else:
+        indices = np.sort(indices)
+        bounds = np.nonzero(np.diff(indices))[0] + 1
+        starts = np.hstack(([0], bounds))
+        ends = np.hstack((bounds, [len(indices)]))
+        counts[indices[starts]] += ends - starts
+
+
+def iter_spike_pairs(times, window, indices=None, backward=False):
+    """Yield all pairs of spikes closer than window, as (i, j, dt) arrays
+    with i < j the indices of the spikes and dt = times[j] - times[i].
+
+    The spike times must be sorted. If indices is specified, only the pairs
+    whose first spike (or second spike if backward is True) is in indices are
+    yielded.
+
+    The pairs are enumerated by increasing shift k = j - i: for a given k, the
+    pairs (i, i + k) are tested at once, and the spikes whose pair is already
+    outside the window are discarded for all larger shifts. The total cost is
+    thus linear in the number of pairs inside the window.
+
+    """
+    n = len(times)
+    if indices is None:
+        indices = np.arange(n)
+    indices = np.asarray(indices, dtype=np.int64)
+    k = 1
+    while len(indices) > 0:
+        # discard the spikes without any neighbor at this shift
+        if backward:
+            indices = indices[indices - k >= 0]
+            i, j = indices - k, indices
+        else:
+            indices = indices[indices + k < n]
+            i, j = indices, indices + k
+        dt = times[j] - times[i]
+        within = dt <= window
+        if not within.all():
+            indices, i, j, dt = (indices[within], i[within], j[within],
+                                 dt[within])
+        if len(indices) == 0:
+            break
+        yield i, j, dt
+        k += 1
+
+
+def count_spike_pairs(times, clusters_rel, nclusters, binsize=1,
+                      windowsize=50, cluster_start=0, cluster_end=None):
+    """Count the time lags of all pairs of spikes closer than the window.
+
+    Arguments:
+      * times: the sorted spike times
+      * clusters_rel: the relative cluster index of every spike
+      * nclusters: the number of clusters
+      * binsize, windowsize: like in compute_correlograms
+      * cluster_start=0, cluster_end=None: only the correlograms (i, j) with
+        i in [cluster_start, cluster_end[ are counted, to split the
+        computation in shards of clusters. Their rows are contiguous.
+
+    Returns:
+      * counts: the flattened rows of these correlograms, in the layout of
+        compute_correlograms, except that the pairs of spikes in the same
+        cluster are counted with a positive lag only.
+
+    """
+    if cluster_end is None:
+        cluster_end = nclusters
+    nhalf = int(windowsize // binsize)
+    nbins = 2 * nhalf + 1
+    window = (nhalf + .5) * binsize
+    row_start = get_correlograms_index(cluster_start, 0)
+    nrows = get_correlograms_index(cluster_end, 0) - row_start
+    counts = np.zeros(nrows * nbins, dtype=np.int64)
+
+    # only the correlograms (i, j) with j <= i are stored, a pair of spikes
+    # in clusters (i, j) with i < j goes in the correlogram (j, i) with the
+    # opposite lag. For every ordered pair of clusters (flattened), index of
+    # the central bin of the correlogram, and direction of the lags.
+    ci = np.arange(nclusters).reshape((-1, 1))
+    cj = np.arange(nclusters).reshape((1, -1))
+    swap = ci < cj
+    offsets = ((np.where(swap, get_correlograms_index(cj, ci),
+                               get_correlograms_index(ci, cj)) -
+                row_start) * nbins + nhalf).ravel()
+    signs = np.where(swap, -1, 1).ravel()
+
+    # in a shard, a pair of spikes is counted from its spike in the largest
+    # cluster: the pairs are enumerated forward and backward from the spikes
+    # of the shard
+    sharded = cluster_start > 0 or cluster_end < nclusters
+    if sharded:
+        indices = np.nonzero((clusters_rel >= cluster_start) &
+                             (clusters_rel < cluster_end))[0]
+        directions = (False, True)
+    else:
+        indices = None
+        directions = (False,)
+    for backward in directions:
+        for i, j, dt in iter_spike_pairs(times, window, indices=indices,
+                                         backward=backward):
+            lag = np.floor(dt / float(binsize) + .5).astype(np.int64)
+            # discard the pairs at the exact edge of the window
+            valid = lag <= nhalf
+            if sharded:
+                if backward:
+                    valid &= clusters_rel[j] > clusters_rel[i]
+                else:
+                    valid &= clusters_rel[i] >= clusters_rel[j]
+            if not valid.all():
+                i, j, lag = i[valid], j[valid], lag[valid]
+            code = clusters_rel[i] * nclusters + clusters_rel[j]
+            accumulate(counts, offsets[code] + signs[code] * lag)
+
+    return counts
+
+
+def get_cluster_shards(clusters_rel, nclusters, nshards):
+    """Return the bounds of at most nshards contiguous ranges of clusters
+    with about the same number of spikes."""
+    spikes_cum = np.cumsum(np.bincount(clusters_rel, minlength=nclusters))
+    targets = np.linspace(0, len(clusters_rel), nshards + 1)[1:-1]
+    bounds = np.searchsorted(spikes_cum, targets) + 1
+    return np.unique(np.hstack(([0], np.minimum(bounds, nclusters),
+                                [nclusters])))
+
+
+def count_spike_pairs_shard(args):
+    """Count the spike pairs of a shard of clusters, in a worker process. The
+    spikes are read from memory-mapped files shared by all workers, and the
+    counts are written in the rows of the shard in the shared output
+    file."""
+    (filename_times, filename_clusters, filename_counts, nclusters, binsize,
+        windowsize, cluster_start, cluster_end) = args
+    times = np.load(filename_times, mmap_mode='r')
+    clusters_rel = np.load(filename_clusters, mmap_mode='r')
+    shard_counts = count_spike_pairs(times, clusters_rel, nclusters,
+        binsize=binsize, windowsize=windowsize, cluster_start=cluster_start,
+        cluster_end=cluster_end)
+    nbins = 2 * int(windowsize // binsize) + 1
+    start = get_correlograms_index(cluster_start, 0) * nbins
+    counts = np.load(filename_counts, mmap_mode='r+')
+    counts[start:start + len(shard_counts)] = shard_counts
+    counts.flush()
+    del counts
+
+
+def count_spike_pairs_parallel(times, clusters_rel, nclusters, binsize=1,
+                               windowsize=50, nprocesses=None):
+    """Count the spike pairs like count_spike_pairs, in a pool of processes.
+
+    The correlograms are split in shards of contiguous clusters, with about
+    the same number of spikes, several per process so that the load is
+    balanced. The rows of a shard are contiguous: every worker writes them
+    directly in a memory-mapped output file, so that no counts are sent
+    back to the main process. The spike times and clusters are written once
+    in temporary files, that the workers memory-map instead of receiving a
+    pickled copy.
+
+    """
+    if nprocesses is None:
+        nprocesses = multiprocessing.cpu_count()
+    nbins = 2 * int(windowsize // binsize) + 1
+    size = get_correlograms_index(nclusters, 0) * nbins
+    bounds = get_cluster_shards(clusters_rel, nclusters, 4 * nprocesses)
+    dirname = tempfile.mkdtemp(prefix='spiky')
+    try:
+        filename_times = os.path.join(dirname, 'times.npy')
+        filename_clusters = os.path.join(dirname, 'clusters.npy')
+        filename_counts = os.path.join(dirname, 'counts.npy')
+        np.save(filename_times, times)
+        np.save(filename_clusters, clusters_rel)
+        np.lib.format.open_memmap(filename_counts, mode='w+',
+                                  dtype=np.int64, shape=(size,)).flush()
+        args = [(filename_times, filename_clusters, filename_counts,
+                 nclusters, binsize, windowsize, start, end)
+                    for start, end in zip(bounds[:-1], bounds[1:])]
+        pool = multiprocessing.Pool(nprocesses)
+        try:
+            for _ in pool.imap_unordered(count_spike_pairs_shard, args):
+                pass
+        finally:
+            pool.terminate()
+            pool.join()
+        counts = np.load(filename_counts)
+    finally:
+        shutil.rmtree(dirname, ignore_errors=True)
+    return counts
+
+
+def compute_correlograms(spiketimes, clusters, clusters_unique=None,
+                         binsize=1, windowsize=50, nprocesses=1):
+    """Compute all cross-correlograms between clusters.
+
+    Arguments:
+      * spiketimes: a Nspikes array with the spike times, in samples count
+      * clusters: a Nspikes array with the cluster absolute index of every
+        spike
+      * clusters_unique=None: the sorted array of cluster absolute indices,
+        defining the relative indices. By default, the unique values in
+        clusters.
+      * binsize=1: the bin size, in samples count
+      * windowsize=50: the half-width of the correlograms, in samples count
+      * nprocesses=1: the number of processes. If greater than 1, the
+        computation is split in shards of clusters processed in parallel.
+        None means the number of CPUs.
+
+    Returns:
+      * correlograms: a nclusters*(nclusters+1)/2 x nbins array, with
+        nbins = 2 * (windowsize // binsize) + 1. The row
+        get_correlograms_index(i, j), with j <= i, contains the histogram of
+        the time lags t_j - t_i between all spikes of cluster i and all spikes
+        of cluster j, the central bin being the null lag.
+
+    """
+    spiketimes = np.asarray(spiketimes)
+    clusters = np.asarray(clusters)
+    if clusters_unique is None:
+        clusters_unique = np.unique(clusters)
+    nclusters = len(clusters_unique)
+
+    # relative cluster indices
+    clusters_rel = np.searchsorted(clusters_unique, clusters).astype(np.int64)
+
+    # spikes in time order
+    order = np.argsort(spiketimes, kind='mergesort')
+    times = spiketimes[order]
+    clusters_rel = clusters_rel[order]
+
+    if nprocesses is None or nprocesses > 1:
+        counts = count_spike_pairs_parallel(times, clusters_rel, nclusters,
+            binsize=binsize, windowsize=windowsize, nprocesses=nprocesses)
+    else:
+        counts = count_spike_pairs(times, clusters_rel, nclusters,
+            binsize=binsize, windowsize=windowsize)
+
+    counts = counts.reshape((-1, 2 * int(windowsize // binsize) + 1))
+    # autocorrelograms are symmetric: every pair has been counted with a
+    # positive lag only
+    diagonal = get_correlograms_index(np.arange(nclusters),
+                                      np.arange(nclusters))
+    counts[diagonal,:] += counts[diagonal,::-1]
+    return counts
+
+
+def compute_correlograms_clusters(spiketimes, clusters, clusters_selected,
+                                  clusters_unique=None, binsize=1,
+                                  windowsize=50):
+    """Compute the correlograms between some clusters and all clusters.
+
+    Only the pairs of spikes with at least one spike in the selected clusters
+    are considered, so that the cost is proportional to the number of spikes
+    in those clusters.
+
+    Arguments:
+      * spiketimes, clusters, clusters_unique, binsize, windowsize: like in
+        compute_correlograms
+      * clusters_selected: the absolute indices of the selected clusters
+
+    Returns:
+      * correlograms: a nselected x nclusters x nbins array. correlograms[s, o]
+        is the histogram of the time lags t_o - t_s between the spikes of
+        the s-th selected cluster and the spikes of the o-th cluster.
+
+    """
+    spiketimes = np.asarray(spiketimes)
+    clusters = np.asarray(clusters)
+    clusters_selected = np.asarray(clusters_selected)
+    if clusters_unique is None:
+        clusters_unique = np.unique(clusters)
+    nclusters = len(clusters_unique)
+    nselected = len(clusters_selected)
+
+    # spikes in time order, with relative cluster indices
+    order = np.argsort(spiketimes, kind='mergesort')
+    times = spiketimes[order]
+    clusters_rel = np.searchsorted(clusters_unique,
+                                   clusters[order]).astype(np.int64)
+    # index of the cluster of every spike in the selection, -1 if not
+    # selected
+    selected_rel = -np.ones(nclusters, dtype=np.int64)
+    selected_rel[np.searchsorted(clusters_unique, clusters_selected)] = \
+        np.arange(nselected)
+    spikes_selected = selected_rel[clusters_rel]
+    indices = np.nonzero(spikes_selected >= 0)[0]
+
+    nhalf = int(windowsize // binsize)
+    nbins = 2 * nhalf + 1
+    window = (nhalf + .5) * binsize
+    counts = np.zeros(nselected * nclusters * nbins, dtype=np.int64)
+
+    # pairs whose first spike is selected, then pairs whose second spike only
+    # is selected
+    for backward in (False, True):
+        for i, j, dt in iter_spike_pairs(times, window, indices=indices,
+                                         backward=backward):
+            lag = np.floor(dt / float(binsize) + .5).astype(np.int64)
+            valid = lag <= nhalf
+            if backward:
+                valid &= spikes_selected[i] < 0
+            i, j, lag = i[valid], j[valid], lag[valid]
+            # the pair seen from the first spike, and from the second one
+            for s, o, sign in ((i, j, 1), (j, i, -1)):
+                sel = spikes_selected[s]
+                keep = sel >= 0
+                accumulate(counts, (sel[keep] * nclusters +
+                    clusters_rel[o][keep]) * nbins + nhalf +
+                    sign * lag[keep])
+
+    return counts.reshape((nselected, nclusters, nbins))
+
+
+class CorrelogramsCache(object):
+    """Correlograms of all pairs of clusters, keyed by pair of cluster
+    absolute indices, and updated incrementally when clusters change.
+
+    Only the correlograms (i, j) with j <= i are stored, as histograms of the
+    lags t_j - t_i. When clusters are merged, the new correlograms are sums of
+    the existing ones. When spikes are reassigned, only the pairs involving
+    the clusters that changed are recomputed.
+
+    """
+    def __init__(self, spiketimes, clusters, binsize=1, windowsize=50,
+                 nprocesses=1):
+        self.spiketimes = np.asarray(spiketimes)
+        self.clusters = np.array(clusters)
+        self.binsize = binsize
+        self.windowsize = windowsize
+        self.nprocesses = nprocesses
+        self.correlograms = {}
+
+    def get_clusters(self):
+        return np.unique(self.clusters)
+
+    def get(self, i, j):
+        """Return the histogram of the lags t_j - t_i between clusters i and
+        j (absolute indices)."""
+        if i >= j:
+            return self.correlograms[(i, j)]
+        else:
+            return self.correlograms[(j, i)][::-1]
+
+    def set(self, i, j, histogram):
+        """Set the histogram of the lags t_j - t_i between clusters i and j
+        (absolute indices)."""
+        if i >= j:
+            self.correlograms[(i, j)] = histogram
+        else:
+            self.correlograms[(j, i)] = histogram[::-1]
+
+    def compute(self):
+        """Compute the correlograms of all pairs of clusters."""
+        clusters_unique = self.get_clusters()
+        correlograms = compute_correlograms(self.spiketimes, self.clusters,
+            clusters_unique=clusters_unique, binsize=self.binsize,
+            windowsize=self.windowsize, nprocesses=self.nprocesses)
+        self.correlograms = {}
+        for i, ci in enumerate(clusters_unique):
+            for j, cj in enumerate(clusters_unique[:i + 1]):
+                self.correlograms[(ci, cj)] = \
+                    correlograms[get_correlograms_index(i, j)]
+        return self
+
+    def prune(self):
+        """Remove the correlograms of the clusters which do not exist
+        anymore."""
+        clusters = set(self.get_clusters())
+        for key in self.correlograms.keys():
+            if key[0] not in clusters or key[1] not in clusters:
+                del self.correlograms[key]
+
+    def update(self, clusters_to_update):
+        """Recompute the correlograms of all pairs involving the given
+        clusters."""
+        clusters_unique = self.get_clusters()
+        clusters_to_update = np.intersect1d(clusters_to_update,
+                                            clusters_unique)
+        self.prune()
+        if len(clusters_to_update) == 0:
+            return
+        correlograms = compute_correlograms_clusters(self.spiketimes,
+            self.clusters, clusters_to_update,
+            clusters_unique=clusters_unique, binsize=self.binsize,
+            windowsize=self.windowsize)
+        for s, cs in enumerate(clusters_to_update):
+            for o, co in enumerate(clusters_unique):
+                self.set(cs, co, correlograms[s, o])
+
+    def merge(self, clusters_merged, cluster_new):
+        """Merge several clusters into a new one, by summing their
+        correlograms, without any recomputation."""
+        clusters_merged = list(np.unique(clusters_merged))
+        if cluster_new not in clusters_merged and \
+                np.any(self.clusters == cluster_new):
+            clusters_merged.append(cluster_new)
+        others = np.setdiff1d(self.get_clusters(), clusters_merged)
+        correlograms = {}
+        for co in others:
+            correlograms[co] = sum([self.get(cm, co)
+                for cm in clusters_merged])
+        correlogram_auto = sum([self.get(cm0, cm1)
+            for cm0 in clusters_merged for cm1 in clusters_merged])
+
+        self.clusters[np.in1d(self.clusters, clusters_merged)] = cluster_new
+        self.prune()
+        for co in others:
+            self.set(cluster_new, co, correlograms[co])
+        self.set(cluster_new, cluster_new, correlogram_auto)
+
+    def reassign(self, spikes, clusters):
+        """Move spikes to other clusters (split or manual reassignment), and
+        recompute the correlograms of the clusters which changed only."""
+        clusters_changed = np.union1d(np.unique(self.clusters[spikes]),
+                                      np.unique(clusters))
+        self.clusters[spikes] = clusters
+        self.update(clusters_changed)
+
+    def get_correlograms(self, clusters_unique=None):
+        """Return the correlograms of the given clusters (by default all
+        clusters) in the layout of compute_correlograms, as used by
+        CorrelogramsView."""
+        if clusters_unique is None:
+            clusters_unique = self.get_clusters()
+        n = len(clusters_unique)
+        return np.array([self.get(clusters_unique[i], clusters_unique[j])
+            for i in xrange(n) for j in xrange(i + 1)])
+
+
+def normalize_correlograms(correlograms):
+    """Normalize every correlogram by its maximum, so that the values are in
+    [0, 1] for the display."""
+    correlograms = np.asarray(correlograms, dtype=np.float32)
+    m = correlograms.max(axis=1).reshape((-1, 1))
+    m[m == 0] = 1
+    return correlograms / m
@@ -1,7 +1,19 @@
+import os
+import shutil
+import tempfile
+
 import numpy as np
 import numpy.random as rdn
 
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
 import colors
+from correlograms import CorrelogramsCache, normalize_correlograms
+from correlationmatrix import compute_correlationmatrix
+from stats import ClusterStatisticsCache
 
 
 class Info(object):
@@ -12,8 +24,11 @@ class Info(object):
 __all__ = [
     'DataHolder',
     'DataProvider',
+    'H5ArrayProxy',
     'H5DataProvider',
+    'MemmapDataProvider',
     'MockDataProvider',
+    'create_features_columns',
     ]
 
     
@@ -46,17 +61,38 @@ class DataHolder(object):
     spiketimes: an array with the spike times of the spikes, in samples count
     waveforms: a nspikes*nsamples*nchannels array with all waveforms
     waveforms_info: a dict with the info about the waveforms
+    waveforms_stats: a ClusterStatisticsCache with the mean and standard deviation of the waveforms of every cluster, updated incrementally
     clusters: an array with the cluster index for each spike
     clusters_info: a ClustersInfo dic
     features: a nspikes*nchannels*fetdim array with the features of each spike, in each channel
+    features_info: a dict with the info about the features (fetdim)
+    features_columns: an optional writable nfeatures*nspikes float32 memmap receiving the features reordered by the feature view
     masks: a nspikes array with the mask for each spike, as a float in [0,1]
     raw_trace: a total_duration*nchannels array with the raw trace (or a HDF5 proxy with the same interface)
     filtered_trace: like raw trace, but with the filtered trace
     filter_info: a FilterInfo dic
+    correlograms: a nclusters*(nclusters+1)/2*nbins array with the cross-correlograms of all pairs of clusters
+    correlograms_info: a dict with the info about the correlograms (nsamples, binsize, windowsize)
+    correlograms_cache: a CorrelogramsCache with the correlograms of all pairs of clusters, updated incrementally
+    correlationmatrix: a nclusters*nclusters array with the similarity between all pairs of clusters, in [0,1]
     """
 
 
 
+def create_features_columns(features):
+    """Return a writable Nfeatures x Nspikes float32 memmap, backed by a
+    temporary file, which receives the features reordered column by column
+    by the feature view, so that they are never entirely loaded in memory.
+    
+    Arguments:
+      * features: a Nspikes x Nfeatures array, possibly a memmap or a proxy
+    
+    """
+    nspikes, nfeatures = features.shape
+    return np.memmap(tempfile.TemporaryFile(), dtype=np.float32, mode='w+',
+                     shape=(nfeatures, nspikes))
+
+
 class DataProvider(object):
     """Provide import/export functions to load/save a DataHolder instance."""
     data_holder = None
@@ -69,12 +105,301 @@ class DataProvider(object):
         pass
 
 
+# default number of rows read at once by a HDF5 proxy, when the dataset
+# is not chunked in the file
+H5_CHUNK_SIZE = 10000
+
+
+class H5ArrayProxy(object):
+    """Lazy proxy of a HDF5 dataset with a Numpy-like interface.
+    
+    Nothing is read at creation. Rows are read on demand, chunk by chunk, when
+    the proxy is indexed, so that only the requested part of the dataset is
+    ever loaded in memory. Fancy indexing on the first axis is supported (with
+    unsorted or repeated indices), which is not the case with h5py datasets.
+    
+    """
+    def __init__(self, dataset, chunk_size=None):
+        self.set_dataset(dataset)
+        if chunk_size is None:
+            if dataset.chunks is not None:
+                chunk_size = dataset.chunks[0]
+            else:
+                chunk_size = H5_CHUNK_SIZE
+        self.chunk_size = max(1, chunk_size)
+        
+    def set_dataset(self, dataset):
+        self.dataset = dataset
+        self.name = dataset.name
+        self.shape = dataset.shape
+        self.dtype = dataset.dtype
+        self.ndim = len(self.shape)
+        self.size = int(np.prod(self.shape))
+        
+    def __len__(self):
+        return self.shape[0]
+        
+    def iter_chunks(self):
+        """Yield (start, end, block) for successive blocks of rows."""
+        n = self.shape[0]
+        for start in xrange(0, n, self.chunk_size):
+            end = min(start + self.chunk_size, n)
+            yield start, end, self.dataset[start:end]
+        
+    def take(self, rows):
+        """Return the given rows (an integer or boolean array), in the given
+        order, by reading only the chunks that contain them."""
+        rows = np.asarray(rows)
+        n = self.shape[0]
+        if rows.dtype == np.bool_:
+            if rows.shape != (n,):
+                raise IndexError(("The boolean index has a length of %d "
+                    "instead of %d.") % (len(rows), n))
+            rows = np.nonzero(rows)[0]
+        rows = rows.astype(np.int64)
+        if len(rows) > 0 and (rows.min() < -n or rows.max() >= n):
+            raise IndexError("Index out of bounds for a dataset with %d "
+                "rows." % n)
+        # negative indices count from the end, as with Numpy arrays
+        rows[rows < 0] += n
+        out = np.empty((len(rows),) + self.shape[1:], dtype=self.dtype)
+        if len(rows) == 0:
+            return out
+        # sort the requested rows, and group them by chunk
+        order = np.argsort(rows, kind='mergesort')
+        rows_sorted = rows[order]
+        chunks = rows_sorted // self.chunk_size
+        bounds = np.nonzero(np.diff(chunks))[0] + 1
+        starts = np.hstack(([0], bounds))
+        ends = np.hstack((bounds, [len(rows)]))
+        for start, end in zip(starts, ends):
+            # read the whole chunk once, and extract the requested rows
+            i0 = chunks[start] * self.chunk_size
+            i1 = min(i0 + self.chunk_size, self.shape[0])
+            block = self.dataset[i0:i1]
+            out[order[start:end]] = block[rows_sorted[start:end] - i0]
+        return out
+        
+    def expand_index(self, item):
+        """Return the index as a tuple, the Ellipsis being replaced by full
+        slices."""
+        if not isinstance(item, tuple):
+            item = (item,)
+        if any([index is Ellipsis for index in item]):
+            i = [index is Ellipsis for index in item].index(True)
+            item = (item[:i] + (slice(None),) * (self.ndim - len(item) + 1) +
+                    tuple([index for index in item[i + 1:]
+                           if index is not Ellipsis]))
+        if not item:
+            item = (slice(None),)
+        return item
+        
+    def normalize_index(self, index, axis):
+        """Return an integer or a slice on an axis as an index accepted by
+        h5py, which only supports non negative integers and positive steps,
+        and whether the values read must be reversed."""
+        n = self.shape[axis]
+        if isinstance(index, slice):
+            start, stop, step = index.indices(n)
+            count = len(xrange(start, stop, step))
+            if count == 0:
+                return slice(0, 0), False
+            # last element, and same elements in the increasing order
+            last = start + (count - 1) * step
+            if step > 0:
+                return slice(start, last + 1, step), False
+            return slice(last, start + 1, -step), True
+        if not -n <= index < n:
+            raise IndexError(("Index %d out of bounds for the axis %d with %d "
+                "elements.") % (index, axis, n))
+        return index % n, False
+        
+    def __getitem__(self, item):
+        item = self.expand_index(item)
+        first = item[0]
+        integer = (int, long, np.integer)
+        if isinstance(first, (slice,) + integer):
+            # the integers and slices are passed to h5py, which only reads
+            # the requested part of the dataset, and the other indices are
+            # applied in memory on the axes which remain
+            read, rest, reverse = [], [], []
+            for axis, index in enumerate(item):
+                if isinstance(index, (slice,) + integer):
+                    index, reversed_ = self.normalize_index(index, axis)
+                    read.append(index)
+                    if isinstance(index, slice):
+                        if reversed_:
+                            reverse.append(len(rest))
+                        rest.append(slice(None))
+                else:
+                    read.append(slice(None))
+                    rest.append(index)
+            data = self.dataset[tuple(read)]
+            for axis in reverse:
+                data = data[(slice(None),) * axis + (slice(None, None, -1),)]
+            rest = tuple(rest)
+        else:
+            data = self.take(first)
+            rest = (slice(None),) + item[1:]
+        if any([not isinstance(index, slice) or index != slice(None)
+                for index in rest]):
+            data = data[rest]
+        return data
+        
+    def __array__(self, dtype=None):
+        data = np.empty(self.shape, dtype=self.dtype)
+        for start, end, block in self.iter_chunks():
+            data[start:end,...] = block
+        if dtype is not None:
+            data = data.astype(dtype)
+        return data
+
+
 class H5DataProvider(DataProvider):
-    def load(self, filename):
-        pass
+    """Load/save a DataHolder from/to a HDF5 file.
+    
+    The large arrays (waveforms, features, masks, spiketimes) are not read at
+    loading time: the DataHolder gets lazy H5ArrayProxy instances instead.
+    The small arrays (clusters, cluster colors, probe) are loaded in memory, and
+    only those which have changed are written back when saving.
+    
+    File layout: one dataset per array at the root of the file, and the
+    sampling frequency and the number of features per channel as attributes of
+    the root group.
+    
+    """
+    # arrays loaded lazily, through a proxy
+    lazy_arrays = ['spiketimes', 'waveforms', 'features', 'masks']
+    # arrays loaded in memory, and written back if they changed
+    memory_arrays = ['clusters', 'cluster_colors', 'probe_positions']
+    
+    file = None
+    
+    def load(self, filename, mode='r'):
+        if h5py is None:
+            raise ImportError("h5py is required to load HDF5 files.")
+        self.filename = filename
+        self.file = h5py.File(filename, mode)
+        f = self.file
         
-    def save(self, filename):
-        pass
+        self.holder = DataHolder()
+        
+        # lazy arrays
+        for name in self.lazy_arrays:
+            if name in f:
+                setattr(self.holder, name, H5ArrayProxy(f[name]))
+        
+        # in-memory arrays, with a copy to detect changes when saving
+        self.saved = {}
+        for name in self.memory_arrays:
+            if name in f:
+                self.saved[name] = f[name][...]
+        
+        if 'clusters' in self.saved:
+            self.holder.clusters = self.saved['clusters'].copy()
+            self.holder.nspikes = len(self.holder.clusters)
+        else:
+            # all spikes in a single cluster, the number of spikes being
+            # given by the first lazy array
+            nspikes = 0
+            for name in self.lazy_arrays:
+                if name in f:
+                    nspikes = f[name].shape[0]
+                    break
+            self.holder.nspikes = nspikes
+            self.holder.clusters = np.zeros(nspikes, dtype=np.int32)
+        
+        clusters_unique = np.unique(self.holder.clusters)
+        if 'cluster_colors' in self.saved:
+            cluster_colors = self.saved['cluster_colors'].copy()
+        else:
+            cluster_colors = np.array(colors.generate_colors(
+                len(clusters_unique)), dtype=np.float32)
+        self.holder.clusters_info = Info(colors=cluster_colors)
+        
+        self.holder.probe = Info(positions=self.saved.get('probe_positions'))
+        
+        self.holder.freq = f.attrs.get('freq', None)
+        if 'masks' in f:
+            self.holder.nchannels = f['masks'].shape[1]
+        if 'waveforms' in f:
+            self.holder.waveforms_info = Info(
+                nsamples=f['waveforms'].shape[1])
+        # number of features per channel, deduced from the shape of the
+        # features (with one extra column for the time) if not specified
+        fetdim = f.attrs.get('fetdim', None)
+        if fetdim is None and 'features' in f and 'masks' in f:
+            fetdim = (f['features'].shape[1] - 1) // f['masks'].shape[1]
+        self.holder.features_info = Info(fetdim=int(fetdim or 3))
+        if 'features' in f:
+            self.holder.features_columns = create_features_columns(
+                self.holder.features)
+        
+        # per-cluster waveform statistics, computed when first needed
+        if 'waveforms' in f:
+            self.holder.waveforms_stats = ClusterStatisticsCache(
+                self.holder.waveforms, self.holder.clusters)
+        
+        return self.holder
+        
+    def get_memory_array(self, name):
+        if name == 'clusters':
+            return self.holder.clusters
+        if name == 'cluster_colors':
+            return self.holder.clusters_info.colors
+        if name == 'probe_positions':
+            return self.holder.probe.positions
+        
+    def reopen(self, filename):
+        """Open a file in write mode, as a copy of the current file if it is a
+        different one, and bind the lazy proxies to its datasets."""
+        self.file.close()
+        if filename != self.filename:
+            shutil.copyfile(self.filename, filename)
+        self.filename = filename
+        self.file = h5py.File(filename, 'r+')
+        for name in self.lazy_arrays:
+            proxy = getattr(self.holder, name, None)
+            if isinstance(proxy, H5ArrayProxy):
+                proxy.set_dataset(self.file[proxy.name])
+        
+    def save(self, filename=None):
+        """Write the arrays that changed since the last load/save.
+        
+        If filename is different from the loaded file, the loaded file is
+        copied first, and the new file becomes the current one: the lazy
+        arrays then read from it.
+        
+        """
+        if filename is not None and \
+                os.path.abspath(filename) != os.path.abspath(self.filename):
+            self.reopen(filename)
+        # reopen the file in write mode if needed
+        elif self.file.mode == 'r':
+            self.reopen(self.filename)
+        f = self.file
+        
+        for name in self.memory_arrays:
+            arr = self.get_memory_array(name)
+            if arr is None:
+                continue
+            saved = self.saved.get(name)
+            if saved is not None and saved.shape == arr.shape and \
+                np.array_equal(saved, arr):
+                continue
+            if name in f and f[name].shape == arr.shape:
+                f[name][...] = arr
+            else:
+                if name in f:
+                    del f[name]
+                f.create_dataset(name, data=arr)
+            self.saved[name] = np.array(arr)
+        f.flush()
+        
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
 
 
 class MockDataProvider(DataProvider):
@@ -89,6 +414,7 @@ class MockDataProvider(DataProvider):
         # TODO
         # self.holder.features = rdn.randn(nspikes, nchannels, fetdim)
         self.holder.features = rdn.randn(nspikes, nchannels * fetdim + 1)
+        self.holder.features_info = Info(fetdim=fetdim)
         
         self.holder.masks = rdn.rand(nspikes, nchannels)
         self.holder.masks[self.holder.masks < .25] = 0
@@ -100,13 +426,30 @@ class MockDataProvider(DataProvider):
                                     
         self.holder.probe = Info(positions=np.loadtxt("data/buzsaki32.txt"))
         
+        # per-cluster waveform statistics
+        self.holder.waveforms_stats = ClusterStatisticsCache(
+            self.holder.waveforms, self.holder.clusters).compute()
+        
+        # spike times, in samples count
+        self.holder.freq = 20000.
+        self.holder.spiketimes = np.cumsum(
+            rdn.exponential(scale=100., size=nspikes)).astype(np.int64)
+        
         # cross correlograms
-        nsamples_correlograms = 20
-        self.holder.correlograms = rdn.rand(nclusters * (nclusters + 1) / 2,
-            nsamples_correlograms)
-        self.holder.correlograms_info = Info(nsamples=nsamples_correlograms)
+        binsize, windowsize = 20, 200
+        self.holder.correlograms_cache = CorrelogramsCache(
+            self.holder.spiketimes, self.holder.clusters,
+            binsize=binsize, windowsize=windowsize).compute()
+        correlograms = self.holder.correlograms_cache.get_correlograms()
+        self.holder.correlograms = normalize_correlograms(correlograms)
+        self.holder.correlograms_info = Info(nsamples=correlograms.shape[1],
+            binsize=binsize, windowsize=windowsize)
         
-        self.holder.correlationmatrix = rdn.rand(nclusters, nclusters) ** 10
+        # same clusters as the correlograms, the empty ones excepted
+        self.holder.correlationmatrix = compute_correlationmatrix(
+            self.holder.features, self.holder.masks, self.holder.clusters,
+            fetdim,
+            clusters_unique=self.holder.correlograms_cache.get_clusters())
         
         
         return self.holder
@@ -117,6 +460,113 @@ class MockDataProvider(DataProvider):
 
 
 
+class MemmapDataProvider(DataProvider):
+    """Load a DataHolder from flat binary files, as memory-mapped arrays.
+    
+    The raw trace, the filtered trace and the waveforms are exposed as
+    `numpy.memmap` views, so that opening a dataset is instantaneous and only
+    the pages actually accessed are read from disk.
+    
+    Files, with `filename` the common base name:
+      * filename.dat: raw trace, total_duration x nchannels, row-major
+      * filename.fil: filtered trace, same layout as the raw trace
+      * filename.spk: waveforms, nspikes x nsamples x nchannels, row-major
+      * filename.fet: features, nspikes x (nchannels * fetdim + 1), float32,
+        row-major, the last column being the time
+      * filename.msk: masks, nspikes x nchannels, float32, row-major
+      * filename.clu: cluster index of each spike, one per line, the first line
+        being the number of clusters (optional)
+    
+    """
+    def open_memmap(self, filename, dtype, shape_tail, mode):
+        if not os.path.exists(filename):
+            return None
+        # deduce the first dimension from the file size
+        itemsize = np.dtype(dtype).itemsize * int(np.prod(shape_tail))
+        nrows = os.path.getsize(filename) // itemsize
+        if nrows == 0:
+            return None
+        return np.memmap(filename, dtype=dtype, mode=mode,
+                         shape=(nrows,) + tuple(shape_tail))
+    
+    def load(self, filename, nchannels=None, nsamples=None, fetdim=None,
+             dtype=np.int16, freq=None, mode='r'):
+        if nchannels is None:
+            raise TypeError("The number of channels should be specified.")
+        self.filename = filename
+        
+        self.holder = DataHolder()
+        self.holder.freq = freq
+        self.holder.nchannels = nchannels
+        
+        # traces
+        self.holder.raw_trace = self.open_memmap(filename + '.dat', dtype,
+            (nchannels,), mode)
+        self.holder.filtered_trace = self.open_memmap(filename + '.fil', dtype,
+            (nchannels,), mode)
+        for trace in (self.holder.raw_trace, self.holder.filtered_trace):
+            if trace is not None:
+                self.holder.total_duration = trace.shape[0]
+                break
+        
+        # waveforms
+        if nsamples is not None:
+            self.holder.waveforms = self.open_memmap(filename + '.spk', dtype,
+                (nsamples, nchannels), mode)
+            self.holder.waveforms_info = Info(nsamples=nsamples)
+            if self.holder.waveforms is not None:
+                self.holder.nspikes = self.holder.waveforms.shape[0]
+        
+        # features and masks, with the features reordered by the feature view
+        # into a temporary memmap
+        if fetdim is not None:
+            self.holder.features = self.open_memmap(filename + '.fet',
+                np.float32, (nchannels * fetdim + 1,), mode)
+            self.holder.features_info = Info(fetdim=fetdim)
+            self.holder.masks = self.open_memmap(filename + '.msk',
+                np.float32, (nchannels,), mode)
+            if self.holder.features is not None:
+                self.holder.nspikes = self.holder.features.shape[0]
+                self.holder.features_columns = create_features_columns(
+                    self.holder.features)
+                
+        # clusters
+        if os.path.exists(filename + '.clu'):
+            self.holder.clusters = np.loadtxt(filename + '.clu',
+                dtype=np.int32, skiprows=1)
+        elif hasattr(self.holder, 'nspikes'):
+            self.holder.clusters = np.zeros(self.holder.nspikes,
+                dtype=np.int32)
+        if hasattr(self.holder, 'clusters'):
+            nclusters = len(np.unique(self.holder.clusters))
+            self.holder.clusters_info = Info(
+                colors=np.array(colors.generate_colors(nclusters),
+                                        dtype=np.float32))
+        
+        # per-cluster waveform statistics, computed when first needed
+        if (getattr(self.holder, 'waveforms', None) is not None and
+                hasattr(self.holder, 'clusters')):
+            self.holder.waveforms_stats = ClusterStatisticsCache(
+                self.holder.waveforms, self.holder.clusters)
+        
+        return self.holder
+        
+    def save(self, filename=None):
+        """Flush the memory-mapped arrays opened in write mode, and write the
+        cluster file."""
+        if filename is None:
+            filename = self.filename
+        for name in ['raw_trace', 'filtered_trace', 'waveforms', 'features',
+                     'masks']:
+            arr = getattr(self.holder, name, None)
+            if isinstance(arr, np.memmap) and arr.mode != 'r':
+                arr.flush()
+        if hasattr(self.holder, 'clusters'):
+            clusters = self.holder.clusters
+            np.savetxt(filename + '.clu',
+                np.hstack(([len(np.unique(clusters))], clusters)), fmt='%d')
+
+
 if __name__ == '__main__':
     provider = MockDataProvider()
     dataholder = provider.load()
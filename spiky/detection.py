@@ -0,0 +1,216 @@
+import tempfile
+
+import numpy as np
+
+from dataio import Info
+from filtering import bandpass_filter, get_chunks
+
+
+__all__ = [
+    'detect_chunks',
+    'detect_spikes',
+    'estimate_threshold',
+    'filter_chunks',
+    'iter_chunks',
+    ]
+
+
+# number and size of the blocks, spread over the trace, on which the
+# detection threshold is estimated
+THRESHOLD_CHUNKS = 10
+THRESHOLD_CHUNK_SIZE = 20000
+
+
+def iter_chunks(trace, chunk_size=100000, overlap=1000):
+    """Yield successive overlapping blocks of a trace.
+
+    Arguments:
+      * trace: a total_duration x nchannels array (or memmap, or HDF5 proxy)
+      * chunk_size: the number of samples in each block, without the overlap
+      * overlap: the number of additional samples on each side of the block
+
+    Yields:
+      * (start, end, keep_start, keep_end, block): block is trace[start:end],
+        and [keep_start, keep_end[ is the part of the block which belongs to
+        this chunk, the rest being the overlap with the neighbor chunks.
+
+    """
+    for start, end, keep_start, keep_end in get_chunks(trace.shape[0],
+            chunk_size=chunk_size, overlap=overlap):
+        yield start, end, keep_start, keep_end, np.asarray(trace[start:end])
+
+
+def filter_chunks(chunks, freq, low=500., high=None, order=3, output=None):
+    """Filter each block of a sequence of chunks.
+
+    The overlap of the chunks absorbs the edge effects of the filter. If
+    output is specified (a preallocated array or memmap with the shape of the
+    trace), the filtered samples of every chunk are written into it.
+
+    Yields the chunks, with the filtered blocks.
+
+    """
+    for start, end, keep_start, keep_end, block in chunks:
+        filtered = bandpass_filter(np.asarray(block, dtype=np.float64),
+            freq, low=low, high=high, order=order)
+        if output is not None:
+            output[keep_start:keep_end] = \
+                filtered[keep_start - start:keep_end - start]
+        yield start, end, keep_start, keep_end, filtered
+
+
+def get_threshold(filtered, k=4.5):
+    """Estimate the detection threshold of each channel, as k times the
+    standard deviation of the noise (estimated with the median).
+
+    The median is null on a channel which is flat most of the time, the
+    standard deviation is used instead on such a channel, and its threshold
+    is infinite if the channel is entirely flat.
+
+    """
+    threshold = k * np.median(np.abs(filtered), axis=0) / .6745
+    null = threshold <= 0
+    if null.any():
+        threshold[null] = k * np.std(filtered[:, null], axis=0)
+        threshold[threshold <= 0] = np.inf
+    return threshold
+
+
+def estimate_threshold(trace, freq, nchunks=THRESHOLD_CHUNKS,
+                       chunk_size=THRESHOLD_CHUNK_SIZE, overlap=1000,
+                       low=500., high=None, order=3, k=4.5):
+    """Estimate the detection threshold of each channel on nchunks blocks of
+    chunk_size samples evenly spaced in a raw trace, rather than on its
+    beginning only, which may not be representative of the recording (e.g.
+    when the amplifier settles)."""
+    n = trace.shape[0]
+    starts = np.unique(np.linspace(0, max(n - chunk_size, 0),
+                                   nchunks).astype(np.int64))
+    blocks = []
+    for keep_start in starts:
+        keep_end = min(keep_start + chunk_size, n)
+        start, end = max(0, keep_start - overlap), min(n, keep_end + overlap)
+        filtered = bandpass_filter(np.asarray(trace[start:end],
+            dtype=np.float64), freq, low=low, high=high, order=order)
+        blocks.append(filtered[keep_start - start:keep_end - start])
+    return get_threshold(np.vstack(blocks), k=k)
+
+
+def find_peaks(filtered, threshold):
+    """Find the negative threshold crossings in a filtered block.
+
+    Returns the index of the peak (minimum of the signal normalized by the
+    threshold, over all channels) in every excursion below the threshold.
+    The channels with a null threshold are ignored.
+
+    """
+    threshold = np.asarray(threshold, dtype=np.float64).reshape((1, -1))
+    threshold = np.where(threshold > 0, threshold, np.inf)
+    # normalized signal, minimum over channels
+    x = (filtered / threshold).min(axis=1)
+    crossing = np.hstack(([False], x < -1, [False])).astype(np.int8)
+    # excursions below the threshold
+    edges = np.diff(crossing)
+    starts = np.nonzero(edges == 1)[0]
+    ends = np.nonzero(edges == -1)[0]
+    if len(starts) == 0:
+        return np.zeros(0, dtype=np.int64)
+    # all samples of all excursions, with the excursion index
+    lengths = ends - starts
+    first = np.hstack(([0], np.cumsum(lengths)[:-1]))
+    labels = np.repeat(np.arange(len(starts)), lengths)
+    samples = np.repeat(starts - first, lengths) + np.arange(lengths.sum())
+    # minimum of the signal within every excursion
+    order = np.lexsort((x[samples], labels))
+    return samples[order[first]]
+
+
+def detect_chunks(chunks, threshold=None, nsamples_before=10,
+                  nsamples_after=22, k=4.5):
+    """Detect the spikes and extract their waveforms in each block of a
+    sequence of filtered chunks.
+
+    A spike is kept by a chunk only if its peak is in the part of the block
+    which belongs to the chunk, so that spikes near the chunk boundaries are
+    detected once, provided that the overlap is larger than the waveforms.
+
+    Arguments:
+      * chunks: the output of filter_chunks
+      * threshold: the detection threshold of every channel. By default,
+        estimated on the first chunk (detect_spikes estimates it on the
+        whole trace with estimate_threshold).
+      * nsamples_before, nsamples_after: the number of samples of every
+        waveform before and after the peak
+
+    Yields:
+      * (spiketimes, waveforms): for every chunk, the times of the spikes in
+        samples count, and a nspikes x nsamples x nchannels array
+
+    """
+    offsets = np.arange(-nsamples_before, nsamples_after)
+    for start, end, keep_start, keep_end, filtered in chunks:
+        if threshold is None:
+            threshold = get_threshold(filtered, k=k)
+        peaks = find_peaks(filtered, threshold)
+        # keep the spikes of this chunk, with a complete waveform
+        times = peaks + start
+        keep = ((times >= keep_start) & (times < keep_end) &
+                (peaks >= nsamples_before) &
+                (peaks + nsamples_after <= filtered.shape[0]))
+        peaks = peaks[keep]
+        waveforms = filtered[peaks.reshape((-1, 1)) + offsets.reshape((1, -1))]
+        yield times[keep], waveforms.astype(np.float32)
+
+
+def detect_spikes(holder, chunk_size=100000, overlap=1000, low=500.,
+                  high=None, order=3, threshold=None, nsamples_before=10,
+                  nsamples_after=22, waveforms_file=None):
+    """Filter the raw trace of a DataHolder, detect the spikes and extract
+    their waveforms, chunk by chunk.
+
+    The memory used by the processing is bounded by the chunk size,
+    whatever the length of the recording. By default, the detection
+    threshold is estimated on blocks spread over the whole trace. The
+    filtered trace is written into holder.filtered_trace if it exists (e.g.
+    a writable memmap), otherwise it is not kept. The waveforms of every
+    chunk are appended to waveforms_file (a file name, the waveforms being
+    float32 values), or to a temporary file by default, and holder.waveforms
+    is a memmap on this file. Fill holder.filter_info, holder.spiketimes,
+    holder.waveforms and holder.waveforms_info.
+
+    """
+    raw_trace = holder.raw_trace
+    output = getattr(holder, 'filtered_trace', None)
+    holder.filter_info = Info(low=low, high=high, order=order)
+    if threshold is None:
+        threshold = estimate_threshold(raw_trace, holder.freq,
+            overlap=overlap, low=low, high=high, order=order)
+
+    chunks = iter_chunks(raw_trace, chunk_size=chunk_size, overlap=overlap)
+    chunks = filter_chunks(chunks, holder.freq, low=low, high=high,
+        order=order, output=output)
+
+    if waveforms_file is None:
+        f = tempfile.TemporaryFile()
+    else:
+        f = open(waveforms_file, 'w+b')
+    spiketimes = [np.zeros(0, dtype=np.int64)]
+    for times, waveforms in detect_chunks(chunks, threshold=threshold,
+            nsamples_before=nsamples_before, nsamples_after=nsamples_after):
+        spiketimes.append(times)
+        waveforms.tofile(f)
+    f.flush()
+
+    nsamples = nsamples_before + nsamples_after
+    nchannels = raw_trace.shape[1]
+    holder.spiketimes = np.hstack(spiketimes)
+    holder.nspikes = len(holder.spiketimes)
+    if holder.nspikes > 0:
+        holder.waveforms = np.memmap(f, dtype=np.float32, mode='r+',
+            shape=(holder.nspikes, nsamples, nchannels))
+    else:
+        holder.waveforms = np.zeros((0, nsamples, nchannels),
+            dtype=np.float32)
+    f.close()
+    holder.waveforms_info = Info(nsamples=nsamples)
+    return holder
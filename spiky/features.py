@@ -0,0 +1,130 @@
+import numpy as np
+import numpy.random as rdn
+
+from dataio import Info
+
+
+__all__ = [
+    'compute_features',
+    'fit_pca',
+    'project_features',
+    ]
+
+
+def get_subsample(nspikes, nsubsample=10000, seed=None):
+    """Return the sorted indices of a random subset of at most nsubsample
+    spikes."""
+    if nspikes <= nsubsample:
+        return np.arange(nspikes)
+    state = rdn.RandomState(seed)
+    return np.sort(state.permutation(nspikes)[:nsubsample])
+
+
+def fit_pca(waveforms, fetdim=3, nsubsample=10000, batch_size=10000,
+            seed=None):
+    """Compute the principal components of the waveforms on every channel.
+
+    The PCA is fitted on a random subset of spikes. The covariance matrices
+    of all channels are accumulated batch by batch, so that the memory used is
+    bounded by the batch size, and waveforms can be a memory-mapped array or
+    a HDF5 proxy. Since the dimension of the PCA is the number of samples per
+    waveform, the covariance matrices are small and diagonalized exactly.
+
+    Arguments:
+      * waveforms: a nspikes x nsamples x nchannels array
+      * fetdim=3: the number of components per channel
+      * nsubsample=10000: the maximum number of spikes used for the fit
+      * batch_size=10000: the number of spikes read at once
+      * seed=None: the seed of the random subsample
+
+    Returns:
+      * means: a nsamples x nchannels array with the mean waveform
+      * components: a nchannels x nsamples x fetdim array with the principal
+        components of every channel, by decreasing variance
+
+    """
+    nspikes, nsamples, nchannels = waveforms.shape
+    indices = get_subsample(nspikes, nsubsample=nsubsample, seed=seed)
+    n = max(len(indices), 1)
+
+    sums = np.zeros((nsamples, nchannels))
+    products = np.zeros((nchannels, nsamples, nsamples))
+    for start in xrange(0, len(indices), batch_size):
+        batch = np.asarray(waveforms[indices[start:start + batch_size]],
+                           dtype=np.float64)
+        sums += batch.sum(axis=0)
+        # nchannels x nspikes x nsamples, for a batched matrix product
+        batch = batch.transpose((2, 0, 1))
+        products += np.matmul(batch.transpose((0, 2, 1)), batch)
+    means = sums / n
+    covariances = products / n - np.einsum('sc,tc->cst', means, means)
+
+    # eigenvectors of the covariance matrices, by decreasing eigenvalue
+    components = np.zeros((nchannels, nsamples, fetdim))
+    for channel in xrange(nchannels):
+        _, vectors = np.linalg.eigh(covariances[channel])
+        components[channel] = vectors[:,::-1][:,:fetdim]
+    return means, components
+
+
+def project_features(waveforms, means, components, spiketimes=None,
+                     batch_size=10000, output=None):
+    """Project the waveforms on the principal components, batch by batch.
+
+    Arguments:
+      * waveforms: a nspikes x nsamples x nchannels array
+      * means, components: the output of fit_pca
+      * spiketimes=None: the spike times, written in the last column
+      * batch_size=10000: the number of spikes processed at once
+      * output=None: a preallocated nspikes x (nchannels * fetdim + 1) array
+        (e.g. a writable memmap or a HDF5 dataset). By default, allocated
+        in memory. It should be float64: in float32, the spike times lose
+        the sample resolution after 2^24 samples (about 8 minutes at
+        32 kHz).
+
+    Returns:
+      * features: a nspikes x (nchannels * fetdim + 1) array, the features of
+        channel c being the columns c * fetdim to (c + 1) * fetdim - 1, and
+        the last column the spike time.
+
+    """
+    nspikes = waveforms.shape[0]
+    nchannels, _, fetdim = components.shape
+    nfeatures = nchannels * fetdim
+    if output is None:
+        output = np.zeros((nspikes, nfeatures + 1), dtype=np.float64)
+
+    for start in xrange(0, nspikes, batch_size):
+        end = min(start + batch_size, nspikes)
+        batch = np.asarray(waveforms[start:end], dtype=np.float64) - means
+        features = np.empty((end - start, nfeatures + 1))
+        # nchannels x nspikes x fetdim
+        projections = np.matmul(batch.transpose((2, 0, 1)), components)
+        features[:,:nfeatures] = projections.transpose((1, 0, 2)).reshape(
+            (-1, nfeatures))
+        if spiketimes is not None:
+            features[:,-1] = spiketimes[start:end]
+        else:
+            features[:,-1] = 0
+        output[start:end] = features
+    return output
+
+
+def compute_features(holder, fetdim=3, nsubsample=10000, batch_size=10000,
+                     seed=None, output=None):
+    """Compute the features of all spikes of a DataHolder from their
+    waveforms, with a PCA on every channel.
+
+    Fill holder.features, in the layout expected by FeatureView, and
+    holder.features_info (fetdim, and the means and components of the PCA,
+    to project new spikes).
+
+    """
+    means, components = fit_pca(holder.waveforms, fetdim=fetdim,
+        nsubsample=nsubsample, batch_size=batch_size, seed=seed)
+    holder.features = project_features(holder.waveforms, means, components,
+        spiketimes=getattr(holder, 'spiketimes', None),
+        batch_size=batch_size, output=output)
+    holder.features_info = Info(fetdim=fetdim, means=means,
+                                components=components)
+    return holder
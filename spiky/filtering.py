@@ -0,0 +1,172 @@
+import multiprocessing
+import multiprocessing.pool
+import os
+import threading
+
+import numpy as np
+from scipy import signal
+
+
+__all__ = [
+    'bandpass_filter',
+    'filter_trace',
+    'get_chunks',
+    ]
+
+
+def get_chunks(n, chunk_size=100000, overlap=1000):
+    """Return the list of chunks of a trace with n samples, as tuples
+    (start, end, keep_start, keep_end).
+
+    [keep_start, keep_end[ is the part of the trace which belongs to the
+    chunk, and [start, end[ the part which is read, with overlap additional
+    samples on each side (except at the edges of the trace).
+
+    """
+    chunks = []
+    for keep_start in xrange(0, n, chunk_size):
+        keep_end = min(keep_start + chunk_size, n)
+        chunks.append((max(0, keep_start - overlap), min(n, keep_end + overlap),
+                       keep_start, keep_end))
+    return chunks
+
+
+def bandpass_filter(data, freq, low=500., high=None, order=3):
+    """Apply a Butterworth band-pass filter (forward and backward) on each
+    column of data, sampled at freq. high=None means 0.95 * Nyquist
+    frequency."""
+    nyquist = freq / 2.
+    if high is None:
+        high = .95 * nyquist
+    b, a = signal.butter(order, (low / nyquist, high / nyquist), 'pass')
+    return signal.filtfilt(b, a, data, axis=0)
+
+
+def flush(output):
+    """Write the pending changes of a memmap or HDF5 dataset to disk."""
+    if hasattr(output, 'flush'):
+        output.flush()
+    elif hasattr(output, 'file'):
+        output.file.flush()
+
+
+class Checkpoint(object):
+    """Record the chunks already processed in a text file, one index per line
+    after a header line with the chunk and filter parameters.
+
+    The output is flushed every flush_every chunks, and the chunks written
+    since the previous flush are recorded only then, once their data is on
+    disk.
+
+    """
+    def __init__(self, filename, output, chunk_size, overlap, freq, low,
+                 high, order, flush_every=16):
+        self.filename = filename
+        self.output = output
+        if high is not None:
+            high = float(high)
+        self.header = ("chunk_size=%d overlap=%d freq=%r low=%r high=%r "
+            "order=%d") % (chunk_size, overlap, float(freq), float(low), high,
+                           order)
+        self.flush_every = flush_every
+        self.pending = []
+        # reentrant, as add calls commit
+        self.lock = threading.RLock()
+
+    def load(self):
+        """Return the set of chunks already processed."""
+        if self.filename is None or not os.path.exists(self.filename):
+            return set()
+        with open(self.filename, 'r') as f:
+            lines = f.read().splitlines()
+        if not lines or lines[0] != self.header:
+            raise ValueError(("The checkpoint file %s has been created with "
+                "different chunk or filter parameters.") % self.filename)
+        return set([int(line) for line in lines[1:] if line.strip()])
+
+    def start(self):
+        if self.filename is not None and not os.path.exists(self.filename):
+            with open(self.filename, 'w') as f:
+                f.write(self.header + "\n")
+
+    def add(self, index):
+        """Record a chunk whose data has been written to the output."""
+        with self.lock:
+            self.pending.append(index)
+            if len(self.pending) >= self.flush_every:
+                self.commit()
+
+    def commit(self):
+        """Flush the output, and record the pending chunks."""
+        with self.lock:
+            if not self.pending:
+                return
+            flush(self.output)
+            if self.filename is not None:
+                with open(self.filename, 'a') as f:
+                    f.write("".join(["%d\n" % index
+                                     for index in self.pending]))
+            self.pending = []
+
+
+def filter_trace(raw_trace, output, freq, low=500., high=None, order=3,
+                 chunk_size=100000, overlap=1000, nthreads=None,
+                 checkpoint=None, flush_every=16):
+    """Filter a raw trace into a preallocated output, chunk by chunk, in a
+    pool of threads.
+
+    Each chunk is read with an overlap on both sides, which absorbs the edge
+    effects of the filter, and only its own samples are written. The
+    filtering functions of NumPy/SciPy release the GIL, so that the chunks are
+    actually processed in parallel.
+
+    Arguments:
+      * raw_trace: a total_duration x nchannels array (or memmap, or HDF5
+        proxy)
+      * output: a preallocated array with the same shape, typically a
+        writable memmap or a HDF5 dataset
+      * freq, low, high, order: the filter parameters, see bandpass_filter
+      * chunk_size, overlap: the chunk parameters, see get_chunks
+      * nthreads=None: the number of threads, by default the number of CPUs
+      * checkpoint=None: the name of a file where the processed chunks are
+        recorded, once written to disk. If the file exists, these chunks are
+        skipped, so that an interrupted job can be resumed.
+      * flush_every=16: the number of chunks written between two flushes
+        of the output. Up to this number of chunks are processed again
+        when a job is resumed.
+
+    """
+    chunks = get_chunks(raw_trace.shape[0], chunk_size=chunk_size,
+                        overlap=overlap)
+    checkpoint = Checkpoint(checkpoint, output, chunk_size, overlap, freq,
+        low, high, order, flush_every=flush_every)
+    done = checkpoint.load()
+    checkpoint.start()
+
+    def process(index):
+        start, end, keep_start, keep_end = chunks[index]
+        filtered = bandpass_filter(
+            np.asarray(raw_trace[start:end], dtype=np.float64),
+            freq, low=low, high=high, order=order)
+        output[keep_start:keep_end] = \
+            filtered[keep_start - start:keep_end - start]
+        # the chunk is recorded only once its data is on disk
+        checkpoint.add(index)
+
+    indices = [index for index in xrange(len(chunks)) if index not in done]
+    if nthreads != 1:
+        if nthreads is None:
+            nthreads = multiprocessing.cpu_count()
+        pool = multiprocessing.pool.ThreadPool(nthreads)
+        try:
+            # consume the results, to raise the exceptions of the workers
+            for _ in pool.imap_unordered(process, indices):
+                pass
+        finally:
+            pool.terminate()
+            pool.join()
+    else:
+        for index in indices:
+            process(index)
+    checkpoint.commit()
+    return output
@@ -5,6 +5,10 @@ from dataio import MockDataProvider
 
 SETTINGS = tools.init_settings()
 
+# file where the profiling records of the views are saved when the window is
+# closed, if profiling is enabled (SPIKY_PROFILING environment variable)
+PROFILING_FILENAME = "spiky_profiling.json"
+
 __all__ = ['SpikyMainWindow']
 
 def get_default_widget_controller():
@@ -75,7 +79,8 @@ class WaveformWidget(VisualizationWidget):
                       clusters=dh.clusters,
                       cluster_colors=dh.clusters_info.colors,
                       geometrical_positions=dh.probe.positions,
-                      masks=dh.masks)
+                      masks=dh.masks,
+                      waveforms_stats=getattr(dh, 'waveforms_stats', None))
         return view
 
     
@@ -85,9 +90,10 @@ class FeatureWidget(VisualizationWidget):
     def create_view(self, dh):
         view = FeatureView()
         view.set_data(dh.features, clusters=dh.clusters,
-                      fetdim=3,
+                      fetdim=dh.features_info.fetdim,
                       cluster_colors=dh.clusters_info.colors,
-                      masks=dh.masks)
+                      masks=dh.masks,
+                      features_columns=getattr(dh, 'features_columns', None))
         return view
 
     def create_controller(self):
@@ -194,8 +200,15 @@ class SpikyMainWindow(QtGui.QMainWindow):
         
         
         
+    def dump_profiling(self, filename=PROFILING_FILENAME):
+        """Save the duration and peak memory of the calls of the profiled
+        functions of the views in a JSON file."""
+        PROFILER.dump(filename)
+        
     def closeEvent(self, e):
         self.save_geometry()
+        if PROFILER.enabled:
+            self.dump_profiling()
         super(SpikyMainWindow, self).closeEvent(e)
 
 
@@ -0,0 +1,160 @@
+import numpy as np
+
+from clustering import sum_by_cluster
+
+
+__all__ = [
+    'ClusterStatisticsCache',
+    ]
+
+
+class ClusterStatisticsCache(object):
+    """Number of spikes, sums and sums of squares of some per-spike data
+    (typically the waveforms) for every cluster, keyed by cluster absolute
+    index, and updated incrementally when clusters change.
+
+    The data is read once, chunk by chunk, when the statistics are computed,
+    either explicitly with compute(), or when they are first needed, so that
+    creating the cache is instantaneous. When clusters are merged, the new
+    statistics are sums of the existing ones. When spikes are reassigned,
+    only the data of the moved spikes is read. The mean and standard
+    deviation of every cluster are derived from these statistics.
+
+    """
+    def __init__(self, data, clusters, chunk_size=10000):
+        self.data = data
+        self.clusters = np.array(clusters)
+        self.chunk_size = chunk_size
+        self.shape = data.shape[1:]
+        self.counts = {}
+        self.sums = {}
+        self.sums2 = {}
+        self.computed = False
+
+    def check_computed(self):
+        """Compute the statistics if this has not been done yet."""
+        if not self.computed:
+            self.compute()
+
+    def get_clusters(self):
+        self.check_computed()
+        return np.array(sorted(self.counts.keys()))
+
+    def add(self, clusters_unique, counts, sums, sums2, sign=1):
+        """Add (or subtract, if sign is -1) grouped statistics."""
+        for cluster, count, s, s2 in zip(clusters_unique, counts, sums, sums2):
+            if cluster not in self.counts:
+                self.counts[cluster] = 0
+                self.sums[cluster] = np.zeros(self.shape)
+                self.sums2[cluster] = np.zeros(self.shape)
+            self.counts[cluster] += sign * count
+            self.sums[cluster] += sign * s
+            self.sums2[cluster] += sign * s2
+
+    def compute(self):
+        """Compute the statistics of all clusters, with a single pass on the
+        data."""
+        self.counts, self.sums, self.sums2 = {}, {}, {}
+        nspikes = self.data.shape[0]
+        for start in xrange(0, nspikes, self.chunk_size):
+            end = min(start + self.chunk_size, nspikes)
+            self.add(*sum_by_cluster(self.data[start:end],
+                                     self.clusters[start:end]))
+        self.computed = True
+        return self
+
+    def prune(self):
+        """Remove the statistics of the clusters which do not have any spike
+        anymore."""
+        for cluster in self.counts.keys():
+            if self.counts[cluster] == 0:
+                del self.counts[cluster]
+                del self.sums[cluster]
+                del self.sums2[cluster]
+
+    def merge(self, clusters_merged, cluster_new):
+        """Merge several clusters into a new one, without reading the
+        data."""
+        if not self.computed:
+            merged = np.in1d(self.clusters, clusters_merged)
+            self.clusters[merged] = cluster_new
+            return
+        clusters_merged = [cluster for cluster in np.unique(clusters_merged)
+                           if cluster in self.counts and
+                              cluster != cluster_new]
+        self.add([cluster_new] * len(clusters_merged),
+                 [self.counts[c] for c in clusters_merged],
+                 [self.sums[c] for c in clusters_merged],
+                 [self.sums2[c] for c in clusters_merged])
+        self.clusters[np.in1d(self.clusters, clusters_merged)] = cluster_new
+        for cluster in clusters_merged:
+            del self.counts[cluster]
+            del self.sums[cluster]
+            del self.sums2[cluster]
+
+    def reassign(self, spikes, clusters):
+        """Move spikes to other clusters (split or manual reassignment), by
+        reading the data of the moved spikes only."""
+        spikes = np.asarray(spikes, dtype=np.int64)
+        clusters = np.asarray(clusters)
+        if clusters.ndim == 0:
+            clusters = np.repeat(clusters, len(spikes))
+        if len(spikes) == 0:
+            return
+        if not self.computed:
+            self.clusters[spikes] = clusters
+            return
+        # read the moved spikes in increasing order
+        order = np.argsort(spikes)
+        spikes, clusters = spikes[order], clusters[order]
+        data = self.data[spikes]
+        self.add(*sum_by_cluster(data, self.clusters[spikes]), sign=-1)
+        self.add(*sum_by_cluster(data, clusters))
+        self.clusters[spikes] = clusters
+        self.prune()
+
+    def get_count(self, cluster):
+        self.check_computed()
+        return self.counts[cluster]
+
+    def get_counts(self, clusters_unique=None):
+        """Return the number of spikes of the given clusters (by default all
+        clusters), the clusters without any spike having a null count."""
+        if clusters_unique is None:
+            clusters_unique = self.get_clusters()
+        self.check_computed()
+        return np.array([self.counts.get(cluster, 0)
+                         for cluster in clusters_unique], dtype=np.int64)
+
+    def get_mean(self, cluster):
+        """Return the mean of the data of a cluster (absolute index)."""
+        self.check_computed()
+        return self.sums[cluster] / max(self.counts[cluster], 1)
+
+    def get_std(self, cluster):
+        """Return the standard deviation of the data of a cluster (absolute
+        index)."""
+        self.check_computed()
+        n = max(self.counts[cluster], 1)
+        mean = self.sums[cluster] / n
+        return np.sqrt(np.maximum(self.sums2[cluster] / n - mean ** 2, 0))
+
+    def get_means(self, clusters_unique=None):
+        """Return the means of the given clusters (by default all clusters) as
+        a single array, the clusters without any spike having a null mean."""
+        return self.get_array(self.get_mean, clusters_unique)
+
+    def get_stds(self, clusters_unique=None):
+        """Return the standard deviations of the given clusters (by default
+        all clusters) as a single array."""
+        return self.get_array(self.get_std, clusters_unique)
+
+    def get_array(self, fun, clusters_unique=None):
+        if clusters_unique is None:
+            clusters_unique = self.get_clusters()
+        self.check_computed()
+        arr = np.zeros((len(clusters_unique),) + self.shape)
+        for i, cluster in enumerate(clusters_unique):
+            if cluster in self.counts:
+                arr[i] = fun(cluster)
+        return arr
@@ -2,6 +2,7 @@ from waveformview import *
 from featureview import *
 from correlogramsview import *
 from correlationmatrixview import *
+from profiling import *
 
 
 
@@ -1,10 +1,128 @@
 import numpy as np
-import operator
 
 from galry import *
+from profiling import profiled
 
 
-__all__ = ['SpikeDataOrganizer', 'HighlightManager']
+__all__ = ['SpikeDataOrganizer', 'HighlightManager', 'GridIndex',
+           'get_ranges', 'get_ranges_indices', 'merge_ranges',
+           'points_in_polygon', 'upload_ranges',
+           'get_cluster_capacity', 'pad_cluster_colors', 'delete_dataset']
+
+
+def get_ranges(indices):
+    """Return the list of contiguous (start, end) ranges in a sorted array
+    of unique indices, with end excluded."""
+    indices = np.asarray(indices)
+    if len(indices) == 0:
+        return []
+    bounds = np.nonzero(np.diff(indices) != 1)[0] + 1
+    starts = indices[np.hstack(([0], bounds))]
+    ends = indices[np.hstack((bounds - 1, [len(indices) - 1]))] + 1
+    return zip(starts, ends)
+    
+    
+def get_ranges_indices(starts, ends):
+    """Concatenate the indices of several (start, end) ranges, end excluded,
+    without a Python loop."""
+    starts = np.asarray(starts, dtype=np.int64)
+    lengths = np.asarray(ends, dtype=np.int64) - starts
+    total = lengths.sum()
+    # offset of each range in the concatenated array
+    offsets = np.zeros(len(lengths), dtype=np.int64)
+    offsets[1:] = np.cumsum(lengths)[:-1]
+    return np.repeat(starts - offsets, lengths) + np.arange(total)
+    
+    
+def points_in_polygon(points, polygon):
+    """Return a boolean array telling whether each point (N x 2 array) is
+    inside the polygon (K x 2 array with the vertices), with the even-odd
+    rule. The loop is on the edges, each edge being tested against all
+    points at once."""
+    x, y = points[:,0], points[:,1]
+    inside = np.zeros(len(points), dtype=np.bool_)
+    xj, yj = polygon[-1]
+    for xi, yi in polygon:
+        # points whose horizontal line crosses the edge
+        crossing = np.nonzero((yi > y) != (yj > y))[0]
+        if len(crossing) > 0:
+            xc = (xj - xi) * (y[crossing] - yi) / (yj - yi) + xi
+            inside[crossing] ^= x[crossing] < xc
+        xj, yj = xi, yi
+    return inside
+    
+    
+# partial buffer updates separated by less than this number of bytes are
+# merged into a single update
+UPLOAD_GAP_BYTES = 65536
+
+
+def merge_ranges(ranges, max_gap):
+    """Merge the sorted (start, end) ranges separated by at most max_gap
+    elements. The ranges separated by larger gaps are kept apart, however
+    many they are."""
+    if len(ranges) <= 1:
+        return ranges
+    starts, ends = np.array(ranges).T
+    splits = np.nonzero(starts[1:] - ends[:-1] > max_gap)[0]
+    return zip(starts[np.hstack(([0], splits + 1))],
+               ends[np.hstack((splits, [len(ends) - 1]))])
+    
+    
+# minimum number of clusters the GPU datasets have room for
+MIN_CLUSTER_CAPACITY = 16
+
+
+def get_cluster_capacity(nclusters):
+    """Return the number of clusters the GPU datasets have room for (e.g. the
+    size of the cluster colors uniform), so that they only need to be
+    created again when the number of clusters doubles."""
+    capacity = MIN_CLUSTER_CAPACITY
+    while capacity < nclusters:
+        capacity *= 2
+    return capacity
+    
+    
+def pad_cluster_colors(cluster_colors, capacity):
+    """Return the cluster colors padded with zeros up to the capacity."""
+    padded = np.zeros((capacity, 3), dtype=np.float32)
+    padded[:len(cluster_colors)] = cluster_colors
+    return padded
+    
+    
+def delete_dataset(paint_manager, dataset):
+    """Hide a dataset and release its buffers, textures and shaders in video
+    memory, before it is replaced by a new one."""
+    paint_manager.set_data(visible=False, dataset=dataset)
+    dataset["loader"].cleanup()
+    paint_manager.datasets.remove(dataset)
+    
+    
+@profiled("upload_ranges")
+def upload_ranges(paint_manager, dataset, ranges, **arrays):
+    """Upload only the given (start, end) ranges of some vertex attributes,
+    and return the number of uploaded vertices. The textures do not support
+    partial updates, and are always uploaded entirely.
+    
+    Each keyword argument is the name of an attribute with the full host
+    array: only the subarrays in the ranges are sent to the GPU, as partial
+    updates starting at `onset`. Ranges separated by less than
+    UPLOAD_GAP_BYTES are merged into a single update, the others are
+    uploaded separately, so that the uploaded size is proportional to the
+    size of the ranges.
+    
+    """
+    # size of the data of a vertex, in all arrays
+    nbytes = sum([arr.dtype.itemsize * int(np.prod(arr.shape[1:]))
+                  for arr in arrays.itervalues()])
+    uploaded = 0
+    for start, end in merge_ranges(ranges,
+                                   UPLOAD_GAP_BYTES // max(nbytes, 1)):
+        subarrays = dict([(name, arr[start:end,...])
+            for name, arr in arrays.iteritems()])
+        paint_manager.set_data(dataset=dataset, onset=start, **subarrays)
+        uploaded += end - start
+    return uploaded
 
 
 class SpikeDataOrganizer(object):
@@ -14,13 +132,22 @@ class SpikeDataOrganizer(object):
         # reorder data
         self.reorder()
         
+    @profiled("organizer.set_data")
     def set_data(self, data, clusters=None, cluster_colors=None, masks=None,
-                             nchannels=None, spike_ids=None):
+                             nchannels=None, spike_ids=None,
+                             column_major=False, output=None):
         """
         Arguments:
           * data: a Nspikes x ?? (x ??) array
           * clusters: a Nspikes array, dtype=int, absolute indices
           * cluster_colors: as a function of the RELATIVE index
+          * column_major: for a Nspikes x Nfeatures array, store the
+            reordered data column by column, so that every feature of all
+            spikes is contiguous. data_reordered is then the transposed view
+            of a Nfeatures x Nspikes array.
+          * output: in the column major mode, a preallocated Nfeatures x
+            Nspikes float32 array (e.g. a writable memmap) receiving the
+            reordered data
         """
         # get the number of spikes from the first dimension of data
         self.nspikes = data.shape[0]
@@ -34,22 +161,34 @@ class SpikeDataOrganizer(object):
         if clusters is None:
             clusters = np.zeros(self.nspikes, dtype=np.int)
         if masks is None:
-            masks = np.ones((self.nspikes, self.nchannels))
+            masks = np.ones((self.nspikes, nchannels))
         if spike_ids is None:
             spike_ids = np.arange(self.nspikes)
             
-        self.data = enforce_dtype(data, np.float32)
-        self.clusters = enforce_dtype(clusters, np.int32)
-        self.masks = enforce_dtype(masks, np.float32)
-        self.cluster_colors = enforce_dtype(cluster_colors, np.float32)
-        
-        # unique clusters
+        # unique clusters: sorted here, but the clusters created later by
+        # add_clusters are appended, so that the relative indices of the
+        # existing clusters never change. clusters_unique is therefore only
+        # sorted until new clusters are created.
         self.clusters_unique = np.unique(clusters)
-        self.clusters_unique.sort()
         self.nclusters = len(self.clusters_unique)
         
         if cluster_colors is None:
             cluster_colors = np.ones((self.nclusters, 3))
+            
+        if column_major and self.ndim != 2:
+            raise ValueError("The column major mode requires a 2D array.")
+        self.column_major = column_major
+        self.output = output
+        
+        # in the column major mode, the data is converted chunk by chunk
+        # when it is reordered, so that a memmap is never loaded entirely
+        if column_major:
+            self.data = data
+        else:
+            self.data = enforce_dtype(data, np.float32)
+        self.clusters = enforce_dtype(clusters, np.int32)
+        self.masks = enforce_dtype(masks, np.float32)
+        self.cluster_colors = enforce_dtype(cluster_colors, np.float32)
         
         # same as clusters, but with relative indexing instead of absolute
         clusters_rel = np.arange(self.clusters_unique.max() + 1)
@@ -59,32 +198,36 @@ class SpikeDataOrganizer(object):
     def get_reordering(self):
         # regroup spikes from the same clusters, so that all data from
         # one cluster are contiguous in memory (better for OpenGL rendering)
-        # permutation contains the spike indices in successive clusters
-        self.permutation = []
-        self.cluster_sizes_dict = {}
-        self.cluster_sizes_cum = {}
-        counter = 0
-        for cluster in self.clusters_unique:
-            # spike indices in the current cluster
-            ids = np.nonzero(self.clusters == cluster)[0]
-            # size of the current cluster
-            size = len(ids)
-            # record the size
-            self.cluster_sizes_dict[cluster] = size
-            # record the total number of spikes before the first spike in the
-            # current cluster
-            self.cluster_sizes_cum[cluster] = counter
-            # create the spike permutation to regroup those in the same clusters
-            self.permutation.append(ids)
-            counter += size
-        self.permutation = np.hstack(self.permutation)
+        # permutation contains the spike indices in successive clusters:
+        # a stable sort on the relative cluster indices keeps the original
+        # spike order within each cluster
+        self.permutation = np.argsort(self.clusters_rel, kind='mergesort')
+        # array of cluster sizes as a function of the relative index
+        self.cluster_sizes = np.bincount(self.clusters_rel,
+                                         minlength=self.nclusters)
+        # total number of spikes before the first spike in each cluster,
+        # as a function of the relative index
+        self.cluster_sizes_cum = np.zeros(self.nclusters, dtype=np.int64)
+        self.cluster_sizes_cum[1:] = np.cumsum(self.cluster_sizes)[:-1]
+        # cluster sizes as a function of the absolute index
+        self.cluster_sizes_dict = dict(zip(self.clusters_unique,
+                                           self.cluster_sizes))
         return self.permutation
         
+    @profiled("organizer.reorder")
     def reorder(self, permutation=None):
         if permutation is None:
             permutation = self.get_reordering()
+        
+        # position of every spike in the reordered arrays
+        self.permutation = permutation
+        self.spike_positions = np.empty(self.nspikes, dtype=np.int64)
+        self.spike_positions[permutation] = np.arange(self.nspikes)
+        
         # reorder data
-        if self.ndim == 1:
+        if self.column_major:
+            self.data_reordered = self.reorder_columns()
+        elif self.ndim == 1:
             self.data_reordered = self.data[permutation]
         elif self.ndim == 2:
             self.data_reordered = self.data[permutation,:]
@@ -93,17 +236,352 @@ class SpikeDataOrganizer(object):
             
         # reorder masks
         self.masks = self.masks[permutation,:]
-        self.clusters = self.clusters[permutation,:]
-        self.clusters_rel = self.clusters_rel[permutation,:]
-        
-        # array of cluster sizes as a function of the relative index
-        self.cluster_sizes = np.array(map(operator.itemgetter(1),
-                                    sorted(self.cluster_sizes_dict.iteritems(),
-                                            key=operator.itemgetter(0))))
+        self.clusters = self.clusters[permutation]
+        self.clusters_rel = self.clusters_rel[permutation]
         
         return self.data_reordered
+        
+    def reorder_columns(self, chunk_size=100000):
+        """Return the reordered data as the transposed view of a column major
+        Nfeatures x Nspikes array.
+        
+        The data is read sequentially, chunk by chunk of contiguous spikes,
+        and each chunk is scattered to the positions of its spikes, so that
+        every page of a memmap or chunk of a HDF5 dataset is read once.
+        
+        """
+        nfeatures = self.data.shape[1]
+        if self.output is None:
+            columns = np.empty((nfeatures, self.nspikes), dtype=np.float32)
+        else:
+            columns = self.output
+        for start in xrange(0, self.nspikes, chunk_size):
+            end = min(start + chunk_size, self.nspikes)
+            columns[:,self.spike_positions[start:end]] = np.asarray(
+                self.data[start:end], dtype=np.float32).T
+        return columns.T
+        
+    def add_clusters(self, clusters, cluster_colors=None):
+        """Append new empty clusters after the existing ones.
+        
+        The new clusters get the next relative indices, whatever their
+        absolute indices: clusters_unique is then not sorted anymore, and the
+        relative index of a cluster must be found with get_clusters_rel
+        rather than with a binary search.
+        
+        """
+        n = len(clusters)
+        if cluster_colors is None:
+            cluster_colors = np.ones((n, 3))
+        self.clusters_unique = np.hstack((self.clusters_unique, clusters))
+        self.cluster_colors = np.vstack((self.cluster_colors,
+            enforce_dtype(cluster_colors, np.float32)))
+        self.cluster_sizes = np.hstack((self.cluster_sizes,
+            np.zeros(n, dtype=self.cluster_sizes.dtype)))
+        self.cluster_sizes_cum = np.hstack((self.cluster_sizes_cum,
+            np.repeat(self.nspikes, n)))
+        self.nclusters += n
+        
+    def get_clusters_rel(self, clusters):
+        """Return the relative indices of the given clusters (absolute
+        indices), which do not follow the order of the absolute indices
+        once new clusters have been appended."""
+        clusters_rel = np.zeros(self.clusters_unique.max() + 1, dtype=np.int64)
+        clusters_rel[self.clusters_unique] = np.arange(self.nclusters)
+        return clusters_rel[clusters]
+        
+    @profiled("organizer.reassign")
+    def reassign(self, spikes, clusters, cluster_colors=None):
+        """Move spikes to other clusters, and patch the reordered arrays in
+        place instead of reordering everything again.
+        
+        Only the positions which need to change are written: the cost is
+        proportional to the number of moved spikes and to the shifts of the
+        cluster boundaries, and not to the total number of spikes. Clusters
+        which become empty are kept with a size of zero, and new clusters are
+        appended after the existing ones.
+        
+        Arguments:
+          * spikes: an array with the (non reordered) indices of the spikes
+          * clusters: the new cluster of each spike (absolute index), or a
+            single cluster index for all spikes
+          * cluster_colors: the colors of the new clusters, if any
+          
+        Returns:
+          * changed: a sorted array with the positions, in the reordered
+            arrays, of all spikes which changed
+        
+        """
+        spikes = np.asarray(spikes, dtype=np.int64)
+        clusters = np.asarray(clusters, dtype=np.int32)
+        if clusters.ndim == 0:
+            clusters = np.repeat(clusters, len(spikes))
+        
+        # create the new clusters
+        targets, inverse = np.unique(clusters, return_inverse=True)
+        new_clusters = np.setdiff1d(targets, self.clusters_unique)
+        if len(new_clusters) > 0:
+            self.add_clusters(new_clusters, cluster_colors)
+        # relative index of the new cluster of every spike
+        new_rel = self.get_clusters_rel(targets)[inverse]
+        
+        # only keep the spikes which actually change cluster
+        positions = self.spike_positions[spikes]
+        old_rel = self.clusters_rel[positions]
+        keep = old_rel != new_rel
+        positions = positions[keep]
+        old_rel, new_rel = old_rel[keep], new_rel[keep]
+        if len(positions) == 0:
+            return np.array([], dtype=np.int64)
+        self.clusters_rel[positions] = new_rel
+        self.clusters[positions] = self.clusters_unique[new_rel]
+        
+        # new cluster sizes and offsets
+        sizes = (self.cluster_sizes +
+                 np.bincount(new_rel, minlength=self.nclusters) -
+                 np.bincount(old_rel, minlength=self.nclusters))
+        sizes_cum = np.zeros(self.nclusters, dtype=np.int64)
+        sizes_cum[1:] = np.cumsum(sizes)[:-1]
+        
+        # the only positions which may be misplaced are those of the moved
+        # spikes, and those between the old and the new start of each cluster
+        shifted = np.nonzero(sizes_cum != self.cluster_sizes_cum)[0]
+        shifted_positions = get_ranges_indices(
+            np.minimum(sizes_cum[shifted], self.cluster_sizes_cum[shifted]),
+            np.maximum(sizes_cum[shifted], self.cluster_sizes_cum[shifted]))
+        candidates = np.union1d(positions, shifted_positions)
+        # cluster of the spike at every candidate position, and cluster which
+        # owns this position in the new layout
+        occupant = self.clusters_rel[candidates]
+        owner = np.searchsorted(sizes_cum, candidates, side='right') - 1
+        misplaced = occupant != owner
+        candidates = candidates[misplaced]
+        # move the misplaced spikes to the misplaced slots, cluster by cluster
+        src = candidates[np.argsort(occupant[misplaced], kind='mergesort')]
+        dst = candidates[np.argsort(owner[misplaced], kind='mergesort')]
+        for arr in (self.data_reordered, self.masks, self.clusters,
+                    self.clusters_rel, self.permutation):
+            arr[dst,...] = arr[src,...]
+        self.spike_positions[self.permutation[dst]] = dst
+        
+        # update the cluster sizes in place
+        self.cluster_sizes[:] = sizes
+        self.cluster_sizes_cum[:] = sizes_cum
+        self.cluster_sizes_dict = dict(zip(self.clusters_unique,
+                                           self.cluster_sizes))
+        
+        return np.union1d(positions, dst)
 
 
+class GridIndex(object):
+    """Uniform grid over a set of 2D points, answering rectangle queries in a
+    time proportional to the number of points returned.
+    
+    The points are sorted by cell, the cells being numbered row by row, so
+    that the points of consecutive cells in a row are contiguous. A query
+    only tests the points of the rows of cells overlapping the rectangle.
+    When some points move, they are removed from their cells and inserted in
+    their new cells, without sorting all points again.
+    
+    """
+    def __init__(self, points, active=None, points_per_cell=16,
+                 ngrid_max=2048):
+        """
+        Arguments:
+          * points: a N x 2 array
+          * active: a N boolean array, only the active points are indexed
+            and returned by queries. By default, all points.
+          * points_per_cell: the average number of points per cell
+          * ngrid_max: the maximum number of cells in each dimension
+        """
+        self.points = points
+        self.points_per_cell = points_per_cell
+        self.ngrid_max = ngrid_max
+        if active is None:
+            self.build(np.arange(len(points)))
+        else:
+            self.build(np.nonzero(active)[0])
+        
+    @profiled("grid_index.build")
+    def build(self, indices):
+        """Index the given points."""
+        points = self.points
+        n = len(indices)
+        self.ngrid = int(np.clip(np.sqrt(n / float(self.points_per_cell)),
+                                 1, self.ngrid_max))
+        if n > 0:
+            x, y = points[indices,0], points[indices,1]
+            self.bounds = (x.min(), y.min(), x.max(), y.max())
+        else:
+            self.bounds = (0., 0., 1., 1.)
+        cells = self.get_cells(points[indices,:])
+        # indexed points sorted by cell (in any order within a cell, as the
+        # query results are sorted), and offset of every cell
+        order = np.argsort(cells)
+        self.indices = indices[order]
+        self.cell_starts = np.zeros(self.ngrid ** 2 + 1, dtype=np.int64)
+        self.cell_starts[1:] = np.cumsum(np.bincount(cells,
+            minlength=self.ngrid ** 2))
+        
+    @property
+    def nbytes(self):
+        """Size of the index in bytes, the points excepted."""
+        return self.indices.nbytes + self.cell_starts.nbytes
+        
+    @profiled("grid_index.update")
+    def update(self, positions, active):
+        """Update the index after the coordinates of some points changed.
+        
+        Arguments:
+          * positions: the indices of the points which changed
+          * active: a boolean array telling whether each of these points is
+            indexed
+        
+        The grid is only built again if a point is now outside the bounds.
+        
+        """
+        positions = np.asarray(positions, dtype=np.int64)
+        added = positions[np.asarray(active, dtype=np.bool_)]
+        points = self.points[added,:]
+        removed = np.zeros(len(self.points), dtype=np.bool_)
+        removed[positions] = True
+        removed = removed[self.indices]
+        x0, y0, x1, y1 = self.bounds
+        if len(added) > 0 and (points[:,0].min() < x0 or
+                points[:,0].max() > x1 or points[:,1].min() < y0 or
+                points[:,1].max() > y1):
+            self.build(np.hstack((self.indices[~removed], added)))
+            return
+        ncells = self.ngrid ** 2
+        # remove the points from their current cells
+        removed_cells = np.searchsorted(self.cell_starts,
+            np.nonzero(removed)[0], side='right') - 1
+        counts = (np.diff(self.cell_starts) -
+                  np.bincount(removed_cells, minlength=ncells))
+        indices = self.indices[~removed]
+        cell_starts = np.zeros(ncells + 1, dtype=np.int64)
+        cell_starts[1:] = np.cumsum(counts)
+        # insert them at the end of their new cells
+        cells = self.get_cells(points)
+        order = np.argsort(cells, kind='mergesort')
+        cells = cells[order]
+        self.indices = np.insert(indices, cell_starts[cells + 1],
+                                 added[order])
+        self.cell_starts[1:] = np.cumsum(counts +
+            np.bincount(cells, minlength=ncells))
+        
+    def get_cell_coordinates(self, x, y):
+        """Return the column and row of the cells containing the given
+        coordinates, clipped to the grid."""
+        x0, y0, x1, y1 = self.bounds
+        ix = np.floor((x - x0) * self.ngrid / max(x1 - x0, 1e-12))
+        iy = np.floor((y - y0) * self.ngrid / max(y1 - y0, 1e-12))
+        return (np.clip(ix, 0, self.ngrid - 1).astype(np.int64),
+                np.clip(iy, 0, self.ngrid - 1).astype(np.int64))
+        
+    def get_cells(self, points):
+        ix, iy = self.get_cell_coordinates(points[:,0], points[:,1])
+        return (iy * self.ngrid + ix).astype(np.int32)
+        
+    def query(self, box):
+        """Return the sorted indices of the active points inside the
+        rectangle (xmin, ymin, xmax, ymax)."""
+        xmin, ymin, xmax, ymax = box
+        x0, y0, x1, y1 = self.bounds
+        if len(self.indices) == 0 or xmax < x0 or xmin > x1 or \
+                ymax < y0 or ymin > y1:
+            return np.array([], dtype=np.int64)
+        ix0, iy0 = self.get_cell_coordinates(xmin, ymin)
+        ix1, iy1 = self.get_cell_coordinates(xmax, ymax)
+        # one contiguous range of indexed points for each row of cells
+        rows = np.arange(iy0, iy1 + 1) * self.ngrid
+        candidates = self.indices[get_ranges_indices(
+            self.cell_starts[rows + ix0], self.cell_starts[rows + ix1 + 1])]
+        points = self.points[candidates,:]
+        inside = ((points[:,0] >= xmin) & (points[:,0] <= xmax) &
+                  (points[:,1] >= ymin) & (points[:,1] <= ymax))
+        return np.sort(candidates[inside])
+        
+    def get_edge_cells(self, polygon, ix0, iy0, ix1, iy1):
+        """Return a boolean (iy1 - iy0 + 1) x (ix1 - ix0 + 1) array with the
+        cells of the given block which may be crossed by an edge of the
+        polygon (a superset of them), or None if the edges are too long
+        compared to the cells."""
+        x0, y0, x1, y1 = self.bounds
+        w = max(x1 - x0, 1e-12) / self.ngrid
+        h = max(y1 - y0, 1e-12) / self.ngrid
+        start = polygon
+        end = np.roll(polygon, -1, axis=0)
+        # sample every edge with steps smaller than a cell
+        steps = np.ceil(np.maximum(np.abs(end[:,0] - start[:,0]) / w,
+                                   np.abs(end[:,1] - start[:,1]) / h))
+        steps = np.maximum(steps, 1).astype(np.int64)
+        shape = (iy1 - iy0 + 1, ix1 - ix0 + 1)
+        if steps.sum() > 16 * shape[0] * shape[1] + 1024:
+            return None
+        edges = np.repeat(np.arange(len(polygon)), steps + 1)
+        t = (get_ranges_indices(np.zeros(len(steps)), steps + 1) /
+             np.repeat(steps, steps + 1).astype(np.float64))
+        samples = (start[edges] +
+                   (end[edges] - start[edges]) * t.reshape((-1, 1)))
+        ix, iy = self.get_cell_coordinates(samples[:,0], samples[:,1])
+        # two successive samples of an edge are closer than a cell: the part
+        # of the edge between them is in the cells of their bounding box
+        same = edges[1:] == edges[:-1]
+        a, b = np.nonzero(same)[0], np.nonzero(same)[0] + 1
+        cells = np.zeros(shape, dtype=np.bool_)
+        for cx, cy in ((ix[a], iy[a]), (ix[b], iy[b]),
+                       (ix[a], iy[b]), (ix[b], iy[a])):
+            keep = ((cx >= ix0) & (cx <= ix1) & (cy >= iy0) & (cy <= iy1))
+            cells[cy[keep] - iy0, cx[keep] - ix0] = True
+        return cells
+        
+    def query_polygon(self, polygon):
+        """Return the sorted indices of the active points inside the polygon
+        (a K x 2 array with the vertices).
+        
+        The cells of the bounding box of the polygon which are not crossed by
+        any edge are entirely inside or outside the polygon: only their
+        center is tested. Only the points of the cells crossed by an edge are
+        tested individually.
+        
+        """
+        polygon = np.asarray(polygon, dtype=np.float64)
+        if len(polygon) < 3 or len(self.indices) == 0:
+            return np.array([], dtype=np.int64)
+        xmin, ymin = polygon.min(axis=0)
+        xmax, ymax = polygon.max(axis=0)
+        x0, y0, x1, y1 = self.bounds
+        if xmax < x0 or xmin > x1 or ymax < y0 or ymin > y1:
+            return np.array([], dtype=np.int64)
+        ix0, iy0 = self.get_cell_coordinates(xmin, ymin)
+        ix1, iy1 = self.get_cell_coordinates(xmax, ymax)
+        
+        # cells of the bounding box
+        iy, ix = np.mgrid[iy0:iy1 + 1, ix0:ix1 + 1]
+        edge_cells = self.get_edge_cells(polygon, ix0, iy0, ix1, iy1)
+        if edge_cells is None:
+            edge_cells = np.ones(ix.shape, dtype=np.bool_)
+        # cells entirely inside the polygon
+        w = max(x1 - x0, 1e-12) / self.ngrid
+        h = max(y1 - y0, 1e-12) / self.ngrid
+        centers = np.empty((ix.size, 2))
+        centers[:,0] = x0 + (ix.ravel() + .5) * w
+        centers[:,1] = y0 + (iy.ravel() + .5) * h
+        inner_cells = (~edge_cells.ravel() &
+                       points_in_polygon(centers, polygon))
+        cells = (iy * self.ngrid + ix).ravel()
+        
+        inner = self.indices[get_ranges_indices(
+            self.cell_starts[cells[inner_cells]],
+            self.cell_starts[cells[inner_cells] + 1])]
+        edge_cells = cells[edge_cells.ravel()]
+        candidates = self.indices[get_ranges_indices(
+            self.cell_starts[edge_cells], self.cell_starts[edge_cells + 1])]
+        inside = points_in_polygon(self.points[candidates,:], polygon)
+        return np.sort(np.hstack((inner, candidates[inside])))
+        
+        
 class HighlightManager(object):
     
     highlight_rectangle_color = (0.75, 0.75, 1., .25)
@@ -1,11 +1,15 @@
 import numpy as np
 import numpy.random as rdn
 import collections
+import logging
 import operator
+import threading
 import time
+import Queue
 
 from galry import *
 from common import *
+from profiling import profiled
 
 # import colors
 # from probes import Probe
@@ -32,13 +36,223 @@ FRAGMENT_SHADER = """
     out_color = varying_color;
 """
 
+# maximum number of vertices of the lasso, in the GPU buffer
+LASSO_MAX_VERTICES = 1000
+
+# maximum size in bytes of the projections kept in memory, the current one
+# being always kept (about 230 MB for 10 million spikes)
+PROJECTION_CACHE_BYTES = 512 * 1024 ** 2
+
+# number of points above which their density is shown instead of the points
+DENSITY_THRESHOLD = 1000000
+
+# number of bins of the density texture along each axis
+DENSITY_BINS = 256
+
+# minimum number of bins of the density texture in the view along each axis,
+# below which the points are binned again
+DENSITY_MIN_BINS = 128
+
+# margin binned around the view, as a fraction of its size on each side, so
+# that the density texture is reused when panning
+DENSITY_MARGIN = .25
+
+# maximum number of spikes used to rank the projections
+RANKING_MAX_SPIKES = 100000
+
+# number of best projections kept in the ranking
+RANKING_SIZE = 100
+
+
+def get_separation_scores(columns, clusters_rel, positions=None,
+                          chunk_size=16):
+    """Return a separation score of the clusters for every pair of features,
+    computed for all pairs at once.
+    
+    The score of a feature is its Fisher ratio: the variance of the cluster
+    means, divided by the mean variance within the clusters. The score of a
+    pair is the sum of the scores of both features, multiplied by 1 - r^2
+    where r is the covariance of the two features across the cluster means,
+    normalized by their total variances (between and within the clusters),
+    so that two redundant features do not make a good projection. With the
+    total variances, a feature which does not separate the clusters is not
+    correlated with the others, even though the cluster means of all
+    features are perfectly correlated when there are two clusters.
+    
+    Arguments:
+      * columns: a Nfeatures x Nspikes array, the spikes being sorted by
+        cluster
+      * clusters_rel: the relative cluster index of every spike
+      * positions=None: the sorted indices of the spikes to use, by default
+        all spikes
+    
+    Returns:
+      * scores: a Nfeatures x Nfeatures symmetric array, with a null diagonal
+    
+    """
+    if positions is not None:
+        clusters_rel = clusters_rel[positions]
+    sizes = np.bincount(clusters_rel)
+    sizes = sizes[sizes > 0].astype(np.float64)
+    starts = np.hstack(([0], np.cumsum(sizes)[:-1])).astype(np.int64)
+    nfeatures = columns.shape[0]
+    nspikes = sizes.sum()
+    
+    # cluster means and within-cluster variance of every feature, a few
+    # features at a time
+    means = np.empty((nfeatures, len(sizes)))
+    within = np.empty(nfeatures)
+    for start in xrange(0, nfeatures, chunk_size):
+        end = min(start + chunk_size, nfeatures)
+        if positions is None:
+            block = np.asarray(columns[start:end], dtype=np.float64)
+        else:
+            block = np.asarray(columns[start:end,positions], dtype=np.float64)
+        sums = np.add.reduceat(block, starts, axis=1)
+        means[start:end] = sums / sizes
+        within[start:end] = ((block ** 2).sum(axis=1) -
+                             (sums * means[start:end]).sum(axis=1))
+    within /= nspikes
+    
+    # covariance of the cluster means, weighted by the cluster sizes
+    centered = means - (np.dot(means, sizes) / nspikes)[:,np.newaxis]
+    between = np.dot(centered * sizes, centered.T) / nspikes
+    variance = np.diag(between)
+    fisher = variance / np.maximum(within, 1e-12)
+    total = variance + within
+    correlation = between / np.sqrt(np.maximum(np.outer(total, total),
+                                               1e-24))
+    scores = (fisher[:,np.newaxis] + fisher) * (1 - correlation ** 2)
+    np.fill_diagonal(scores, 0)
+    return scores
+
+
+class ProjectionCache(object):
+    """Least recently used cache of the projections of the features, with a
+    background thread computing projections in advance.
+    
+    The values are computed by a function of the key. The results of the
+    computations started before the last call to clear() are discarded. The
+    least recently used values are dropped when the total size of the values
+    exceeds max_bytes, the size of a value being the sum of the nbytes of its
+    items.
+    
+    """
+    def __init__(self, compute, max_bytes=PROJECTION_CACHE_BYTES):
+        self.compute = compute
+        self.max_bytes = max_bytes
+        self.values = collections.OrderedDict()
+        self.nbytes = 0
+        # events of the keys being computed in the background thread
+        self.pending = {}
+        self.version = 0
+        self.lock = threading.Lock()
+        self.queue = Queue.Queue()
+        self.thread = None
+        
+    def get_nbytes(self, value):
+        return sum(getattr(item, 'nbytes', 0) for item in value)
+        
+    def add(self, key, value):
+        """Add a value, the lock being acquired, and drop the least recently
+        used values while the cache is too large."""
+        if key in self.values:
+            self.nbytes -= self.get_nbytes(self.values.pop(key))
+        self.values[key] = value
+        self.nbytes += self.get_nbytes(value)
+        while len(self.values) > 1 and self.nbytes > self.max_bytes:
+            self.nbytes -= self.get_nbytes(self.values.popitem(last=False)[1])
+        
+    def put(self, key, value):
+        with self.lock:
+            self.add(key, value)
+        
+    def get(self, key):
+        """Return the value of a key, from the cache, from the background
+        thread if it is being computed, or computed now."""
+        with self.lock:
+            if key in self.values:
+                value = self.values.pop(key)
+                self.values[key] = value
+                return value
+            event = self.pending.get(key, None)
+        if event is not None:
+            event.wait()
+            with self.lock:
+                if key in self.values:
+                    return self.values[key]
+        value = self.compute(key)
+        self.put(key, value)
+        return value
+        
+    def prefetch(self, keys):
+        """Compute the values of some keys in the background thread."""
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run)
+            self.thread.daemon = True
+            self.thread.start()
+        for key in keys:
+            self.queue.put(key)
+        
+    def run(self):
+        while True:
+            key = self.queue.get()
+            if key is None:
+                return
+            with self.lock:
+                if key in self.values or key in self.pending:
+                    continue
+                event = self.pending[key] = threading.Event()
+                version = self.version
+            try:
+                value = self.compute(key)
+            except Exception:
+                # the thread keeps serving the other keys: this one is
+                # computed again, with the error raised, if it is requested
+                logging.exception("The projection %r could not be computed "
+                                  "in the background." % (key,))
+            else:
+                with self.lock:
+                    if version == self.version:
+                        self.add(key, value)
+            finally:
+                with self.lock:
+                    del self.pending[key]
+                event.set()
+        
+    def clear(self):
+        with self.lock:
+            self.values.clear()
+            self.nbytes = 0
+            self.version += 1
+        
+    def close(self):
+        """Stop the background thread."""
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread = None
+
 
 class FeatureDataManager(object):
     # Initialization methods
     # ----------------------
+    @profiled("feature.set_data")
     def set_data(self, features, fetdim=None, clusters=None, cluster_colors=None,
-                 masks=None, spike_ids=None):
-        
+                 masks=None, spike_ids=None, features_columns=None,
+                 density=None, hide_masked=False):
+        """
+        Arguments:
+          * features: a Nspikes x Nfeatures array, possibly a memmap
+          * features_columns: an optional preallocated Nfeatures x Nspikes
+            float32 array (e.g. a writable memmap) receiving the reordered
+            features column by column, so that they are never entirely
+            loaded in memory
+          * density: whether to show the density of the points in a texture
+            instead of the points. By default, the density is shown above
+            DENSITY_THRESHOLD points.
+          * hide_masked: whether to upload and draw only the spikes which are
+            not masked on the channels of the current projection
+        """
         assert fetdim is not None
         
         self.nspikes, self.ndim = features.shape
@@ -46,16 +260,55 @@ class FeatureDataManager(object):
         self.nchannels = (self.ndim - 1) // self.fetdim
         self.npoints = features.shape[0]
         self.features = features
+        if density is None:
+            density = self.npoints > DENSITY_THRESHOLD
+        self.density = density
+        self.hide_masked = hide_masked
         
-        # data organizer: reorder data according to clusters
+        # data organizer: reorder data according to clusters, in a column
+        # major layout so that the features of a projection are contiguous
         self.data_organizer = SpikeDataOrganizer(features,
                                                 clusters=clusters,
                                                 cluster_colors=cluster_colors,
                                                 masks=masks,
                                                 nchannels=self.nchannels,
-                                                spike_ids=spike_ids)
+                                                spike_ids=spike_ids,
+                                                column_major=True,
+                                                output=features_columns)
         
         # get reordered data
+        self.get_organized_data()
+        
+        # self.full_clusters = self.clusters
+        
+        # bounds of every feature, which define the normalization of all
+        # projections
+        self.features_min = self.features_reordered.min(axis=0).astype(
+            np.float64)
+        self.features_max = self.features_reordered.max(axis=0).astype(
+            np.float64)
+        
+        # copy each color as many times as there are spikes in each cluster,
+        # the transparency depends on the projection
+        self.colors = np.empty((self.nspikes, 4), dtype=np.float32)
+        self.colors[:,:3] = np.repeat(self.cluster_colors, self.cluster_sizes,
+                                      axis=0)
+        
+        # ranking of the projections, computed on demand
+        self.best_projections = None
+        
+        # the projections already computed
+        if getattr(self, 'projection_cache', None) is not None:
+            self.projection_cache.close()
+        self.projection_cache = ProjectionCache(self.compute_projection)
+        
+        # prepare GPU data
+        self.set_projection()
+        
+        # update the highlight manager
+        self.highlight_manager.initialize()
+        
+    def get_organized_data(self):
         self.permutation = self.data_organizer.permutation
         self.features_reordered = self.data_organizer.data_reordered
         self.nclusters = self.data_organizer.nclusters
@@ -68,44 +321,191 @@ class FeatureDataManager(object):
         self.cluster_sizes_cum = self.data_organizer.cluster_sizes_cum
         self.cluster_sizes_dict = self.data_organizer.cluster_sizes_dict
         
-        # self.full_clusters = self.clusters
-        
-        # prepare GPU data
-        self.set_projection()
-        
-        # update the highlight manager
-        self.highlight_manager.initialize()
+    @profiled("feature.reassign_spikes")
+    def reassign_spikes(self, spikes, clusters, cluster_colors=None):
+        """Move spikes to other clusters, and patch the projected data in
+        place. Return the positions of the changed spikes in the reordered
+        arrays."""
+        changed = self.data_organizer.reassign(spikes, clusters,
+                                               cluster_colors=cluster_colors)
+        self.get_organized_data()
+        self.update_projection(changed)
+        self.best_projections = None
+        return changed
 
+    @profiled("feature.set_projection")
     def set_projection(self, channel0=0, channel1=0, coord0=0, coord1=1):
+        self.projection = (channel0, channel1, coord0, coord1)
+        (self.normalized_data, self.full_masks, self.data_normalizer,
+            self.grid_index) = self.projection_cache.get(self.projection)
+        # add transparency: the max of transparency between channel0 and 1
+        self.colors[:,3] = self.full_masks
+        self.update_visible()
+        
+    @profiled("feature.rank_projections")
+    def rank_projections(self):
+        """Return the projections sorted by decreasing separation of the
+        clusters, on a subset of the spikes for large datasets."""
+        # the last feature is the time, which is not projected
+        nfeatures = self.nchannels * self.fetdim
+        columns = self.features_reordered.T[:nfeatures]
+        positions = None
+        if self.nspikes > RANKING_MAX_SPIKES:
+            # regularly spaced spikes, which keep the proportions of the
+            # clusters and remain sorted
+            positions = np.linspace(0, self.nspikes - 1,
+                                    RANKING_MAX_SPIKES).astype(np.int64)
+        scores = get_separation_scores(columns, self.clusters_rel, positions)
+        i0, i1 = np.triu_indices(nfeatures, 1)
+        pairs = scores[i0, i1]
+        best = np.argsort(-pairs, kind='mergesort')[:RANKING_SIZE]
+        i0, i1 = i0[best], i1[best]
+        return zip(i0 // self.fetdim, i1 // self.fetdim,
+                   i0 % self.fetdim, i1 % self.fetdim)
+        
+    def get_best_projections(self):
+        """Return the projections sorted by decreasing separation of the
+        clusters, ranked once until the data changes."""
+        if self.best_projections is None:
+            self.best_projections = self.rank_projections()
+        return self.best_projections
+        
+    def prefetch_projections(self, projections):
+        """Compute some projections in advance, in a background thread."""
+        self.projection_cache.prefetch(projections)
+        
+    @profiled("feature.compute_projection")
+    def compute_projection(self, projection):
+        """Return the normalized coordinates, the masks, the normalizer and
+        the spatial index of the spikes in a projection."""
+        channel0, channel1, coord0, coord1 = projection
         
         # in GPU memory, X coordinates are always between -1 and 1
         i0 = channel0 * self.fetdim + coord0
         i1 = channel1 * self.fetdim + coord1
         
-        # copy each color as many times as there are spikes in each cluster
-        self.colors = np.empty((self.nspikes, 4), dtype=np.float32)
-        colors = np.repeat(self.cluster_colors, self.cluster_sizes, axis=0)
-        self.colors[:,:3] = colors
-        # add transparency: the max of transparency between channel0 and 1
-        self.full_masks = np.max(self.masks[:,np.array([channel0, channel1])], 1)
-        self.colors[:,3] = self.full_masks
+        # the normalizer only depends on the bounds of the two features
+        data_normalizer = DataNormalizer(np.array(
+            [[self.features_min[i0], self.features_min[i1]],
+             [self.features_max[i0], self.features_max[i1]]]))
+        data_normalizer.normalize()
+        normalized_data = np.empty((self.nspikes, 2), dtype=np.float32)
+        normalized_data[:,0] = data_normalizer.normalize_x(
+            self.features_reordered[:,i0])
+        normalized_data[:,1] = data_normalizer.normalize_y(
+            self.features_reordered[:,i1])
+        
+        # the max of transparency between channel0 and 1
+        full_masks = np.max(self.masks[:,np.array([channel0, channel1])], 1)
         
-        # feature data
-        X = self.features_reordered[:,i0]
-        Y = self.features_reordered[:,i1]
+        # spatial index of the unmasked points, for the selection
+        grid_index = GridIndex(normalized_data, active=full_masks > 0)
+        return normalized_data, full_masks, data_normalizer, grid_index
         
-        # create a Nx2 array with all coordinates
-        self.data = np.empty((X.size, 2), dtype=np.float32)
-        self.data[:,0] = X.ravel()
-        self.data[:,1] = Y.ravel()
+    @profiled("feature.get_density")
+    def get_density(self, box=(-1., -1., 1., 1.), highlighted=None):
+        """Return the density of the unmasked points of the current
+        projection in a rectangle (xmin, ymin, xmax, ymax), as a RGB texture
+        with DENSITY_BINS x DENSITY_BINS bins, the first row being at the top.
         
-        # initialize the normalizer
-        self.data_normalizer = DataNormalizer(self.data)
-        self.normalized_data = self.data_normalizer.normalize()
+        The color of a bin is the mean color of its points, which is the sum
+        of the 2D histograms of the clusters weighted by their colors, and
+        its brightness increases with the logarithm of the number of points.
+        The bins containing highlighted spikes are white. Only the points in
+        the rectangle are binned, so that zooming in is cheaper.
+        
+        """
+        xmin, ymin, xmax, ymax = box
+        nbins = DENSITY_BINS
+        x0, y0, x1, y1 = self.grid_index.bounds
+        if xmin <= x0 and ymin <= y0 and xmax >= x1 and ymax >= y1:
+            # all points are visible, the masked ones having a null weight
+            positions = slice(None)
+        else:
+            positions = self.grid_index.query(box)
+        
+        def get_bins(points):
+            ix = ((points[:,0] - xmin) * (nbins / (xmax - xmin))).astype(
+                np.int64)
+            iy = ((ymax - points[:,1]) * (nbins / (ymax - ymin))).astype(
+                np.int64)
+            return (np.clip(iy, 0, nbins - 1) * nbins +
+                    np.clip(ix, 0, nbins - 1))
+        
+        # histogram of the points, and of their colors, weighted by the masks
+        bins = get_bins(self.normalized_data[positions])
+        weights = self.full_masks[positions]
+        counts = np.bincount(bins, weights=weights, minlength=nbins * nbins)
+        texture = np.empty((nbins * nbins, 3), dtype=np.float32)
+        for i in xrange(3):
+            texture[:,i] = np.bincount(bins,
+                weights=weights * self.colors[positions,i],
+                minlength=nbins * nbins)
+        brightness = np.log1p(counts) / np.log1p(max(counts.max(), 1.))
+        texture *= (brightness / np.maximum(counts, 1e-6))[:,np.newaxis]
+        
+        if highlighted is not None and len(highlighted) > 0:
+            points = self.normalized_data[highlighted]
+            inside = ((self.full_masks[highlighted] > 0) &
+                      (points[:,0] >= xmin) & (points[:,0] <= xmax) &
+                      (points[:,1] >= ymin) & (points[:,1] <= ymax))
+            texture[get_bins(points[inside])] = 1
+        return texture.reshape((nbins, nbins, 3))
+        
+    def update_visible(self):
+        """Compute the positions, in the reordered arrays, of the spikes
+        uploaded on the GPU, which are the unmasked spikes when the masked
+        ones are hidden. The i-th uploaded point is the spike at position
+        visible_positions[i], and visible_positions is None when all spikes
+        are uploaded."""
+        if self.hide_masked:
+            self.visible_positions = np.nonzero(self.full_masks > 0)[0]
+            self.nvisible = len(self.visible_positions)
+        else:
+            self.visible_positions = None
+            self.nvisible = self.npoints
+            
+    def set_hide_masked(self, hide_masked):
+        self.hide_masked = hide_masked
+        self.update_visible()
+        
+    def get_visible(self, arr):
+        """Return the values of a per-spike array for the uploaded spikes."""
+        if self.visible_positions is None:
+            return arr
+        return arr[self.visible_positions]
+        
+    @profiled("feature.update_projection")
+    def update_projection(self, positions):
+        """Update the projected data of some spikes only, given their
+        positions in the reordered arrays."""
+        channel0, channel1, coord0, coord1 = self.projection
+        i0 = channel0 * self.fetdim + coord0
+        i1 = channel1 * self.fetdim + coord1
+        
+        self.colors[positions,:3] = self.cluster_colors[
+            self.clusters_rel[positions]]
+        self.full_masks[positions] = np.max(
+            self.masks[positions][:,np.array([channel0, channel1])], 1)
+        self.colors[positions,3] = self.full_masks[positions]
+        self.update_visible()
+        
+        # the normalization does not change, as the set of points is the same
+        self.normalized_data[positions,0] = self.data_normalizer.normalize_x(
+            self.features_reordered[positions,i0])
+        self.normalized_data[positions,1] = self.data_normalizer.normalize_y(
+            self.features_reordered[positions,i1])
+        self.grid_index.update(positions, self.full_masks[positions] > 0)
+        
+        # the other projections are out of date
+        self.projection_cache.clear()
+        self.projection_cache.put(self.projection, (self.normalized_data,
+            self.full_masks, self.data_normalizer, self.grid_index))
         
         
 class FeatureTemplate(DefaultTemplate):
-    def initialize(self, npoints=None, nclusters=None, **kwargs):
+    def initialize(self, npoints=None, nclusters=None, cluster_capacity=None,
+                   **kwargs):
         self.primitive_type =PrimitiveType.Points
         self.size = npoints
         self.npoints = npoints
@@ -116,8 +516,11 @@ class FeatureTemplate(DefaultTemplate):
         self.add_attribute("cluster", vartype="int", ndim=1)
         self.add_attribute("highlight", vartype="int", ndim=1)
         
+        # room for new clusters, see get_cluster_capacity
+        if cluster_capacity is None:
+            cluster_capacity = nclusters
         self.add_uniform("cluster_colors", vartype="float", ndim=3,
-            size=self.nclusters)
+            size=cluster_capacity)
         
         self.add_varying("varying_color", vartype="float", ndim=4)
         
@@ -128,65 +531,214 @@ class FeatureTemplate(DefaultTemplate):
         
         
 class FeaturePaintManager(PaintManager):
+    @profiled("feature.upload")
     def initialize(self):
+        if self.data_manager.density:
+            self.initialize_density()
+            return
+        self.cluster_capacity = get_cluster_capacity(
+            self.data_manager.nclusters)
         self.ds = self.create_dataset(FeatureTemplate,
             npoints=self.data_manager.npoints,
             nclusters=self.data_manager.nclusters,
+            cluster_capacity=self.cluster_capacity,
             position0=self.data_manager.normalized_data,
             mask=self.data_manager.full_masks,
             cluster=self.data_manager.clusters_rel,
             highlight=self.highlight_manager.highlight_mask,
-            cluster_colors=self.data_manager.cluster_colors)
+            cluster_colors=self.get_cluster_colors())
+        if self.data_manager.hide_masked:
+            self.upload_visible()
+        
+    def initialize_density(self):
+        """Show the density of the points in a texture, instead of the points
+        themselves."""
+        self.ds = None
+        self.density_box = (-1., -1., 1., 1.)
+        self.ds_density = self.create_dataset(TextureTemplate,
+            texture=self.data_manager.get_density(self.density_box),
+            points=self.density_box)
         
+    def density_covers(self, box):
+        """Return whether the current density texture covers a view with at
+        least DENSITY_MIN_BINS bins along each axis, in which case it is
+        reused rather than computed again."""
+        xmin, ymin, xmax, ymax = self.density_box
+        return (box[0] >= xmin and box[1] >= ymin and
+                box[2] <= xmax and box[3] <= ymax and
+                (box[2] - box[0]) * DENSITY_BINS >=
+                    DENSITY_MIN_BINS * (xmax - xmin) and
+                (box[3] - box[1]) * DENSITY_BINS >=
+                    DENSITY_MIN_BINS * (ymax - ymin))
+        
+    @profiled("feature.update_density")
+    def update_density(self, force=False):
+        """Bin the points visible in the current view, with a margin, in
+        the density mode. The texture is only computed again if the view is
+        not covered by it anymore or if zooming in made its bins too coarse,
+        unless force is True."""
+        if not self.data_manager.density:
+            return
+        im = self.interaction_manager
+        x0, y0 = im.get_data_coordinates(-1, -1)
+        x1, y1 = im.get_data_coordinates(1, 1)
+        # all points are between -1 and 1
+        box = (max(min(x0, x1), -1.), max(min(y0, y1), -1.),
+               min(max(x0, x1), 1.), min(max(y0, y1), 1.))
+        if box[0] >= box[2] or box[1] >= box[3]:
+            return
+        if not force and self.density_covers(box):
+            return
+        dx = DENSITY_MARGIN * (box[2] - box[0])
+        dy = DENSITY_MARGIN * (box[3] - box[1])
+        box = (max(box[0] - dx, -1.), max(box[1] - dy, -1.),
+               min(box[2] + dx, 1.), min(box[3] + dy, 1.))
+        self.density_box = box
+        self.set_data(texture=self.data_manager.get_density(box,
+                highlighted=self.highlight_manager.highlighted_spikes),
+            points=box, dataset=self.ds_density)
+        
+    @profiled("feature.update_points")
     def update_points(self):
-        self.set_data(position0=self.data_manager.normalized_data,
-            mask=self.data_manager.full_masks, dataset=self.ds)
+        dm = self.data_manager
+        if dm.density:
+            self.update_density(force=True)
+            return
+        if dm.hide_masked:
+            # the set of uploaded spikes depends on the projection
+            self.upload_visible()
+        else:
+            self.set_data(position0=dm.normalized_data, mask=dm.full_masks,
+                size=dm.npoints, dataset=self.ds)
+            
+    def upload_visible(self):
+        """Upload all the data of the spikes which are displayed, at the
+        beginning of the buffers, and only draw them."""
+        dm = self.data_manager
+        hm = self.highlight_manager
+        hm.visible_highlight_mask = dm.get_visible(hm.highlight_mask)
+        self.set_data(dataset=self.ds, onset=0, size=dm.nvisible,
+            position0=dm.get_visible(dm.normalized_data),
+            mask=dm.get_visible(dm.full_masks),
+            cluster=dm.get_visible(dm.clusters_rel),
+            highlight=hm.visible_highlight_mask)
+        
+    def toggle_masked_points(self):
+        """Show or hide the spikes which are masked on the channels of the
+        current projection."""
+        dm = self.data_manager
+        dm.set_hide_masked(not dm.hide_masked)
+        if not dm.density:
+            self.upload_visible()
+        
+    @profiled("feature.update_spikes")
+    def update_spikes(self, positions, update_colors=False):
+        """Upload the data of some spikes only, given their positions in the
+        reordered arrays."""
+        if self.data_manager.density:
+            self.update_density(force=True)
+            return
+        if self.data_manager.nclusters > self.cluster_capacity:
+            # the cluster colors do not fit in the dataset anymore: create it
+            # again, which happens each time the number of clusters doubles
+            delete_dataset(self, self.ds)
+            self.initialize()
+            return
+        if self.data_manager.hide_masked:
+            # the uploaded spikes are shifted in the buffers
+            self.upload_visible()
+        else:
+            upload_ranges(self, self.ds, get_ranges(positions),
+                position0=self.data_manager.normalized_data,
+                mask=self.data_manager.full_masks,
+                cluster=self.data_manager.clusters_rel)
+        if update_colors:
+            self.set_data(cluster_colors=self.get_cluster_colors(),
+                dataset=self.ds)
+            
+    def get_cluster_colors(self):
+        return pad_cluster_colors(self.data_manager.cluster_colors,
+                                  self.cluster_capacity)
         
         
 class FeatureHighlightManager(HighlightManager):
     def initialize(self):
         super(FeatureHighlightManager, self).initialize()
         self.highlight_mask = np.zeros(self.data_manager.nspikes, dtype=np.int32)
-        self.highlighted_spikes = []
+        # highlight mask of the uploaded spikes when the masked ones are
+        # hidden, in the order of the buffers
+        self.visible_highlight_mask = None
+        self.highlighted_spikes = np.array([], dtype=np.int64)
+        # lasso: vertices in window relative coordinates, and the spikes
+        # selected by the last lasso
+        self.lasso_vertices = []
+        self.selected_spikes = np.array([], dtype=np.int64)
+        self.paint_manager.ds_lasso = self.paint_manager.create_dataset(
+            PlotTemplate,
+            position=np.zeros((LASSO_MAX_VERTICES, 2), dtype=np.float32),
+            primitive_type=PrimitiveType.LineStrip,
+            color=self.highlight_rectangle_color,
+            is_static=True,
+            visible=False)
         
+    @profiled("feature.find_enclosed_spikes")
     def find_enclosed_spikes(self, enclosing_box):
         x0, y0, x1, y1 = enclosing_box
         
-        # press_position
-        xp, yp = x0, y0
-
         # reorder
         xmin, xmax = min(x0, x1), max(x0, x1)
         ymin, ymax = min(y0, y1), max(y0, y1)
 
-        features = self.data_manager.normalized_data
-        masks = self.data_manager.full_masks
-
-        indices = ((masks > 0) & \
-                  (features[:,0] >= xmin) & (features[:,0] <= xmax) & \
-                  (features[:,1] >= ymin) & (features[:,1] <= ymax))
-        # absolute indices in the data
-        spkindices = np.nonzero(indices)[0]
-        spkindices = np.unique(spkindices)
-        return spkindices
+        # unmasked points in the box, from the spatial index
+        return self.data_manager.grid_index.query((xmin, ymin, xmax, ymax))
         
+    @profiled("feature.find_spikes_in_polygon")
+    def find_spikes_in_polygon(self, polygon):
+        """Return the unmasked spikes inside a polygon, in data
+        coordinates."""
+        return self.data_manager.grid_index.query_polygon(polygon)
+        
+    @profiled("feature.set_highlighted_spikes")
     def set_highlighted_spikes(self, spikes):
         """Update spike colors to mark transiently selected spikes with
-        a special color."""
-        if len(spikes) == 0:
-            # do update only if there were previously selected spikes
-            do_update = len(self.highlighted_spikes) > 0
-            self.highlight_mask[:] = 0
-        else:
-            do_update = True
-            self.highlight_mask[:] = 0
-            self.highlight_mask[spikes] = 1
-        
-        if do_update:
-            self.paint_manager.set_data(
-                highlight=self.highlight_mask, dataset=self.paint_manager.ds)
+        a special color. Only the spikes whose state changed are
+        uploaded."""
+        spikes = np.asarray(spikes, dtype=np.int64)
+        changed = np.setxor1d(self.highlighted_spikes, spikes)
+        if len(changed) > 0:
+            self.highlight_mask[np.setdiff1d(self.highlighted_spikes, spikes)] = 0
+            self.highlight_mask[np.setdiff1d(spikes, self.highlighted_spikes)] = 1
+            if not self.data_manager.density:
+                self.upload_highlight(changed)
         
         self.highlighted_spikes = spikes
+        if len(changed) > 0 and self.data_manager.density:
+            self.paint_manager.update_density(force=True)
+        
+    def upload_highlight(self, positions):
+        """Upload the highlighting of the spikes at the given positions in
+        the reordered arrays, which are at other indices in the buffers when
+        the masked spikes are hidden."""
+        visible_positions = self.data_manager.visible_positions
+        if visible_positions is None:
+            upload_ranges(self.paint_manager, self.paint_manager.ds,
+                get_ranges(positions), highlight=self.highlight_mask)
+        else:
+            if self.visible_highlight_mask is None:
+                self.visible_highlight_mask = self.highlight_mask[
+                    visible_positions]
+            if len(visible_positions) == 0:
+                return
+            # indices in the buffers of the spikes which are uploaded, the
+            # positions and visible_positions being sorted
+            indices = np.minimum(np.searchsorted(visible_positions, positions),
+                                 len(visible_positions) - 1)
+            uploaded = visible_positions[indices] == positions
+            indices = indices[uploaded]
+            self.visible_highlight_mask[indices] = self.highlight_mask[
+                positions[uploaded]]
+            upload_ranges(self.paint_manager, self.paint_manager.ds,
+                get_ranges(indices), highlight=self.visible_highlight_mask)
         
     def highlighted(self, box):
         spikes = self.find_enclosed_spikes(box)
@@ -194,7 +746,48 @@ class FeatureHighlightManager(HighlightManager):
         
     def cancel_highlight(self):
         super(FeatureHighlightManager, self).cancel_highlight()
-        self.set_highlighted_spikes([])
+        # go back to the permanent selection
+        self.set_highlighted_spikes(self.selected_spikes)
+        
+    def lasso(self, parameter):
+        """Add a vertex to the current lasso, and highlight the spikes inside
+        it. parameter contains the mouse press position and the current
+        mouse position, in window relative coordinates."""
+        xp, yp, x, y = parameter
+        if not self.lasso_vertices:
+            self.lasso_vertices = [(xp, yp)]
+        if (x, y) != self.lasso_vertices[-1]:
+            self.lasso_vertices.append((x, y))
+        # keep a bounded number of vertices
+        if len(self.lasso_vertices) > LASSO_MAX_VERTICES:
+            self.lasso_vertices = self.lasso_vertices[::2]
+        
+        # paint the lasso, closed by padding the buffer with the first vertex
+        position = np.empty((LASSO_MAX_VERTICES, 2), dtype=np.float32)
+        position[:] = self.lasso_vertices[0]
+        position[:len(self.lasso_vertices)] = self.lasso_vertices
+        self.paint_manager.set_data(visible=True, position=position,
+            dataset=self.paint_manager.ds_lasso)
+        
+        # select the spikes, in data coordinates
+        polygon = [self.interaction_manager.get_data_coordinates(x, y)
+            for x, y in self.lasso_vertices]
+        self.set_highlighted_spikes(self.find_spikes_in_polygon(polygon))
+        
+    def end_lasso(self):
+        """Finish the current lasso, if any: the highlighted spikes become
+        the permanent selection."""
+        if not self.lasso_vertices:
+            return
+        self.lasso_vertices = []
+        self.selected_spikes = np.array(self.highlighted_spikes,
+                                        dtype=np.int64)
+        self.paint_manager.set_data(visible=False,
+            dataset=self.paint_manager.ds_lasso)
+            
+    def clear_selection(self):
+        self.selected_spikes = np.array([], dtype=np.int64)
+        self.set_highlighted_spikes(self.selected_spikes)
         
         
 class FeatureInteractionManager(InteractionManager):
@@ -202,39 +795,117 @@ class FeatureInteractionManager(InteractionManager):
         self.channel = 0
         self.coordorder = [(0,1),(0,2),(1,2)]
         self.icoord = 0
+        # position in the ranking of the best projections
+        self.ibest = -1
         self.constrain_navigation = False
         
     def process_none_event(self):
         super(FeatureInteractionManager, self).process_none_event()
+        self.highlight_manager.end_lasso()
         self.highlight_manager.cancel_highlight()
+        # density mode: bin the points again once the view has changed
+        self.paint_manager.update_density()
         
     def process_custom_event(self, event, parameter):
         if event == FeatureEventEnum.ChangeProjection:
             self.change_projection(parameter)
+        if event == FeatureEventEnum.ChangeAxisChannel:
+            self.change_axis(parameter[0], dchannel=parameter[1])
+        if event == FeatureEventEnum.ChangeAxisCoord:
+            self.change_axis(parameter[0], dcoord=parameter[1])
+        if event == FeatureEventEnum.ChangeBestProjection:
+            self.change_best_projection(parameter)
+        if event == FeatureEventEnum.ToggleMaskedPoints:
+            self.paint_manager.toggle_masked_points()
             
         # transient selection
         if event == FeatureEventEnum.HighlightSpikeEvent:
             self.highlight_manager.highlight(parameter)
             self.cursor = cursors.CrossCursor
+            
+        # permanent selection
+        if event == FeatureEventEnum.LassoEvent:
+            self.highlight_manager.lasso(parameter)
+            self.cursor = cursors.CrossCursor
+        if event == FeatureEventEnum.ClearSelectionEvent:
+            self.highlight_manager.clear_selection()
           
-    def change_projection(self, dir=1):
-        self.icoord += dir
+    def get_neighbor_projection(self, channel, icoord, dir=1):
+        """Return the channel and coordinates index following (or preceding,
+        if dir is -1) the given ones."""
+        icoord += dir
         nchannels = self.data_manager.nchannels
-        if self.icoord == 3:
-            self.icoord = 0
-            self.channel = np.mod(self.channel + 1, nchannels)
-        elif self.icoord == -1:
-            self.icoord = 2
-            self.channel = np.mod(self.channel - 1, nchannels)
-        c0, c1 = self.coordorder[self.icoord]
-        self.data_manager.set_projection(self.channel, self.channel,
-                c0, c1)
+        if icoord == 3:
+            icoord = 0
+            channel = np.mod(channel + 1, nchannels)
+        elif icoord == -1:
+            icoord = 2
+            channel = np.mod(channel - 1, nchannels)
+        return channel, icoord
+        
+    def get_projection(self, channel, icoord):
+        c0, c1 = self.coordorder[icoord]
+        return (channel, channel, c0, c1)
+          
+    def change_projection(self, dir=1):
+        self.channel, self.icoord = self.get_neighbor_projection(
+            self.channel, self.icoord, dir)
+        self.set_projection(*self.get_projection(self.channel, self.icoord))
+        # compute the next projections in both directions in advance
+        self.data_manager.prefetch_projections([self.get_projection(
+            *self.get_neighbor_projection(self.channel, self.icoord, d))
+                for d in (dir, -dir)])
+        
+    def set_projection(self, channel0, channel1, coord0, coord1):
+        """Show any pair of features: coord0 of channel0 on the x axis, and
+        coord1 of channel1 on the y axis."""
+        self.data_manager.set_projection(channel0, channel1, coord0, coord1)
         self.paint_manager.update_points()
+        # the linear navigation continues from the x axis channel
+        self.channel = channel0
+        
+    def get_axis_projection(self, projection, axis, dchannel=0, dcoord=0):
+        """Return a projection where the channel and coordinate of one axis
+        (0 for x, 1 for y) are shifted."""
+        projection = list(projection)
+        projection[axis] = np.mod(projection[axis] + dchannel,
+                                  self.data_manager.nchannels)
+        projection[2 + axis] = np.mod(projection[2 + axis] + dcoord,
+                                      self.data_manager.fetdim)
+        return tuple(projection)
+        
+    def change_axis(self, axis, dchannel=0, dcoord=0):
+        """Move one axis (0 for x, 1 for y) to another channel or
+        coordinate, the other axis being unchanged."""
+        projection = self.get_axis_projection(self.data_manager.projection,
+            axis, dchannel, dcoord)
+        self.set_projection(*projection)
+        # compute the next projection in the same direction in advance
+        self.data_manager.prefetch_projections([self.get_axis_projection(
+            projection, axis, dchannel, dcoord)])
+        
+    def change_best_projection(self, dir=1):
+        """Show the next (or previous, if dir is -1) projection in the
+        ranking of the projections which separate the clusters best."""
+        best_projections = self.data_manager.get_best_projections()
+        if not best_projections:
+            return
+        self.ibest = np.clip(self.ibest + dir, 0, len(best_projections) - 1)
+        self.set_projection(*best_projections[self.ibest])
+        self.data_manager.prefetch_projections([best_projections[i]
+            for i in (self.ibest + dir, self.ibest - dir)
+                if 0 <= i < len(best_projections)])
         
         
 FeatureEventEnum = enum(
     "ChangeProjection",
+    "ChangeAxisChannel",
+    "ChangeAxisCoord",
+    "ChangeBestProjection",
+    "ToggleMaskedPoints",
     "HighlightSpikeEvent",
+    "LassoEvent",
+    "ClearSelectionEvent",
     )
         
         
@@ -256,14 +927,61 @@ class FeaturesBindings(DefaultBindingSet):
                                          p["mouse_position"][0],
                                          p["mouse_position"][1]))
       
+    def set_lasso(self):
+        # lasso: shift + left button mouse
+        self.set(UserActions.LeftButtonMouseMoveAction,
+                 FeatureEventEnum.LassoEvent,
+                 key_modifier=QtCore.Qt.Key_Shift,
+                 param_getter=lambda p: (p["mouse_press_position"][0],
+                                         p["mouse_press_position"][1],
+                                         p["mouse_position"][0],
+                                         p["mouse_position"][1]))
+        # clear the selection
+        self.set(UserActions.KeyPressAction,
+                 FeatureEventEnum.ClearSelectionEvent,
+                 key=QtCore.Qt.Key_Escape)
+      
     def extend(self):
         self.set_highlight()
+        self.set_lasso()
         
         # change projection
         self.set(UserActions.KeyPressAction, FeatureEventEnum.ChangeProjection,
                  key=QtCore.Qt.Key_F, param_getter=lambda p: -1)
         self.set(UserActions.KeyPressAction, FeatureEventEnum.ChangeProjection,
                  key=QtCore.Qt.Key_G, param_getter=lambda p: 1)
+        
+        # change the channel of the x axis (shift) or y axis (control)
+        for axis, modifier in ((0, QtCore.Qt.Key_Shift),
+                               (1, QtCore.Qt.Key_Control)):
+            self.set(UserActions.KeyPressAction,
+                     FeatureEventEnum.ChangeAxisChannel,
+                     key=QtCore.Qt.Key_F, key_modifier=modifier,
+                     param_getter=lambda p, axis=axis: (axis, -1))
+            self.set(UserActions.KeyPressAction,
+                     FeatureEventEnum.ChangeAxisChannel,
+                     key=QtCore.Qt.Key_G, key_modifier=modifier,
+                     param_getter=lambda p, axis=axis: (axis, 1))
+        
+        # change the coordinate of the x or y axis
+        self.set(UserActions.KeyPressAction, FeatureEventEnum.ChangeAxisCoord,
+                 key=QtCore.Qt.Key_X, param_getter=lambda p: (0, 1))
+        self.set(UserActions.KeyPressAction, FeatureEventEnum.ChangeAxisCoord,
+                 key=QtCore.Qt.Key_Y, param_getter=lambda p: (1, 1))
+        
+        # go through the projections which separate the clusters best
+        self.set(UserActions.KeyPressAction,
+                 FeatureEventEnum.ChangeBestProjection,
+                 key=QtCore.Qt.Key_B, param_getter=lambda p: 1)
+        self.set(UserActions.KeyPressAction,
+                 FeatureEventEnum.ChangeBestProjection,
+                 key=QtCore.Qt.Key_B, key_modifier=QtCore.Qt.Key_Shift,
+                 param_getter=lambda p: -1)
+        
+        # show or hide the masked points
+        self.set(UserActions.KeyPressAction,
+                 FeatureEventEnum.ToggleMaskedPoints,
+                 key=QtCore.Qt.Key_M)
      
      
 class FeatureView(GalryWidget):
@@ -278,6 +996,33 @@ class FeatureView(GalryWidget):
     def set_data(self, *args, **kwargs):
         self.data_manager.set_data(*args, **kwargs)
         
+    def get_selected_spikes(self):
+        """Return the indices of the spikes selected with the lasso, e.g. to
+        split them with reassign_spikes."""
+        return np.sort(self.data_manager.permutation[
+            self.highlight_manager.selected_spikes])
+        
+    def reassign_spikes(self, spikes, clusters, cluster_colors=None):
+        """Merge, split or reassign spikes to other clusters, by uploading
+        only the data of the spikes which changed.
+        
+        Arguments:
+          * spikes: the indices of the spikes to move
+          * clusters: the new cluster (absolute index) of each spike, or a
+            single cluster index
+          * cluster_colors: the colors of the new clusters, if any
+        
+        """
+        nclusters = self.data_manager.nclusters
+        # the selection refers to positions which are about to change
+        self.highlight_manager.cancel_highlight()
+        self.highlight_manager.clear_selection()
+        changed = self.data_manager.reassign_spikes(spikes, clusters,
+            cluster_colors=cluster_colors)
+        self.paint_manager.update_spikes(changed,
+            update_colors=self.data_manager.nclusters != nclusters)
+        self.updateGL()
+        
         
 
 # if __name__ == '__main__':
@@ -306,4 +1051,3 @@ class FeatureView(GalryWidget):
     # # masks = masks[indices,:]
     
     
-    
\ No newline at end of file
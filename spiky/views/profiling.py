@@ -0,0 +1,189 @@
+"""Wall time and peak memory of the data processing and upload stages of the
+views.
+
+Profiling is enabled by setting the SPIKY_PROFILING environment variable
+before the views are imported. When it is not set, the `profiled` decorator
+returns the functions unchanged, so that profiling costs nothing. Otherwise,
+the recording can be paused with PROFILER.enabled = False.
+
+The memory is the peak of the memory used during a call, above the memory
+used when the call started. It is the peak of the resident memory of the
+process, read from /proc/self/status, the peak being reset through
+/proc/self/clear_refs (Linux 4.0+): the pages of the arrays which are
+allocated but never written are then not counted. It is None when this is
+not available. The availability is only probed when profiling is enabled,
+since probing the resident memory resets its peak.
+
+"""
+import collections
+import functools
+import json
+import os
+import time
+
+
+__all__ = ['Profiler', 'PROFILER', 'profiled']
+
+
+# maximum number of individual calls kept in memory
+MAX_RECORDS = 10000
+
+
+def get_resident_memory():
+    """Return the current and peak resident memory of the process, in
+    bytes."""
+    values = {}
+    with open('/proc/self/status', 'r') as f:
+        for line in f:
+            name, _, value = line.partition(':')
+            if name in ('VmRSS', 'VmHWM'):
+                values[name] = int(value.split()[0]) * 1024
+    return values['VmRSS'], values['VmHWM']
+
+
+def reset_resident_peak():
+    """Reset the peak resident memory of the process to the current
+    resident memory."""
+    with open('/proc/self/clear_refs', 'w') as f:
+        f.write('5')
+
+
+def has_resident_memory():
+    try:
+        reset_resident_peak()
+        get_resident_memory()
+    except (IOError, OSError, KeyError, ValueError):
+        return False
+    return True
+
+
+def get_memory_source():
+    """Return the source of the memory measurements: 'resident' or None."""
+    if has_resident_memory():
+        return 'resident'
+    return None
+
+
+class Profiler(object):
+    """Record the duration and peak memory of the calls of the profiled
+    functions.
+
+    Every record contains the name of the function, the time of the call, its
+    total duration, its own duration (without the profiled functions called
+    by it), and its peak memory in bytes.
+
+    """
+    def __init__(self, enabled=False, max_records=MAX_RECORDS):
+        self.enabled = enabled
+        self.records = collections.deque(maxlen=max_records)
+        # calls in progress, for nested profiled functions
+        self.stack = []
+        # source of the memory measurements, set by start_memory
+        self.memory_source = None
+
+    def start_memory(self):
+        if self.memory_source is None:
+            self.memory_source = get_memory_source()
+
+    def is_measuring_memory(self):
+        return self.memory_source == 'resident'
+
+    def get_memory(self):
+        """Return the current memory, and its peak since the last reset."""
+        return get_resident_memory()
+
+    def reset_peak(self):
+        reset_resident_peak()
+
+    def enter(self):
+        """Start a call, and return its frame."""
+        frame = dict(start=time.time(), children=0., memory=None,
+                     peak=None)
+        if self.is_measuring_memory():
+            current, peak = self.get_memory()
+            # keep the peak of the caller before resetting it
+            if self.stack:
+                self.fold_peak(self.stack[-1], peak)
+            self.reset_peak()
+            frame['memory'] = current
+        self.stack.append(frame)
+        return frame
+
+    def fold_peak(self, frame, peak):
+        if frame['peak'] is None or peak > frame['peak']:
+            frame['peak'] = peak
+
+    def exit(self, name, frame):
+        """End a call, and record it."""
+        duration = time.time() - frame['start']
+        self.stack.pop()
+        memory = None
+        if frame['memory'] is not None:
+            _, peak = self.get_memory()
+            self.fold_peak(frame, peak)
+            memory = max(frame['peak'] - frame['memory'], 0)
+        if self.stack:
+            parent = self.stack[-1]
+            parent['children'] += duration
+            if frame['peak'] is not None and parent['memory'] is not None:
+                self.fold_peak(parent, frame['peak'])
+        self.records.append(dict(name=name, start=frame['start'],
+            time=duration, self_time=duration - frame['children'],
+            memory=memory))
+
+    def get_records(self, name=None):
+        """Return the records of all calls, or of the calls of a given
+        function, in chronological order."""
+        return [record for record in self.records
+                    if name is None or record['name'] == name]
+
+    def get_summary(self):
+        """Return, for every profiled function, the number of calls, the
+        total, own and maximum duration of the calls, and the maximum peak
+        memory."""
+        summary = {}
+        for record in self.records:
+            stats = summary.setdefault(record['name'], dict(count=0,
+                time=0., self_time=0., max_time=0., max_memory=None))
+            stats['count'] += 1
+            stats['time'] += record['time']
+            stats['self_time'] += record['self_time']
+            stats['max_time'] = max(stats['max_time'], record['time'])
+            if record['memory'] is not None and (stats['max_memory'] is None
+                    or record['memory'] > stats['max_memory']):
+                stats['max_memory'] = record['memory']
+        return summary
+
+    def dump(self, filename):
+        """Save the summary and the records in a JSON file."""
+        with open(filename, 'w') as f:
+            json.dump(dict(summary=self.get_summary(),
+                           records=self.get_records()), f, indent=2)
+
+    def reset(self):
+        self.records.clear()
+
+
+PROFILER = Profiler(enabled=bool(os.environ.get('SPIKY_PROFILING')))
+if PROFILER.enabled:
+    PROFILER.start_memory()
+
+
+def profiled(name):
+    """Decorator recording the calls of a function under the given name,
+    when profiling is enabled."""
+    def decorator(fun):
+        if not PROFILER.enabled:
+            return fun
+        @functools.wraps(fun)
+        def wrapper(*args, **kwargs):
+            if not PROFILER.enabled:
+                return fun(*args, **kwargs)
+            frame = PROFILER.enter()
+            try:
+                return fun(*args, **kwargs)
+            finally:
+                PROFILER.exit(name, frame)
+        return wrapper
+    return decorator
+
@@ -4,8 +4,22 @@ import collections
 import operator
 import time
 
+try:
+    import OpenGL.GL as gl
+except ImportError:
+    gl = None
+
 from galry import *
 from common import *
+from profiling import profiled
+try:
+    # spiky imported as a package
+    from ..clustering import group_by_cluster
+    from ..stats import ClusterStatisticsCache
+except ValueError:
+    # spiky directory in the path
+    from clustering import group_by_cluster
+    from stats import ClusterStatisticsCache
 
 __all__ = ['WaveformView']
 
@@ -44,7 +58,50 @@ FRAGMENT_SHADER = """
     out_color = varying_color;
 """
 
-HIGHLIGHT_CLOSE_BOXES_COUNT = 4
+# compact layout: only the Y coordinates are per-vertex attributes, the
+# clusters, highlighting and masks are stored in textures (per spike and per
+# channel), and the other attributes are derived from the vertex index
+VERTEX_HEADER_COMPACT = """
+vec4 get_texel(sampler2D tex, int index, int width, int rows)
+{
+    vec2 coords = vec2((float(index % width) + .5) / float(width),
+                       (float(index / width) + .5) / float(rows));
+    return texture2D(tex, coords);
+}
+"""
+
+VERTEX_SHADER_COMPACT = """
+    // the vertices are ordered by channel, spike and sample
+    int sample = gl_VertexID % nsamples;
+    int spike_channel = gl_VertexID / nsamples;
+    int spike = spike_channel % nspikes;
+    float channel = float(spike_channel / nspikes);
+
+    // per-spike and per-channel data
+    float cluster = floor(get_texel(cluster_texture, spike,
+        texture_width, spike_texture_rows).x * 255. + .5);
+    float highlight = get_texel(highlight_texture, spike,
+        texture_width, spike_texture_rows).x;
+    float mask = get_texel(mask_texture, spike_channel,
+        texture_width, mask_texture_rows).x;
+
+    // X coordinates are always between -1 and 1
+    vec2 position0 = vec2(-1. + 2. * float(sample) / float(nsamples - 1), y);
+"""
+
+# width of the textures of the compact layout, until the maximum size of the
+# textures is known. galry only updates a texture entirely: `onset` in
+# set_data only applies to the vertex attributes.
+TEXTURE_WIDTH = 4096
+# number of textures read in the vertex shader of the compact layout
+COMPACT_TEXTURES = 3
+# maximum number of clusters in the compact layout, whose textures have 8 bits
+# per texel, the full layout being used beyond
+COMPACT_MAX_CLUSTERS = 256
+
+# level of detail: maximum number of vertices of the additional waveforms
+# loaded for the visible channels when zooming in
+LOD_DETAIL_VERTICES = 1000000
 
 WaveformSpatialArrangement = enum("Linear", "Geometrical")
 WaveformSuperposition = enum("Superimposed", "Separated")
@@ -59,14 +116,99 @@ WaveformEventEnum = enum(
 
 
     
+def get_spikes_subset(clusters, max_waveforms):
+    """Return the sorted indices of at most max_waveforms spikes per cluster,
+    evenly spaced in time within each cluster."""
+    order, _, starts, sizes = group_by_cluster(clusters)
+    # keep one spike every step spikes in each cluster
+    steps = np.maximum(1, -(-sizes // max(max_waveforms, 1)))
+    ranks = np.arange(len(clusters)) - np.repeat(starts, sizes)
+    keep = np.mod(ranks, np.repeat(steps, sizes)) == 0
+    return np.sort(order[keep])
+    
+    
+def get_glsl_version(version):
+    """Return the (major, minor) GLSL version from a version string like
+    '1.30 NVIDIA via Cg compiler'."""
+    try:
+        major, minor = version.split()[0].split('.')[:2]
+        return int(major), int(minor[:2].ljust(2, '0'))
+    except (AttributeError, IndexError, ValueError):
+        return (0, 0)
+    
+    
+def get_compact_texture_size():
+    """Return the maximum size of the textures if the current OpenGL context
+    supports the compact layout, or None otherwise.
+    
+    The vertex shader of the compact layout needs GLSL 1.30 (for gl_VertexID
+    and the integer operations) and texture fetches in the vertex shader.
+    
+    """
+    if gl is None:
+        return None
+    try:
+        version = get_glsl_version(
+            gl.glGetString(gl.GL_SHADING_LANGUAGE_VERSION))
+        max_size = int(gl.glGetIntegerv(gl.GL_MAX_TEXTURE_SIZE))
+        units = int(gl.glGetIntegerv(gl.GL_MAX_VERTEX_TEXTURE_IMAGE_UNITS))
+    except Exception:
+        return None
+    if version < (1, 30) or units < COMPACT_TEXTURES:
+        return None
+    return max_size
+    
+    
+def get_texture(values, width=TEXTURE_WIDTH):
+    """Return a float32 texture with the given values, wrapped in rows of
+    width texels and padded with zeros."""
+    values = np.asarray(values).ravel()
+    rows = max(1, -(-len(values) // width))
+    texture = np.zeros((rows, width), dtype=np.float32)
+    texture.ravel()[:len(values)] = values
+    return texture
+    
+    
+def encode_clusters(clusters_rel):
+    """Encode relative cluster indices in [0, 1], as they are decoded in the
+    vertex shader of the compact layout.
+    
+    galry converts the float textures to 8-bit textures, with
+    uint8(255 * value). The index k is encoded as (k + .25) / 255 (clipped to
+    1), which is stored as k whether the conversion truncates or rounds, and
+    decoded as floor(255 * texel + .5). This requires less than
+    COMPACT_MAX_CLUSTERS clusters.
+    
+    """
+    clusters_rel = np.asarray(clusters_rel)
+    assert (clusters_rel.size == 0 or
+            clusters_rel.max() < COMPACT_MAX_CLUSTERS)
+    return np.minimum((clusters_rel + .25) / 255., 1.)
+    
     
 class WaveformHighlightManager(HighlightManager):
     def initialize(self):
-        """Set info from the data manager."""
         super(WaveformHighlightManager, self).initialize()
+        self.set_info()
+        self.highlighted_spikes = np.array([], dtype=np.int64)
+        self.prepare_highlight_data()
+        
+    def prepare_highlight_data(self):
+        """Create the highlight attribute, or the highlight texture in the
+        compact layout."""
+        if self.data_manager.compact:
+            # one texel per spike in the compact layout
+            self.highlight_mask = None
+            self.highlight_texture = get_texture(np.zeros(self.nspikes),
+                self.data_manager.texture_width)
+            self.highlight_data = self.highlight_texture.ravel()[:self.nspikes]
+        else:
+            self.highlight_mask = np.zeros(self.npoints, dtype=np.int32)
+        
+    def set_info(self):
+        """Set info from the data manager."""
         data_manager = self.data_manager
         self.get_data_position = self.data_manager.get_data_position
-        self.full_masks = self.data_manager.full_masks
         self.clusters_rel = self.data_manager.clusters_rel
         self.cluster_colors = self.data_manager.cluster_colors
         self.nchannels = data_manager.nchannels
@@ -75,15 +217,21 @@ class WaveformHighlightManager(HighlightManager):
         self.nspikes = data_manager.nspikes
         self.npoints = data_manager.npoints
         self.get_data_position = data_manager.get_data_position
-        self.highlighted_spikes = []
-        self.highlight_mask = np.zeros(self.npoints, dtype=np.int32)
 
+    @profiled("waveform.find_enclosed_spikes")
     def find_enclosed_spikes(self, enclosing_box):
+        """Return the positions, in the reordered arrays, of the spikes with
+        a waveform segment crossing the box, on an unmasked channel (or the
+        sample of single sample waveforms).
+        
+        All boxes intersecting the selection are processed at once. The
+        waveforms whose vertical range does not intersect the selection are
+        discarded first, then the segments within the horizontal range of the
+        selection are clipped to it and tested.
+        
+        """
         x0, y0, x1, y1 = enclosing_box
         
-        # press_position
-        xp, yp = x0, y0
-
         # reorder
         xmin, xmax = min(x0, x1), max(x0, x1)
         ymin, ymax = min(y0, y1), max(y0, y1)
@@ -94,77 +242,101 @@ class WaveformHighlightManager(HighlightManager):
         w, h = box_size
         a, b = w / 2, h / 2
         
-        # find the enclosed channels and clusters
-        sx, sy = self.interaction_manager.sx, self.interaction_manager.sy
-        dist = (np.abs(Tx - xp) * sx) ** 2 + (np.abs(Ty - yp) * sy) ** 2
-        # find the K closest boxes, with K at least HIGHLIGHT_CLOSE_BOXES_COUNT
-        # or nclusters (so that all spikes are selected in superimposed mode
-        closest = np.argsort(dist.ravel())[:HIGHLIGHT_CLOSE_BOXES_COUNT]
-        
-        spkindices = []
-        for index in closest:
-            # find the channel and cluster of this close box
-            channel, cluster_rel = index // self.nclusters, np.mod(index, self.nclusters)
-            # find the position of the points in the data buffer
-            start, end = self.get_data_position(channel, cluster_rel)
-            
-            # offset
-            u = Tx[channel, cluster_rel]
-            v = Ty[channel, cluster_rel]
-
-            # original data
-            waveforms = self.data_manager.normalized_data[start:end,:]
-            masks = self.full_masks[start:end]
-
-            # get the waveforms and masks
-            # waveforms = positioned_data[start:end,:]
-            # find the indices of the points in the enclosed box
-            # inverse transformation of x => ax+u, y => by+v
-            indices = ((masks > 0) & \
-                      (waveforms[:,0] >= (xmin-u)/a) & (waveforms[:,0] <= (xmax-u)/a) & \
-                      (waveforms[:,1] >= (ymin-v)/b) & (waveforms[:,1] <= (ymax-v)/b))
-            # absolute indices in the data
-            indices = np.nonzero(indices)[0] + start
-            # spike indices, independently of the channel
-            spkindices.append(np.mod(indices, self.nspikes * self.nsamples) // self.nsamples)        
-        spkindices = np.hstack(spkindices)
-        spkindices = np.unique(spkindices)
-        spkindices.sort()
-        return spkindices
+        # the selection in the coordinates of every box
+        # inverse transformation of x => ax+u, y => by+v
+        bx0, bx1 = (xmin - Tx) / a, (xmax - Tx) / a
+        by0, by1 = (ymin - Ty) / b, (ymax - Ty) / b
+        
+        # candidate boxes: non-empty, and intersecting the selection
+        dm = self.data_manager
+        boxes = ((bx1 >= -1) & (bx0 <= 1) & (by1 >= -1) & (by0 <= 1) &
+                 (dm.cluster_sizes > 0).reshape((1, -1)))
+        channels, clusters = np.nonzero(boxes)
+        if len(channels) == 0:
+            return np.array([], dtype=np.int64)
+        bx0, bx1 = bx0[channels, clusters], bx1[channels, clusters]
+        by0, by1 = by0[channels, clusters], by1[channels, clusters]
+        
+        # all spikes of the candidate boxes
+        starts = dm.cluster_sizes_cum[clusters]
+        sizes = dm.cluster_sizes[clusters]
+        positions = get_ranges_indices(starts, starts + sizes)
+        box = np.repeat(np.arange(len(channels)), sizes)
+        channel = channels[box]
+        
+        # discard the masked waveforms, and those which are entirely above
+        # or below the selection
+        keep = ((dm.masks[positions, channel] > 0) &
+                (dm.waveform_ymax[channel, positions] >= by0[box]) &
+                (dm.waveform_ymin[channel, positions] <= by1[box]))
+        positions, box, channel = positions[keep], box[keep], channel[keep]
+        X = dm.x_samples
+        
+        # single sample waveforms have no segment: the vertical range of the
+        # point has been tested already, test its horizontal position
+        if self.nsamples == 1:
+            hit = (bx0[box] <= X[0]) & (bx1[box] >= X[0])
+            return np.unique(positions[hit])
+        
+        # segments (between samples k and k+1) within the horizontal range
+        # of the selection, in every box
+        first = np.clip(np.searchsorted(X, bx0) - 1, 0, self.nsamples - 2)
+        last = np.clip(np.searchsorted(X, bx1, side='right') - 1,
+                       0, self.nsamples - 2)
+        nsegments = np.maximum(last - first + 1, 0)[box]
+        candidate = np.repeat(np.arange(len(positions)), nsegments)
+        segment = get_ranges_indices(first[box], first[box] + nsegments)
+        index = (self.nsamples * (channel * self.nspikes + positions))[
+            candidate] + segment
+        box = box[candidate]
+        
+        # clip the segments to the horizontal range of the selection, and
+        # test the vertical range of the clipped segments
+        xa, ya = X[segment], dm.normalized_y[index]
+        xb, yb = X[segment + 1], dm.normalized_y[index + 1]
+        slope = (yb - ya) / (xb - xa)
+        yl = ya + slope * (np.maximum(xa, bx0[box]) - xa)
+        yr = ya + slope * (np.minimum(xb, bx1[box]) - xa)
+        hit = ((np.maximum(yl, yr) >= by0[box]) &
+               (np.minimum(yl, yr) <= by1[box]))
+        return np.unique(positions[candidate[hit]])
 
     def find_indices_from_spikes(self, spikes):
         if spikes is None or len(spikes)==0:
             return None
-        n = len(spikes)
         # find point indices in the data buffer corresponding to 
         # the selected spikes. In particular, waveforms of those spikes
         # across all channels should be selected as well.
-        spikes = np.array(spikes, dtype=np.int32)
-        ind = np.repeat(spikes * self.nsamples, self.nsamples)
-        ind += np.tile(np.arange(self.nsamples), n)
-        ind = np.tile(ind, self.nchannels)
-        ind += np.repeat(np.arange(self.nchannels) * self.nsamples * self.nspikes,
-                                self.nsamples * n)
-        return ind
+        return self.data_manager.get_vertex_indices(spikes).ravel()
         
+    @profiled("waveform.set_highlighted_spikes")
     def set_highlighted_spikes(self, spikes):
         """Update spike colors to mark transiently selected spikes with
-        a special color."""
-        if len(spikes) == 0:
-            # do update only if there were previously selected spikes
-            do_update = len(self.highlighted_spikes) > 0
-            self.highlight_mask[:] = 0
-        else:
-            do_update = True
-            ind = self.find_indices_from_spikes(spikes)
-        
-            self.highlight_mask[:] = 0
-            self.highlight_mask[ind] = 1
-        
-        if do_update:
-            self.paint_manager.set_data(
-                highlight=self.highlight_mask,
-                dataset=self.paint_manager.ds_waveforms)
+        a special color. Only the vertices of the spikes whose state changed
+        are uploaded, the highlight texture of the compact layout (one texel
+        per spike) being uploaded entirely."""
+        spikes = np.asarray(spikes, dtype=np.int64)
+        changed = np.setxor1d(self.highlighted_spikes, spikes)
+        if len(changed) > 0:
+            removed = np.setdiff1d(self.highlighted_spikes, spikes)
+            added = np.setdiff1d(spikes, self.highlighted_spikes)
+            if self.data_manager.compact:
+                self.highlight_data[removed] = 0
+                self.highlight_data[added] = 1
+                self.paint_manager.set_data(
+                    dataset=self.paint_manager.ds_waveforms,
+                    highlight_texture=self.highlight_texture)
+            else:
+                if len(removed) > 0:
+                    self.highlight_mask[
+                        self.find_indices_from_spikes(removed)] = 0
+                if len(added) > 0:
+                    self.highlight_mask[
+                        self.find_indices_from_spikes(added)] = 1
+                upload_ranges(self.paint_manager,
+                    self.paint_manager.ds_waveforms,
+                    self.data_manager.get_vertex_ranges(changed),
+                    highlight=self.highlight_mask)
         
         self.highlighted_spikes = spikes
         
@@ -400,6 +572,18 @@ class WaveformPositionManager(object):
         
     # Get methods
     # -----------
+    def get_visible_channels(self, viewbox):
+        """Return the channels with at least one box intersecting the given
+        viewbox (x0, y0, x1, y1), in data coordinates."""
+        x0, y0, x1, y1 = viewbox
+        xmin, xmax = min(x0, x1), max(x0, x1)
+        ymin, ymax = min(y0, y1), max(y0, y1)
+        Tx, Ty = self.box_positions
+        w, h = self.box_size
+        visible = ((Tx + w / 2 >= xmin) & (Tx - w / 2 <= xmax) &
+                   (Ty + h / 2 >= ymin) & (Ty - h / 2 <= ymax))
+        return np.nonzero(visible.any(axis=1))[0]
+        
     def get_viewbox(self, channels):
         """Return the smallest viewbox such that the selected channels are
         visible.
@@ -422,8 +606,10 @@ class WaveformPositionManager(object):
 class WaveformDataManager(object):
     # Initialization methods
     # ----------------------
+    @profiled("waveform.set_data")
     def set_data(self, waveforms, clusters=None, cluster_colors=None,
-                 masks=None, geometrical_positions=None, spike_ids=None):
+                 masks=None, geometrical_positions=None, spike_ids=None,
+                 max_waveforms=None, waveforms_stats=None, compact=False):
         """
         waveforms is a Nspikes x Nsamples x Nchannels array.
         clusters is a Nspikes array, with the cluster absolute index for each
@@ -433,11 +619,52 @@ class WaveformDataManager(object):
             index
         masks is a Nspikes x Nchannels array (with values in [0,1])
         spike_ids is a Nspikes array, it contains the absolute indices of spikes
+        max_waveforms, if not None, enables the level of detail mode: only
+            max_waveforms waveforms per cluster are displayed, with the mean
+            and standard deviation envelopes of all waveforms of each cluster,
+            and more waveforms are loaded for the visible channels when
+            zooming in
+        waveforms_stats is an optional ClusterStatisticsCache of the
+            waveforms, used for the envelopes in the level of detail mode
+            (one is created otherwise), and kept up to date whenever spikes
+            are reassigned
+        compact, if True, enables the compact GPU layout: only the Y
+            coordinates are uploaded per vertex, the clusters and masks are
+            uploaded per spike and per channel in textures, and the other
+            attributes are derived from the vertex index in the vertex shader
+            (requires GLSL 1.30 and texture fetches in the vertex shader, the
+            full layout being used otherwise, or if the textures exceed the
+            maximum size of the textures, or with more than
+            COMPACT_MAX_CLUSTERS clusters)
         """
         
-        self.nspikes, self.nsamples, self.nchannels = waveforms.shape
-        self.npoints = waveforms.size
+        self.nspikes_total, self.nsamples, self.nchannels = waveforms.shape
         self.geometrical_positions = geometrical_positions
+        self.waveforms_full = waveforms
+        self.max_waveforms = max_waveforms
+        self.waveforms_stats = waveforms_stats
+        self.compact = compact
+        self.texture_width = TEXTURE_WIDTH
+        
+        # level of detail: only keep a subset of the spikes of every cluster
+        if max_waveforms is not None:
+            if clusters is None:
+                clusters = np.zeros(self.nspikes_total, dtype=np.int32)
+            if masks is None:
+                masks = np.ones((self.nspikes_total, self.nchannels))
+            self.clusters_full = np.array(clusters, dtype=np.int32)
+            self.masks_full = masks
+            self.spikes_displayed = get_spikes_subset(clusters, max_waveforms)
+            waveforms = waveforms[self.spikes_displayed]
+            clusters = self.clusters_full[self.spikes_displayed]
+            masks = np.asarray(masks[self.spikes_displayed])
+            if spike_ids is not None:
+                spike_ids = spike_ids[self.spikes_displayed]
+        else:
+            self.spikes_displayed = None
+        
+        self.nspikes = waveforms.shape[0]
+        self.npoints = waveforms.size
         self.spike_ids = spike_ids
         self.waveforms = waveforms
         
@@ -450,6 +677,110 @@ class WaveformDataManager(object):
                                                 spike_ids=spike_ids)
         
         # get reordered data
+        self.get_organized_data()
+        
+        # the clusters must fit in the 8-bit texture of the compact layout
+        if self.nclusters > COMPACT_MAX_CLUSTERS:
+            self.compact = False
+        if self.compact:
+            self.prepare_compact_data()
+        else:
+            self.prepare_full_data()
+        
+        # X coordinates of the samples, the same for all waveforms
+        self.x_samples = np.linspace(-1., 1., self.nsamples)
+        
+        # vertical range of every waveform, for the selection
+        self.waveform_ymin = np.empty((self.nchannels, self.nspikes),
+                                      dtype=np.float32)
+        self.waveform_ymax = np.empty((self.nchannels, self.nspikes),
+                                      dtype=np.float32)
+        self.update_waveform_ranges(slice(None))
+        
+        # envelopes of all waveforms, in the level of detail mode
+        if self.spikes_displayed is not None:
+            if self.waveforms_stats is None:
+                self.waveforms_stats = ClusterStatisticsCache(
+                    self.waveforms_full, self.clusters_full)
+            self.update_envelope_data()
+        
+        # position waveforms
+        self.position_manager.set_info(self.nchannels, self.nclusters, 
+                                       geometrical_positions=self.geometrical_positions)
+        
+        # update the highlight manager
+        self.highlight_manager.initialize()
+        
+    @profiled("waveform.reassign_spikes")
+    def reassign_spikes(self, spikes, clusters, cluster_colors=None):
+        """Move spikes to other clusters, and patch the GPU data in place.
+        Return the positions of the changed spikes in the reordered arrays."""
+        nclusters = self.nclusters
+        if self.waveforms_stats is not None:
+            self.update_waveforms_stats(spikes, clusters)
+        if self.spikes_displayed is not None:
+            spikes, clusters, clusters_changed = self.reassign_spikes_full(
+                spikes, clusters, cluster_colors=cluster_colors)
+            # the new clusters have already been created
+            cluster_colors = None
+        changed = self.data_organizer.reassign(spikes, clusters,
+                                               cluster_colors=cluster_colors)
+        self.get_organized_data()
+        if self.compact and self.nclusters > COMPACT_MAX_CLUSTERS:
+            # the clusters do not fit in the 8-bit texture anymore
+            self.use_full_layout()
+        self.update_waveform_data(changed)
+        if self.spikes_displayed is not None:
+            self.update_envelope_data(self.get_clusters_rel(clusters_changed))
+        
+        # new clusters: update the boxes
+        if self.nclusters != nclusters:
+            self.position_manager.set_info(self.nchannels, self.nclusters, 
+                geometrical_positions=self.geometrical_positions)
+            self.highlight_manager.set_info()
+        return changed
+        
+    def reassign_spikes_full(self, spikes, clusters, cluster_colors=None):
+        """In the level of detail mode, move spikes to other clusters in the
+        full set of spikes, create the new clusters, and return the moved
+        spikes which are displayed (indices in the displayed subset) with
+        their new clusters, and the clusters whose envelopes changed."""
+        spikes = np.asarray(spikes, dtype=np.int64)
+        clusters = np.asarray(clusters, dtype=np.int32)
+        if clusters.ndim == 0:
+            clusters = np.repeat(clusters, len(spikes))
+        clusters_old = self.clusters_full[spikes]
+        self.clusters_full[spikes] = clusters
+        # new clusters, which may not have any displayed spike
+        new_clusters = np.setdiff1d(clusters,
+                                    self.data_organizer.clusters_unique)
+        if len(new_clusters) > 0:
+            self.data_organizer.add_clusters(new_clusters, cluster_colors)
+        # displayed spikes among the moved ones
+        index = np.searchsorted(self.spikes_displayed, spikes)
+        index = np.minimum(index, len(self.spikes_displayed) - 1)
+        displayed = self.spikes_displayed[index] == spikes
+        return (index[displayed], clusters[displayed],
+                np.union1d(clusters_old, clusters))
+        
+    def update_waveforms_stats(self, spikes, clusters):
+        """Update the statistics of the waveforms when spikes move to other
+        clusters. When all spikes of some clusters move to a single cluster
+        (a merge), the statistics are summed without reading the
+        waveforms."""
+        stats = self.waveforms_stats
+        moved = np.unique(np.asarray(spikes, dtype=np.int64))
+        targets = np.unique(clusters)
+        if len(moved) > 0 and len(targets) == 1:
+            clusters_old = np.unique(stats.clusters[moved])
+            if np.sum(np.in1d(stats.clusters, clusters_old)) == len(moved):
+                stats.merge(clusters_old, targets[0])
+                return
+        stats.reassign(spikes, clusters)
+        
+    # Internal methods
+    # ----------------
+    def get_organized_data(self):
         self.permutation = self.data_organizer.permutation
         self.waveforms_reordered = self.data_organizer.data_reordered
         self.nclusters = self.data_organizer.nclusters
@@ -462,6 +793,8 @@ class WaveformDataManager(object):
         self.cluster_sizes_cum = self.data_organizer.cluster_sizes_cum
         self.cluster_sizes_dict = self.data_organizer.cluster_sizes_dict
         
+    def prepare_full_data(self):
+        """Define the per-vertex GPU data of the full layout."""
         # prepare GPU data: waveform initial positions and colors
         data = self.prepare_waveform_data()
         
@@ -471,18 +804,9 @@ class WaveformDataManager(object):
         self.full_channels = np.repeat(np.arange(self.nchannels, dtype=np.int32), self.nspikes * self.nsamples)
         
         # normalize the initial waveforms
-        self.data_normalizer = DataNormalizer(data)
-        self.normalized_data = self.data_normalizer.normalize()
-        
-        # position waveforms
-        self.position_manager.set_info(self.nchannels, self.nclusters, 
-                                       geometrical_positions=self.geometrical_positions)
-        
-        # update the highlight manager
-        self.highlight_manager.initialize()
+        self.normalize_waveform_data(data)
         
-    # Internal methods
-    # ----------------
+    @profiled("waveform.prepare_waveform_data")
     def prepare_waveform_data(self):
         """Define waveform data."""
         # prepare data for GPU transfer
@@ -499,15 +823,240 @@ class WaveformDataManager(object):
         data[:,1] = Y.T.ravel()
         return data
     
+    @profiled("waveform.normalize_waveform_data")
+    def normalize_waveform_data(self, data):
+        self.data_normalizer = DataNormalizer(data)
+        self.normalized_data = self.data_normalizer.normalize()
+        self.normalized_y = self.normalized_data[:,1]
+    
+    @profiled("waveform.prepare_compact_data")
+    def prepare_compact_data(self):
+        """Define the waveform data in the compact layout: the normalized Y
+        coordinates, ordered by channel, spike and sample, and the textures
+        with the cluster of every spike, and the mask of every spike on every
+        channel."""
+        Y = self.waveforms_reordered
+        if Y.size > 0:
+            ymin, ymax = Y.min(), Y.max()
+        else:
+            ymin, ymax = -1., 1.
+        # same normalization as in the full layout, X being in [-1, 1]
+        self.data_normalizer = DataNormalizer(np.array([[-1., ymin],
+                                                        [1., ymax]]))
+        self.data_normalizer.normalize()
+        self.normalized_y = np.empty(self.npoints, dtype=np.float32)
+        self.normalized_y[:] = self.data_normalizer.normalize_y(
+            Y.transpose((2, 0, 1)).ravel())
+        self.prepare_textures()
+        
+    def prepare_textures(self):
+        """Create the per-spike and per-channel textures of the compact
+        layout, with rows of texture_width texels."""
+        self.cluster_texture = get_texture(encode_clusters(self.clusters_rel),
+            self.texture_width)
+        self.cluster_data = self.cluster_texture.ravel()[:self.nspikes]
+        self.mask_texture = get_texture(self.masks.T, self.texture_width)
+        self.mask_data = self.mask_texture.ravel()[
+            :self.nspikes * self.nchannels]
+        
+    def set_texture_size(self, max_size):
+        """Adapt the textures of the compact layout to the maximum size of
+        the textures, given by the OpenGL context, or switch to the full
+        layout if they do not fit (or if max_size is None, when the compact
+        layout is not supported)."""
+        if not self.compact:
+            return
+        # the largest texture has one texel per spike and per channel
+        if (max_size is None or
+                -(-self.nspikes * self.nchannels // max_size) > max_size):
+            self.use_full_layout()
+        elif max_size != self.texture_width:
+            self.texture_width = max_size
+            self.prepare_textures()
+            self.highlight_manager.prepare_highlight_data()
+            
+    def use_full_layout(self):
+        """Switch from the compact layout to the full layout."""
+        self.compact = False
+        self.prepare_full_data()
+        self.highlight_manager.prepare_highlight_data()
+    
+    def get_clusters_rel(self, clusters):
+        """Return the relative indices of the given clusters (absolute
+        indices)."""
+        return self.data_organizer.get_clusters_rel(clusters)
+        
+    def get_cluster_envelopes(self, clusters_rel):
+        """Return the number of spikes, and the mean and standard deviation
+        of the waveforms, of the given clusters (relative indices)."""
+        stats = self.waveforms_stats
+        clusters = self.clusters_unique[clusters_rel]
+        return (stats.get_counts(clusters),
+                stats.get_means(clusters),
+                stats.get_stds(clusters))
+        
+    @profiled("waveform.update_envelope_data")
+    def update_envelope_data(self, clusters_rel=None):
+        """Compute the GPU data of the mean and mean +/- standard deviation
+        waveforms of the given clusters (relative indices), or of all
+        clusters, in the level of detail mode.
+        
+        The vertices are ordered by channel, cluster, envelope curve and
+        sample. There is room for the envelopes of envelope_capacity
+        clusters, the envelopes of the clusters to come being hidden, so
+        that the size of the data only changes when the datasets are created
+        again. The vertex ranges which changed are in envelope_ranges.
+        
+        """
+        capacity = get_cluster_capacity(self.nclusters)
+        curve_size = 3 * self.nsamples
+        if (clusters_rel is None or
+                capacity != getattr(self, 'envelope_capacity', None)):
+            self.envelope_capacity = capacity
+            n = self.nchannels * capacity * curve_size
+            self.envelope_npoints = n
+            self.envelope_data = np.zeros((n, 2), dtype=np.float32)
+            self.envelope_data[:,0] = np.tile(np.linspace(-1., 1.,
+                self.nsamples), n // self.nsamples)
+            self.envelope_masks = np.zeros(n, dtype=np.float32)
+            self.envelope_clusters = np.tile(np.repeat(np.arange(capacity,
+                dtype=np.int32), curve_size), self.nchannels)
+            self.envelope_channels = np.repeat(np.arange(self.nchannels,
+                dtype=np.int32), capacity * curve_size)
+            clusters_rel = np.arange(self.nclusters)
+        clusters_rel = np.unique(clusters_rel)
+        counts, means, stds = self.get_cluster_envelopes(clusters_rel)
+        # Nchannels x Nclusters x 3 x Nsamples
+        Y = np.array([means - stds, means, means + stds]).transpose(
+            (3, 1, 0, 2))
+        # first vertex of the envelopes of every channel and cluster
+        starts = curve_size * (self.envelope_capacity *
+            np.arange(self.nchannels).reshape((-1, 1)) +
+            clusters_rel.reshape((1, -1))).ravel()
+        index = get_ranges_indices(starts, starts + curve_size)
+        self.envelope_data[index,1] = self.data_normalizer.normalize_y(
+            Y.ravel())
+        # the envelopes of the empty clusters are hidden
+        self.envelope_masks[index] = np.repeat(np.tile(counts > 0,
+            self.nchannels), curve_size)
+        self.envelope_ranges = get_ranges(index)
+        
+    def get_detail_data(self, channels):
+        """Return the GPU data of additional waveforms on the given channels,
+        in the level of detail mode.
+        
+        The number of additional waveforms per cluster is chosen so that the
+        total number of vertices does not exceed LOD_DETAIL_VERTICES. The
+        returned arrays are padded with invisible vertices (null mask) up to
+        this size, so that they always fit in the same GPU buffers.
+        
+        """
+        capacity = self.get_detail_capacity()
+        data = np.zeros((capacity, 2), dtype=np.float32)
+        masks = np.zeros(capacity, dtype=np.float32)
+        clusters = np.zeros(capacity, dtype=np.int32)
+        channels_full = np.zeros(capacity, dtype=np.int32)
+        
+        nchannels = len(channels)
+        # number of additional waveforms per cluster
+        if nchannels > 0:
+            nadditional = capacity // (nchannels * self.nsamples *
+                                       self.nclusters)
+        else:
+            nadditional = 0
+        if nadditional > 0:
+            spikes = np.setdiff1d(get_spikes_subset(self.clusters_full,
+                self.max_waveforms + nadditional), self.spikes_displayed)
+            # at most nadditional spikes per cluster, evenly spaced in time
+            spikes = spikes[get_spikes_subset(self.clusters_full[spikes],
+                                              nadditional)]
+        else:
+            spikes = np.array([], dtype=np.int64)
+        nspikes = len(spikes)
+        n = nchannels * nspikes * self.nsamples
+        if n == 0:
+            return data, masks, clusters, channels_full
+        
+        # Nchannels x Nspikes x Nsamples
+        waveforms = np.asarray(self.waveforms_full[spikes], dtype=np.float32)
+        Y = waveforms[:,:,channels].transpose((2, 0, 1))
+        data[:n,0] = np.tile(np.linspace(-1., 1., self.nsamples),
+                             nchannels * nspikes)
+        data[:n,1] = self.data_normalizer.normalize_y(Y.ravel())
+        masks[:n] = np.repeat(
+            np.asarray(self.masks_full[spikes])[:,channels].T.ravel(),
+            self.nsamples)
+        clusters[:n] = np.tile(np.repeat(
+            self.get_clusters_rel(self.clusters_full[spikes]), self.nsamples),
+            nchannels)
+        channels_full[:n] = np.repeat(channels, nspikes * self.nsamples)
+        return data, masks, clusters, channels_full
+        
+    def get_detail_capacity(self):
+        return LOD_DETAIL_VERTICES // self.nsamples * self.nsamples
+        
+    def get_vertex_indices(self, positions):
+        """Return the indices in the GPU buffers of all vertices of the
+        given spikes (positions in the reordered arrays), as a
+        Nchannels x Nspikes x Nsamples array."""
+        positions = np.asarray(positions, dtype=np.int64)
+        return (self.nsamples * (
+                    np.arange(self.nchannels).reshape((-1, 1, 1)) * self.nspikes +
+                    positions.reshape((1, -1, 1))) +
+                np.arange(self.nsamples).reshape((1, 1, -1)))
+    
+    def get_vertex_ranges(self, positions):
+        """Return the sorted (start, end) ranges in the GPU buffers of all
+        vertices of the given spikes (sorted positions in the reordered
+        arrays): one range per channel for every run of contiguous
+        positions."""
+        ranges = get_ranges(positions)
+        if len(ranges) == 0:
+            return []
+        starts, ends = np.array(ranges, dtype=np.int64).T
+        offsets = (np.arange(self.nchannels, dtype=np.int64) *
+                   self.nspikes).reshape((-1, 1))
+        return zip((self.nsamples * (offsets + starts)).ravel(),
+                   (self.nsamples * (offsets + ends)).ravel())
+    
+    def update_waveform_data(self, positions):
+        """Update the GPU data of some spikes only, given their positions in
+        the reordered arrays."""
+        if len(positions) == 0:
+            return
+        ind = self.get_vertex_indices(positions)
+        # Y coordinates, the normalization does not change as the set of
+        # waveforms is the same
+        Y = self.waveforms_reordered[positions,...].transpose((2, 0, 1))
+        self.normalized_y[ind] = self.data_normalizer.normalize_y(Y)
+        # masks and clusters
+        if self.compact:
+            self.mask_data.reshape((self.nchannels, -1))[:,positions] = \
+                self.masks[positions,:].T
+            self.cluster_data[positions] = encode_clusters(
+                self.clusters_rel[positions])
+        else:
+            self.full_masks[ind] = self.masks[positions,:].T.reshape(
+                (self.nchannels, -1, 1))
+            self.full_clusters[ind] = self.clusters_rel[positions].reshape(
+                (1, -1, 1))
+        self.update_waveform_ranges(positions)
+        
+    def update_waveform_ranges(self, positions):
+        """Update the vertical range, in normalized coordinates, of the
+        waveforms of some spikes on every channel."""
+        Y = self.normalized_y.reshape(
+            (self.nchannels, self.nspikes, self.nsamples))[:,positions,:]
+        self.waveform_ymin[:,positions] = Y.min(axis=2)
+        self.waveform_ymax[:,positions] = Y.max(axis=2)
+    
     def get_data_position(self, channel, cluster_rel):
         """Return the position in the normalized data of the waveforms of the 
         given cluster (relative index) and channel.
         
         """
-        # get absolute cluster index
-        cluster = self.clusters_unique[cluster_rel]
-        i0 = self.nsamples * (channel * self.nspikes + self.cluster_sizes_cum[cluster])
-        i1 = i0 + self.nsamples * self.cluster_sizes_dict[cluster]
+        i0 = self.nsamples * (channel * self.nspikes + self.cluster_sizes_cum[cluster_rel])
+        i1 = i0 + self.nsamples * self.cluster_sizes[cluster_rel]
         return i0, i1
     
     
@@ -515,8 +1064,9 @@ class WaveformDataManager(object):
     
 class WaveformTemplate(DefaultTemplate):
     def initialize(self, npoints=None, nclusters=None, nchannels=None, 
-        nsamples=None, nspikes=None,
-        **kwargs):
+        nsamples=None, nspikes=None, compact=False, spike_texture_rows=None,
+        mask_texture_rows=None, texture_width=TEXTURE_WIDTH,
+        cluster_capacity=None, **kwargs):
         
         self.npoints = npoints
         self.nsamples = nsamples
@@ -530,11 +1080,28 @@ class WaveformTemplate(DefaultTemplate):
         self.primitive_type = PrimitiveType.LineStrip
         
         
-        self.add_attribute("position0", vartype="float", ndim=2)
-        self.add_attribute("mask", vartype="float", ndim=1)
-        self.add_attribute("cluster", vartype="int", ndim=1)
-        self.add_attribute("channel", vartype="int", ndim=1)
-        self.add_attribute("highlight", vartype="int", ndim=1)
+        if compact:
+            self.add_attribute("y", vartype="float", ndim=1)
+            self.add_texture("cluster_texture", ncomponents=1, ndim=2,
+                size=(spike_texture_rows, texture_width))
+            self.add_texture("highlight_texture", ncomponents=1, ndim=2,
+                size=(spike_texture_rows, texture_width))
+            self.add_texture("mask_texture", ncomponents=1, ndim=2,
+                size=(mask_texture_rows, texture_width))
+            self.add_uniform("nsamples", vartype="int", ndim=1, data=nsamples)
+            self.add_uniform("nspikes", vartype="int", ndim=1, data=nspikes)
+            self.add_uniform("texture_width", vartype="int", ndim=1,
+                data=texture_width)
+            self.add_uniform("spike_texture_rows", vartype="int", ndim=1,
+                data=spike_texture_rows)
+            self.add_uniform("mask_texture_rows", vartype="int", ndim=1,
+                data=mask_texture_rows)
+        else:
+            self.add_attribute("position0", vartype="float", ndim=2)
+            self.add_attribute("mask", vartype="float", ndim=1)
+            self.add_attribute("cluster", vartype="int", ndim=1)
+            self.add_attribute("channel", vartype="int", ndim=1)
+            self.add_attribute("highlight", vartype="int", ndim=1)
         
         self.add_uniform("nclusters", vartype="int", ndim=1, data=nclusters)
         self.add_uniform("nchannels", vartype="int", ndim=1, data=nchannels)
@@ -542,14 +1109,21 @@ class WaveformTemplate(DefaultTemplate):
         self.add_uniform("box_size_margin", vartype="float", ndim=2)
         self.add_uniform("probe_scale", vartype="float", ndim=2)
         self.add_uniform("superimposed", vartype="bool", ndim=1)
+        # room for new clusters, see get_cluster_capacity
+        if cluster_capacity is None:
+            cluster_capacity = nclusters
         self.add_uniform("cluster_colors", vartype="float", ndim=3,
-            size=self.nclusters)
+            size=cluster_capacity)
         self.add_uniform("channel_positions", vartype="float", ndim=2,
             size=self.nchannels)
         
         self.add_varying("varying_color", vartype="float", ndim=4)
         
-        self.add_vertex_main(VERTEX_SHADER)
+        if compact:
+            self.add_vertex_header(VERTEX_HEADER_COMPACT)
+            self.add_vertex_main(VERTEX_SHADER_COMPACT + VERTEX_SHADER)
+        else:
+            self.add_vertex_main(VERTEX_SHADER)
         self.add_fragment_main(FRAGMENT_SHADER)
         
         self.initialize_default(**kwargs)
@@ -569,32 +1143,181 @@ class WaveformPaintManager(PaintManager):
             return self.position_manager.probe_scale
         if name == "superimposed":
             return self.position_manager.superposition == WaveformSuperposition.Superimposed
+        if name == "nclusters":
+            return self.data_manager.nclusters
         if name == "cluster_colors":
-            return self.data_manager.cluster_colors
+            return pad_cluster_colors(self.data_manager.cluster_colors,
+                                      self.cluster_capacity)
         if name == "channel_positions":
             return self.position_manager.get_channel_positions()
     
+    def get_waveform_datasets(self):
+        return [self.ds_waveforms] + self.ds_lod
+    
     def auto_update_uniforms(self, *names):
         dic = dict([(name, self.get_uniform_value(name)) for name in names])
-        self.set_data(dataset=self.ds_waveforms, **dic)
+        for dataset in self.get_waveform_datasets():
+            self.set_data(dataset=dataset, **dic)
     
+    @profiled("waveform.upload")
     def initialize(self):
-        self.ds_waveforms = self.create_dataset(WaveformTemplate,
-            npoints=self.data_manager.npoints,
-            nchannels=self.data_manager.nchannels,
-            nclusters=self.data_manager.nclusters,
-            nsamples=self.data_manager.nsamples,
-            nspikes=self.data_manager.nspikes,
-            position0=self.data_manager.normalized_data,
-            mask=self.data_manager.full_masks,
-            cluster= self.data_manager.full_clusters,
-            channel=self.data_manager.full_channels,
-            highlight=self.highlight_manager.highlight_mask,
-        )
+        self.cluster_capacity = get_cluster_capacity(
+            self.data_manager.nclusters)
+        if self.data_manager.compact:
+            # the textures must fit in the OpenGL limits
+            self.data_manager.set_texture_size(get_compact_texture_size())
+        self.compact = self.data_manager.compact
+        if self.compact:
+            self.initialize_compact()
+        else:
+            self.ds_waveforms = self.create_dataset(WaveformTemplate,
+                npoints=self.data_manager.npoints,
+                nchannels=self.data_manager.nchannels,
+                nclusters=self.data_manager.nclusters,
+                cluster_capacity=self.cluster_capacity,
+                nsamples=self.data_manager.nsamples,
+                nspikes=self.data_manager.nspikes,
+                position0=self.data_manager.normalized_data,
+                mask=self.data_manager.full_masks,
+                cluster= self.data_manager.full_clusters,
+                channel=self.data_manager.full_channels,
+                highlight=self.highlight_manager.highlight_mask,
+            )
+        
+        # level of detail: envelopes, and additional waveforms for the
+        # visible channels
+        self.ds_lod = []
+        if self.data_manager.spikes_displayed is not None:
+            self.initialize_lod()
         
         self.auto_update_uniforms("box_size", "box_size_margin", "probe_scale",
             "superimposed", "cluster_colors", "channel_positions",)
         
+    def initialize_compact(self):
+        dm = self.data_manager
+        self.ds_waveforms = self.create_dataset(WaveformTemplate,
+            compact=True,
+            spike_texture_rows=dm.cluster_texture.shape[0],
+            mask_texture_rows=dm.mask_texture.shape[0],
+            texture_width=dm.texture_width,
+            npoints=dm.npoints,
+            nchannels=dm.nchannels,
+            nclusters=dm.nclusters,
+            cluster_capacity=self.cluster_capacity,
+            nsamples=dm.nsamples,
+            nspikes=dm.nspikes,
+            y=dm.normalized_y,
+            cluster_texture=dm.cluster_texture,
+            mask_texture=dm.mask_texture,
+            highlight_texture=self.highlight_manager.highlight_texture,
+        )
+        
+    def initialize_lod(self):
+        dm = self.data_manager
+        self.ds_envelopes = self.create_dataset(WaveformTemplate,
+            npoints=dm.envelope_npoints,
+            nchannels=dm.nchannels,
+            nclusters=dm.nclusters,
+            cluster_capacity=self.cluster_capacity,
+            nsamples=dm.nsamples,
+            nspikes=dm.envelope_npoints // dm.nsamples // dm.nchannels,
+            position0=dm.envelope_data,
+            mask=dm.envelope_masks,
+            cluster=dm.envelope_clusters,
+            channel=dm.envelope_channels,
+            highlight=np.zeros(dm.envelope_npoints, dtype=np.int32),
+        )
+        capacity = dm.get_detail_capacity()
+        data, masks, clusters, channels = dm.get_detail_data([])
+        self.ds_detail = self.create_dataset(WaveformTemplate,
+            npoints=capacity,
+            nchannels=dm.nchannels,
+            nclusters=dm.nclusters,
+            cluster_capacity=self.cluster_capacity,
+            nsamples=dm.nsamples,
+            nspikes=capacity // dm.nsamples,
+            position0=data,
+            mask=masks,
+            cluster=clusters,
+            channel=channels,
+            highlight=np.zeros(capacity, dtype=np.int32),
+        )
+        self.ds_lod = [self.ds_envelopes, self.ds_detail]
+        self.detail_channels = np.array([], dtype=np.int64)
+        
+    @profiled("waveform.update_detail")
+    def update_detail(self):
+        """Load additional waveforms for the channels visible in the current
+        view, in the level of detail mode."""
+        if self.data_manager.spikes_displayed is None:
+            return
+        im = self.interaction_manager
+        x0, y0 = im.get_data_coordinates(-1, -1)
+        x1, y1 = im.get_data_coordinates(1, 1)
+        channels = self.position_manager.get_visible_channels((x0, y0, x1, y1))
+        # no additional waveforms when all channels are visible
+        if len(channels) == self.data_manager.nchannels:
+            channels = np.array([], dtype=np.int64)
+        if np.array_equal(channels, self.detail_channels):
+            return
+        self.detail_channels = channels
+        data, masks, clusters, channels = \
+            self.data_manager.get_detail_data(channels)
+        self.set_data(dataset=self.ds_detail, position0=data, mask=masks,
+            cluster=clusters, channel=channels)
+        
+    def update_envelopes(self):
+        """Upload the envelopes of the clusters which changed."""
+        dm = self.data_manager
+        upload_ranges(self, self.ds_envelopes, dm.envelope_ranges,
+            position0=dm.envelope_data,
+            mask=dm.envelope_masks)
+        
+    @profiled("waveform.update_spikes")
+    def update_spikes(self, positions, update_clusters=False):
+        """Upload the data of some spikes only, given their positions in the
+        reordered arrays."""
+        dm = self.data_manager
+        if dm.nclusters > self.cluster_capacity or dm.compact != self.compact:
+            # the cluster colors do not fit in the datasets anymore, or the
+            # compact layout has been replaced by the full layout
+            self.recreate_datasets()
+            return
+        if dm.compact:
+            upload_ranges(self, self.ds_waveforms,
+                dm.get_vertex_ranges(positions),
+                y=dm.normalized_y)
+            # the textures are small (one texel per spike, or per spike and
+            # channel), and always uploaded entirely
+            self.set_data(dataset=self.ds_waveforms,
+                cluster_texture=dm.cluster_texture,
+                mask_texture=dm.mask_texture)
+        else:
+            upload_ranges(self, self.ds_waveforms,
+                dm.get_vertex_ranges(positions),
+                position0=dm.normalized_data,
+                mask=dm.full_masks,
+                cluster=dm.full_clusters)
+        if self.data_manager.spikes_displayed is not None:
+            self.update_envelopes()
+            # the additional waveforms are reloaded at the next view change
+            self.set_data(dataset=self.ds_detail,
+                mask=np.zeros(self.data_manager.get_detail_capacity(),
+                              dtype=np.float32))
+            self.detail_channels = np.array([], dtype=np.int64)
+        if update_clusters:
+            self.auto_update_uniforms("nclusters", "cluster_colors",
+                "channel_positions", "box_size", "box_size_margin")
+            
+    def recreate_datasets(self):
+        """Delete the current datasets and create new ones, with room for
+        more clusters, or in the full layout when the clusters do not fit
+        in the compact layout anymore. This happens each time the number of
+        clusters doubles."""
+        for dataset in self.get_waveform_datasets():
+            delete_dataset(self, dataset)
+        self.initialize()
+        
         
         
         
@@ -602,6 +1325,8 @@ class WaveformInteractionManager(InteractionManager):
     def process_none_event(self):
         super(WaveformInteractionManager, self).process_none_event()
         self.highlight_manager.cancel_highlight()
+        # level of detail: load more waveforms once the view has changed
+        self.paint_manager.update_detail()
         
     def process_custom_event(self, event, parameter):
         # toggle arrangements
@@ -750,6 +1475,25 @@ class WaveformView(GalryWidget):
         
     def set_data(self, *args, **kwargs):
         self.data_manager.set_data(*args, **kwargs)
+        
+    def reassign_spikes(self, spikes, clusters, cluster_colors=None):
+        """Merge, split or reassign spikes to other clusters, by uploading
+        only the data of the spikes which changed.
+        
+        Arguments:
+          * spikes: the indices of the spikes to move
+          * clusters: the new cluster (absolute index) of each spike, or a
+            single cluster index
+          * cluster_colors: the colors of the new clusters, if any
+        
+        """
+        nclusters = self.data_manager.nclusters
+        self.highlight_manager.cancel_highlight()
+        changed = self.data_manager.reassign_spikes(spikes, clusters,
+            cluster_colors=cluster_colors)
+        self.paint_manager.update_spikes(changed,
+            update_clusters=self.data_manager.nclusters != nclusters)
+        self.updateGL()
 
 
 # if __name__ == '__main__':
@@ -781,4 +1525,3 @@ class WaveformView(GalryWidget):
     # print waveforms.shape, waveforms.size
     
     
-    
\ No newline at end of file
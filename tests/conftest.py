@@ -0,0 +1,6 @@
+import os
+import sys
+
+# the modules of spiky import each other from the spiky directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'spiky'))
@@ -0,0 +1,89 @@
+import os
+
+import numpy as np
+import numpy.random as rdn
+import pytest
+
+from correlationmatrix import (compute_correlationmatrix,
+    compute_similarity_pairs, get_cluster_statistics)
+from dataio import MockDataProvider
+
+
+def get_similarity_dense(means, variances, channels, fetdim):
+    """Similarity matrix computed for every pair of clusters."""
+    nclusters, nchannels = channels.shape
+    # the last feature, the time, is ignored
+    means = means[:,:nchannels * fetdim]
+    variances = variances[:,:nchannels * fetdim]
+    matrix = np.eye(nclusters)
+    for i in xrange(nclusters):
+        for j in xrange(nclusters):
+            common = np.repeat(channels[i] & channels[j], fetdim)
+            if i == j or not common.any():
+                continue
+            d2 = ((means[i] - means[j]) ** 2 /
+                  (variances[i] + variances[j] + 1e-12))[common].mean()
+            matrix[i, j] = np.exp(-d2 / 2)
+    return matrix
+
+
+@pytest.mark.parametrize(('block_size', 'max_bytes'),
+                         [(256, 64e6), (3, 64e6), (4, 1)])
+def test_similarity_pairs(block_size, max_bytes):
+    rdn.seed(0)
+    nclusters, nchannels, fetdim = 10, 6, 3
+    means = rdn.randn(nclusters, nchannels * fetdim + 1)
+    variances = rdn.rand(nclusters, nchannels * fetdim + 1)
+    channels = rdn.rand(nclusters, nchannels) < .3
+    # a cluster without any unmasked channel, and two clusters on disjoint
+    # channels
+    channels[2] = False
+    channels[5] = [1, 1, 0, 0, 0, 0]
+    channels[7] = [0, 0, 1, 1, 0, 0]
+    rows, cols, values = compute_similarity_pairs(means, variances, channels,
+        fetdim, block_size=block_size, max_bytes=max_bytes)
+    expected = get_similarity_dense(means, variances, channels, fetdim)
+    matrix = np.zeros((nclusters, nclusters))
+    matrix[rows, cols] = values
+    assert np.allclose(matrix, expected)
+    # the pairs without common channels are skipped, every pair being
+    # computed once
+    pairs = set(zip(rows, cols))
+    assert len(pairs) == len(rows)
+    overlap = np.dot(channels.astype(np.int32), channels.T.astype(np.int32))
+    np.fill_diagonal(overlap, 1)
+    assert pairs == set(zip(*np.nonzero(overlap)))
+    assert (5, 7) not in pairs and (2, 0) not in pairs
+
+
+def test_correlationmatrix_empty_cluster():
+    rdn.seed(1)
+    nspikes, nchannels, fetdim = 200, 4, 3
+    features = rdn.randn(nspikes, nchannels * fetdim + 1)
+    masks = np.ones((nspikes, nchannels))
+    clusters = rdn.randint(3, size=nspikes) * 2
+    # the cluster 1 has no spike
+    matrix = compute_correlationmatrix(features, masks, clusters, fetdim,
+                                       clusters_unique=np.arange(5))
+    assert matrix.shape == (5, 5)
+    assert np.array_equal(matrix[1], np.eye(5)[1])
+    assert np.array_equal(matrix[:,1], np.eye(5)[:,1])
+    # the other clusters are unchanged
+    expected = compute_correlationmatrix(features, masks, clusters, fetdim)
+    assert np.allclose(matrix[np.ix_([0, 2, 4], [0, 2, 4])], expected)
+    means, variances, masks_mean = get_cluster_statistics(features, masks,
+        clusters, 5)
+    assert np.array_equal(masks_mean[[1, 3]], np.zeros((2, nchannels)))
+
+
+def test_mock_provider_clusters(monkeypatch):
+    """The correlograms and the correlation matrix of the mock data have the
+    same clusters, even when some of them are empty."""
+    monkeypatch.chdir(os.path.join(os.path.dirname(
+        os.path.abspath(__file__)), '..', 'spiky'))
+    rdn.seed(2)
+    holder = MockDataProvider().load(nspikes=3, nclusters=5)
+    nclusters = len(holder.correlograms_cache.get_clusters())
+    assert nclusters <= 3
+    assert holder.correlationmatrix.shape == (nclusters, nclusters)
+    assert len(holder.correlograms) == nclusters * (nclusters + 1) // 2
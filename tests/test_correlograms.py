@@ -0,0 +1,146 @@
+import numpy as np
+import numpy.random as rdn
+import pytest
+
+from correlograms import (CorrelogramsCache, compute_correlograms,
+    compute_correlograms_clusters, count_spike_pairs, get_cluster_shards,
+    get_correlograms_index)
+
+
+def create_train(nspikes=300, nclusters=5, windowsize=20, seed=0):
+    """Return a random spike train with integer times, some pairs of spikes
+    being exactly at the edges of the window, and some spikes at the same
+    time."""
+    rdn.seed(seed)
+    times = rdn.randint(0, 1000, size=nspikes)
+    times[:20] = times[20:40] + windowsize
+    times[40:50] = times[50:60] - windowsize
+    times[60:70] = times[70:80] + windowsize + 1
+    times[80:90] = times[90:100]
+    clusters = rdn.randint(nclusters, size=nspikes) * 2 + 1
+    return times, clusters
+
+
+def get_lags(times, binsize, windowsize):
+    """Return the matrix of the lags t_b - t_a between all spikes a and b in
+    bins, and whether they are inside the window, by brute force."""
+    nhalf = windowsize // binsize
+    dt = times.reshape((1, -1)) - times.reshape((-1, 1))
+    lags = (np.sign(dt) * np.floor(np.abs(dt) / float(binsize) + .5)).astype(
+        np.int64)
+    valid = np.abs(lags) <= nhalf
+    np.fill_diagonal(valid, False)
+    return lags, valid
+
+
+def get_histogram(lags, valid, spikes0, spikes1, nhalf):
+    """Histogram of the lags between two sets of spikes."""
+    block = lags[np.ix_(spikes0, spikes1)][valid[np.ix_(spikes0, spikes1)]]
+    return np.bincount(block + nhalf, minlength=2 * nhalf + 1)
+
+
+def get_correlograms_brute(times, clusters, clusters_unique, binsize=1,
+                           windowsize=20):
+    nhalf = windowsize // binsize
+    lags, valid = get_lags(times, binsize, windowsize)
+    correlograms = []
+    for i, ci in enumerate(clusters_unique):
+        for cj in clusters_unique[:i + 1]:
+            correlograms.append(get_histogram(lags, valid,
+                np.nonzero(clusters == ci)[0], np.nonzero(clusters == cj)[0],
+                nhalf))
+    return np.array(correlograms)
+
+
+@pytest.mark.parametrize('binsize', [1, 2, 3])
+@pytest.mark.parametrize('nprocesses', [1, 2])
+def test_compute_correlograms(binsize, nprocesses):
+    times, clusters = create_train()
+    expected = get_correlograms_brute(times, clusters, np.unique(clusters),
+                                      binsize=binsize)
+    correlograms = compute_correlograms(times, clusters, binsize=binsize,
+                                        windowsize=20, nprocesses=nprocesses)
+    assert correlograms.shape == expected.shape
+    assert np.array_equal(correlograms, expected)
+
+
+def test_compute_correlograms_edges():
+    # two spikes exactly at the half-width of the window, and one outside
+    times = np.array([100, 120, 80, 300, 321])
+    clusters = np.array([0, 1, 1, 0, 1])
+    correlograms = compute_correlograms(times, clusters, windowsize=20)
+    assert correlograms.shape == (3, 41)
+    assert correlograms[get_correlograms_index(1, 0)].sum() == 2
+    # lags t_1 - t_0 of +20 and -20
+    assert correlograms[get_correlograms_index(1, 0), 40] == 1
+    assert correlograms[get_correlograms_index(1, 0), 0] == 1
+    # the auto-correlogram of the cluster 1: lags of +40 and -40, outside
+    assert correlograms[get_correlograms_index(1, 1)].sum() == 0
+
+
+@pytest.mark.parametrize('nshards', [1, 2, 3, 5])
+def test_count_spike_pairs_shards(nshards):
+    times, clusters = create_train()
+    order = np.argsort(times, kind='mergesort')
+    times = times[order]
+    clusters_rel = np.searchsorted(np.unique(clusters), clusters[order])
+    nclusters = 5
+    counts = count_spike_pairs(times, clusters_rel, nclusters, windowsize=20)
+    bounds = get_cluster_shards(clusters_rel, nclusters, nshards)
+    assert bounds[0] == 0 and bounds[-1] == nclusters
+    assert len(bounds) - 1 <= nshards
+    shards = [count_spike_pairs(times, clusters_rel, nclusters,
+                                windowsize=20, cluster_start=start,
+                                cluster_end=end)
+              for start, end in zip(bounds[:-1], bounds[1:])]
+    assert np.array_equal(np.hstack(shards), counts)
+    # the autocorrelograms are counted with a positive lag only
+    counts = counts.reshape((-1, 41))
+    diagonal = get_correlograms_index(np.arange(nclusters),
+                                      np.arange(nclusters))
+    assert counts[diagonal,:20].sum() == 0
+
+
+def test_compute_correlograms_clusters():
+    times, clusters = create_train()
+    clusters_unique = np.unique(clusters)
+    selected = np.array([3, 9])
+    correlograms = compute_correlograms_clusters(times, clusters, selected,
+                                                 windowsize=20)
+    assert correlograms.shape == (2, 5, 41)
+    lags, valid = get_lags(times, 1, 20)
+    for s, cs in enumerate(selected):
+        for o, co in enumerate(clusters_unique):
+            expected = get_histogram(lags, valid,
+                np.nonzero(clusters == cs)[0],
+                np.nonzero(clusters == co)[0], 20)
+            assert np.array_equal(correlograms[s, o], expected)
+
+
+def check_cache(cache, times):
+    clusters = cache.clusters
+    expected = get_correlograms_brute(times, clusters, np.unique(clusters))
+    assert np.array_equal(cache.get_correlograms(), expected)
+
+
+def test_correlograms_cache():
+    times, clusters = create_train()
+    cache = CorrelogramsCache(times, clusters, windowsize=20).compute()
+    check_cache(cache, times)
+    # split a cluster into a new one
+    spikes = np.nonzero(clusters == 5)[0][::2]
+    cache.reassign(spikes, 12)
+    check_cache(cache, times)
+    # move spikes from several clusters, and empty a cluster
+    spikes = np.hstack((np.nonzero(cache.clusters == 7)[0],
+                        np.arange(0, 300, 11)))
+    cache.reassign(spikes, 1)
+    assert 7 not in cache.get_clusters()
+    check_cache(cache, times)
+    assert not [key for key in cache.correlograms if 7 in key]
+    # merge into an existing cluster and into a new one
+    cache.merge([1, 3], 3)
+    check_cache(cache, times)
+    cache.merge([5, 12], 20)
+    assert list(cache.get_clusters()) == [3, 9, 20]
+    check_cache(cache, times)
@@ -0,0 +1,76 @@
+import os
+
+import numpy as np
+import numpy.random as rdn
+import pytest
+
+h5py = pytest.importorskip('h5py')
+from dataio import H5ArrayProxy
+
+
+INDICES = [
+    0, -1, -100, 57,
+    slice(None), slice(10, 20), slice(None, None, 3), slice(-10, None),
+    slice(None, None, -1), slice(80, 10, -7), slice(-2, -50, -3),
+    slice(5, 5), slice(20, 10), slice(10, 20, -1), slice(200, None),
+    Ellipsis, (Ellipsis, 1), (Ellipsis, -1), (Ellipsis, slice(None, None, -1)),
+    (slice(None), 2), (slice(None, None, -1), -1, slice(None, None, -2)),
+    (-3, slice(3, 0, -1), 1), (slice(10, 20), 1, [0, 2]),
+    (slice(50, 0, -5), [3, 0, 3]), ([5, 1, 5], Ellipsis, 2),
+    ([-1, 0, 99], slice(None, None, -1)), (np.arange(100) % 3 == 0, -2),
+    (np.int64(-5), Ellipsis),
+]
+
+
+@pytest.fixture
+def proxy_data(tmpdir):
+    data = rdn.randn(100, 4, 3)
+    f = h5py.File(os.path.join(str(tmpdir), 'data.h5'), 'w')
+    f.create_dataset('data', data=data, chunks=(16, 4, 3))
+    yield H5ArrayProxy(f['data']), data
+    f.close()
+
+
+@pytest.mark.parametrize('index', INDICES, ids=repr)
+def test_h5_proxy_indexing(proxy_data, index):
+    proxy, data = proxy_data
+    expected = data[index]
+    actual = proxy[index]
+    assert np.shape(actual) == np.shape(expected)
+    assert np.array_equal(actual, expected)
+
+
+@pytest.mark.parametrize('index', [100, -101, (0, 4), (0, 0, -4)])
+def test_h5_proxy_out_of_bounds(proxy_data, index):
+    proxy, data = proxy_data
+    with pytest.raises(IndexError):
+        proxy[index]
+
+
+def test_h5_proxy_reads():
+    """Only the requested part of the dataset is read, with indices that
+    h5py accepts."""
+    class Dataset(object):
+        def __init__(self, data):
+            self.data = data
+            self.name = 'data'
+            self.shape = data.shape
+            self.dtype = data.dtype
+            self.chunks = None
+            self.reads = []
+
+        def __getitem__(self, item):
+            self.reads.append(item)
+            return self.data[item]
+
+    data = rdn.randn(100, 4, 3)
+    dataset = Dataset(data)
+    proxy = H5ArrayProxy(dataset)
+    proxy[:, 2]
+    assert dataset.reads[-1] == (slice(0, 100, 1), 2)
+    proxy[10:20, -1, [0, 2]]
+    assert dataset.reads[-1] == (slice(10, 20, 1), 3, slice(None))
+    proxy[::-1]
+    assert dataset.reads[-1] == (slice(0, 100, 1),)
+    proxy[80:10:-7, 0]
+    assert dataset.reads[-1] == (slice(17, 81, 7), 0)
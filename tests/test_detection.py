@@ -0,0 +1,75 @@
+import numpy as np
+import numpy.random as rdn
+
+from dataio import DataHolder
+from detection import detect_spikes, find_peaks, get_threshold
+
+
+FREQ = 20000.
+
+
+def create_trace(spiketimes, n=5000, nchannels=3, amplitude=50., seed=0):
+    """Return a noisy raw trace with a negative spike on the first two
+    channels at every time in spiketimes."""
+    rdn.seed(seed)
+    trace = rdn.randn(n, nchannels)
+    t = np.arange(n)
+    for time in spiketimes:
+        spike = -amplitude * np.exp(-(t - time) ** 2 / 4.)
+        trace[:, 0] += spike
+        trace[:, 1] += .5 * spike
+    return trace
+
+
+def create_holder(trace):
+    holder = DataHolder()
+    holder.raw_trace = trace
+    holder.freq = FREQ
+    return holder
+
+
+def test_detect_chunk_boundary():
+    # spikes right before, at and after the boundaries of 1000 samples chunks
+    spiketimes = [300, 999, 2000, 3001, 4500]
+    trace = create_trace(spiketimes)
+    chunked = detect_spikes(create_holder(trace), chunk_size=1000,
+                            overlap=200)
+    whole = detect_spikes(create_holder(trace), chunk_size=5000, overlap=200)
+    # every spike is detected once, at the peak
+    assert np.array_equal(chunked.spiketimes, spiketimes)
+    assert np.array_equal(whole.spiketimes, spiketimes)
+    # the overlap absorbs the edge effects of the filter
+    assert chunked.waveforms.shape == (5, 32, 3)
+    assert np.allclose(chunked.waveforms, whole.waveforms, atol=1e-2)
+    assert np.all(chunked.waveforms[:, 10, 0] ==
+                  chunked.waveforms[:, :, 0].min(axis=1))
+
+
+def test_detect_threshold_whole_trace():
+    # the beginning of the trace is very noisy: a threshold estimated on the
+    # first chunk only would be too high to detect the spikes afterwards
+    spiketimes = [2500, 4000]
+    trace = create_trace(spiketimes)
+    trace[:1000] *= 20
+    holder = detect_spikes(create_holder(trace), chunk_size=1000,
+                           overlap=200)
+    spiketimes_after = holder.spiketimes[holder.spiketimes >= 1200]
+    assert np.array_equal(spiketimes_after, spiketimes)
+
+
+def test_threshold_null():
+    rdn.seed(1)
+    filtered = np.zeros((1000, 3))
+    # channel 0: noise, channel 1: flat with a few spikes, channel 2: flat
+    filtered[:, 0] = rdn.randn(1000)
+    filtered[[100, 600], 1] = -10.
+    threshold = get_threshold(filtered)
+    assert 0 < threshold[0] < np.inf
+    assert 0 < threshold[1] < 10
+    assert threshold[2] == np.inf
+    assert np.array_equal(find_peaks(filtered[:, 1:], threshold[1:]),
+                          [100, 600])
+    # null thresholds specified explicitly are ignored
+    assert len(find_peaks(filtered[:, 2:], np.zeros(1))) == 0
+    assert np.array_equal(find_peaks(filtered[:, 1:], np.array([5., 0.])),
+                          [100, 600])
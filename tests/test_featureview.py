@@ -0,0 +1,165 @@
+import time
+
+import numpy as np
+import numpy.random as rdn
+import pytest
+
+pytest.importorskip('galry')
+from views.common import GridIndex
+from views.featureview import (DENSITY_BINS, FeatureDataManager,
+    ProjectionCache, get_separation_scores)
+
+
+def wait_for(cache, key, timeout=5.):
+    """Prefetch a key, and wait until the background thread of the cache has
+    computed it."""
+    cache.prefetch([key])
+    for _ in xrange(int(timeout / .01)):
+        with cache.lock:
+            if key in cache.values:
+                return True
+        time.sleep(.01)
+    return False
+
+
+def test_projection_cache_error():
+    computed = []
+
+    def compute(key):
+        if key == 'bad':
+            raise IndexError("Invalid projection.")
+        computed.append(key)
+        return (np.zeros(10),)
+
+    cache = ProjectionCache(compute)
+    cache.prefetch(['bad'])
+    assert wait_for(cache, 'good')
+    # the thread survived the error, and keeps serving the prefetched keys
+    assert cache.thread.is_alive()
+    assert wait_for(cache, 'other')
+    assert cache.thread.is_alive()
+    assert cache.values.keys() == ['good', 'other']
+    assert computed == ['good', 'other']
+    # the failed key is computed again, with the error, when it is requested
+    with pytest.raises(IndexError):
+        cache.get('bad')
+    cache.close()
+
+
+def test_projection_cache_bytes():
+    cache = ProjectionCache(lambda key: (np.zeros(key, dtype=np.int8),),
+                            max_bytes=100)
+    cache.get(40)
+    cache.get(50)
+    assert cache.values.keys() == [40, 50]
+    assert cache.nbytes == 90
+    # the least recently used values are dropped
+    cache.get(40)
+    cache.get(30)
+    assert cache.values.keys() == [40, 30]
+    assert cache.nbytes == 70
+    # the current value is kept, even larger than the bound
+    cache.get(200)
+    assert cache.values.keys() == [200]
+    assert cache.nbytes == 200
+    cache.clear()
+    assert cache.nbytes == 0
+
+
+def test_separation_scores():
+    # 2 clusters of 4 spikes, with means -5 and 5 on feature 0, the same
+    # values on feature 1, and means 1 and -1 on feature 2
+    spread = np.array([-1., 1., -1., 1.])
+    columns = np.array([
+        np.hstack((-5 + spread, 5 + spread)),
+        np.hstack((spread, spread)),
+        np.hstack((1 + spread, -1 + spread)),
+        ])
+    clusters_rel = np.repeat([0, 1], 4)
+    # Fisher ratios 25, 0 and 1, and r^2 = 5^2 / (26 * 2) for features 0
+    # and 2
+    expected = np.array([[0., 25., 13.5], [25., 0., 1.], [13.5, 1., 0.]])
+    assert np.allclose(get_separation_scores(columns, clusters_rel),
+                       expected)
+    assert np.allclose(get_separation_scores(columns, clusters_rel,
+                                             chunk_size=2), expected)
+    # a subset of the spikes
+    positions = np.array([0, 1, 4, 5])
+    assert np.allclose(get_separation_scores(columns, clusters_rel,
+        positions=positions),
+        get_separation_scores(columns[:,positions], clusters_rel[positions]))
+
+
+def test_separation_scores_gaussian():
+    rdn.seed(0)
+    # two well separated Gaussian clusters of different sizes, on feature 0
+    sizes = [3000, 1000]
+    columns = rdn.randn(4, sum(sizes))
+    columns[0,:sizes[0]] -= 5
+    columns[0,sizes[0]:] += 5
+    # feature 3 is redundant with feature 0
+    columns[3] = columns[0] + .1 * columns[3]
+    clusters_rel = np.repeat([0, 1], sizes)
+    scores = get_separation_scores(columns, clusters_rel)
+    assert np.allclose(scores, scores.T)
+    assert np.all(np.diag(scores) == 0)
+    # the between-cluster variance is 100 * .75 * .25, the within-cluster
+    # variance 1
+    assert np.allclose(scores[0,1:3], 18.75, rtol=.05)
+    assert np.allclose(scores[3,1:3], 18.75 / 1.01, rtol=.05)
+    assert scores[1,2] < .05
+    assert scores[0,3] < 18.75 / 4
+
+
+def create_density_manager(points, masks, colors):
+    fdm = FeatureDataManager.__new__(FeatureDataManager)
+    fdm.normalized_data = np.array(points, dtype=np.float32)
+    fdm.full_masks = np.array(masks, dtype=np.float32)
+    fdm.colors = np.hstack((np.array(colors, dtype=np.float32),
+                            np.ones((len(points), 1), dtype=np.float32)))
+    fdm.grid_index = GridIndex(fdm.normalized_data,
+                               active=fdm.full_masks > 0)
+    return fdm
+
+
+def test_density():
+    # centers of the bins
+    w = 2. / DENSITY_BINS
+    first, last = -1 + w / 2, 1 - w / 2
+    red, green, blue = [1, 0, 0], [0, 1, 0], [0, 0, 1]
+    fdm = create_density_manager(
+        # 3 points in the top left bin, 1 point in the bottom right bin, 2
+        # points in a central bin, 1 masked point
+        [[first, last]] * 3 + [[last, first]] + [[w / 2, w / 2]] * 2 +
+        [[0.5, 0.5]],
+        [1, 1, 1, 1, 1, 1, 0],
+        [red, red, red, blue, red, green, blue])
+    texture = fdm.get_density()
+    assert texture.shape == (DENSITY_BINS, DENSITY_BINS, 3)
+    center = DENSITY_BINS // 2
+    # mean color of every bin, brightness log(1 + count) / log(1 + 3)
+    assert np.allclose(texture[0,0], red)
+    assert np.allclose(texture[-1,-1], np.array(blue) * np.log(2) / np.log(4))
+    assert np.allclose(texture[center - 1,center],
+                       np.array([.5, .5, 0]) * np.log(3) / np.log(4))
+    texture[0,0] = texture[-1,-1] = texture[center - 1,center] = 0
+    assert np.all(texture == 0)
+    # highlighted spikes, the masked ones aside
+    texture = fdm.get_density(highlighted=[3, 6])
+    assert np.all(texture[-1,-1] == 1)
+    assert np.all(texture[center // 2,center + center // 2] == 0)
+
+
+def test_density_zoom():
+    w = 2. / DENSITY_BINS
+    fdm = create_density_manager(
+        [[-1 + w / 2, 1 - w / 2], [-1 + w / 2, 1 - w / 2], [.5, -.5]],
+        [1, .5, 1], [[1, 0, 0], [0, 0, 1], [0, 1, 0]])
+    # top left quarter, with bins twice smaller
+    texture = fdm.get_density(box=(-1., 0., 0., 1.))
+    # the points are weighted by their masks, and only the points in the
+    # rectangle are binned
+    color = np.array([1, 0, .5]) / 1.5
+    assert np.allclose(texture[1,1], color)
+    texture[1,1] = 0
+    assert np.all(texture == 0)
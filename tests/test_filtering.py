@@ -0,0 +1,91 @@
+import os
+
+import numpy as np
+import numpy.random as rdn
+import pytest
+
+from filtering import filter_trace, get_chunks
+
+
+FREQ = 20000.
+
+
+class Interrupted(Exception):
+    pass
+
+
+class InterruptedTrace(object):
+    """A raw trace which raises Interrupted after a given number of reads,
+    and records the chunks read."""
+    def __init__(self, trace, nreads=None):
+        self.trace = trace
+        self.shape = trace.shape
+        self.nreads = nreads
+        self.starts = []
+
+    def __getitem__(self, item):
+        if self.nreads is not None and len(self.starts) >= self.nreads:
+            raise Interrupted()
+        self.starts.append(item.start)
+        return self.trace[item]
+
+
+def create_output(filename, shape):
+    return np.memmap(filename, dtype=np.float32, mode='w+', shape=shape)
+
+
+@pytest.mark.parametrize('nthreads', [1, 4])
+def test_filter_resume(tmpdir, nthreads):
+    rdn.seed(0)
+    trace = rdn.randn(20000, 3)
+    kwargs = dict(chunk_size=1000, overlap=100, nthreads=nthreads,
+                  flush_every=2)
+    chunks = get_chunks(trace.shape[0], chunk_size=1000, overlap=100)
+    expected = filter_trace(trace, create_output(str(tmpdir.join('full')),
+        trace.shape), FREQ, **kwargs)
+
+    # the job is interrupted after 7 chunks
+    filename = str(tmpdir.join('resumed'))
+    checkpoint = str(tmpdir.join('checkpoint'))
+    output = create_output(filename, trace.shape)
+    with pytest.raises(Interrupted):
+        filter_trace(InterruptedTrace(trace, nreads=7), output, FREQ,
+                     checkpoint=checkpoint, **kwargs)
+    del output
+    with open(checkpoint, 'r') as f:
+        done = set([int(line) for line in f.read().splitlines()[1:]])
+    assert 0 < len(done) <= 7
+
+    # the chunks which are not recorded are lost
+    output = np.memmap(filename, dtype=np.float32, mode='r+',
+                       shape=trace.shape)
+    for index in xrange(len(chunks)):
+        if index not in done:
+            start, end, keep_start, keep_end = chunks[index]
+            output[keep_start:keep_end] = np.nan
+
+    # the resumed job only processes the remaining chunks
+    resumed = InterruptedTrace(trace)
+    filter_trace(resumed, output, FREQ, checkpoint=checkpoint, **kwargs)
+    assert sorted(resumed.starts) == [chunks[index][0]
+        for index in xrange(len(chunks)) if index not in done]
+    output.flush()
+    output = np.fromfile(filename, dtype=np.float32).reshape(trace.shape)
+    assert np.array_equal(output, expected)
+
+    # a completed job is not processed again
+    resumed = InterruptedTrace(trace)
+    filter_trace(resumed, output, FREQ, checkpoint=checkpoint, **kwargs)
+    assert resumed.starts == []
+
+
+def test_filter_checkpoint_parameters(tmpdir):
+    trace = np.zeros((5000, 2))
+    checkpoint = str(tmpdir.join('checkpoint'))
+    filter_trace(trace, np.zeros(trace.shape), FREQ, chunk_size=1000,
+                 nthreads=1, checkpoint=checkpoint)
+    assert os.path.exists(checkpoint)
+    # the checkpoint cannot be resumed with other parameters
+    with pytest.raises(ValueError):
+        filter_trace(trace, np.zeros(trace.shape), FREQ, chunk_size=500,
+                     nthreads=1, checkpoint=checkpoint)
@@ -0,0 +1,88 @@
+import numpy as np
+import numpy.random as rdn
+import pytest
+
+pytest.importorskip('galry')
+from views.common import GridIndex, points_in_polygon
+
+
+def get_star(center, radius0, radius1, n=7):
+    """Return a concave polygon, a star with n branches."""
+    angles = np.linspace(0, 2 * np.pi, 2 * n, endpoint=False)
+    radius = np.where(np.arange(2 * n) % 2 == 0, radius1, radius0)
+    return np.c_[center[0] + radius * np.cos(angles),
+                 center[1] + radius * np.sin(angles)]
+
+
+BOXES = [(-1., -1., 1., 1.), (-.3, -.2, .4, .1), (.5, .5, .51, .52),
+         (-5., -5., 5., 5.), (2., 2., 3., 3.), (.2, -.5, .2, .5)]
+
+POLYGONS = [
+    get_star((0., 0.), .2, .8),
+    get_star((.5, -.3), .05, .3, n=5),
+    np.array([[-.9, -.9], [.9, -.9], [0., .9]]),
+    # larger than the points, with edges much longer than the cells
+    np.array([[-3., -3.], [3., -3.], [3., 3.], [-3., 3.]]),
+    # concave, with a vertex far away
+    np.array([[-1., -1.], [1., -1.], [0., 0.], [1., 1.], [-20., 1.]]),
+    np.array([[2., 2.], [3., 2.], [3., 3.]]),
+]
+
+
+def check_queries(index, points, active):
+    for box in BOXES:
+        xmin, ymin, xmax, ymax = box
+        expected = np.nonzero(active & (points[:,0] >= xmin) &
+                              (points[:,0] <= xmax) & (points[:,1] >= ymin) &
+                              (points[:,1] <= ymax))[0]
+        assert np.array_equal(index.query(box), expected)
+    for polygon in POLYGONS:
+        expected = np.nonzero(active & points_in_polygon(points, polygon))[0]
+        assert np.array_equal(index.query_polygon(polygon), expected)
+
+
+def test_points_in_polygon():
+    square = np.array([[0., 0.], [1., 0.], [1., 1.], [0., 1.]])
+    points = np.array([[.5, .5], [1.5, .5], [-.1, .2], [.9, .99]])
+    assert points_in_polygon(points, square).tolist() == [True, False,
+                                                          False, True]
+    # the hole of a concave polygon
+    u = np.array([[0., 0.], [3., 0.], [3., 2.], [2., 2.], [2., 1.], [1., 1.],
+                  [1., 2.], [0., 2.]])
+    points = np.array([[1.5, 1.5], [1.5, .5], [.5, 1.5], [2.5, 1.5]])
+    assert points_in_polygon(points, u).tolist() == [False, True, True, True]
+    assert points_in_polygon(points, u).dtype == np.bool_
+
+
+@pytest.mark.parametrize('points_per_cell', [1, 16])
+def test_grid_index_updates(points_per_cell):
+    rdn.seed(0)
+    n = 5000
+    points = rdn.rand(n, 2).astype(np.float32) * 2 - 1
+    active = rdn.rand(n) > .2
+    index = GridIndex(points, active=active, points_per_cell=points_per_cell)
+    check_queries(index, points, active)
+    for i in xrange(10):
+        positions = np.unique(rdn.randint(n, size=rdn.randint(1, 300)))
+        points[positions] = rdn.rand(len(positions), 2) * 2 - 1
+        if i % 3 == 2:
+            # some points outside the bounds of the grid
+            points[positions[:3]] *= 1.5
+        active[positions] = rdn.rand(len(positions)) > .3
+        index.update(positions, active[positions])
+        check_queries(index, points, active)
+
+
+def test_grid_index_empty():
+    points = rdn.rand(100, 2)
+    active = np.zeros(100, dtype=np.bool_)
+    index = GridIndex(points, active=active)
+    check_queries(index, points, active)
+    # points becoming active in an empty index
+    active[:10] = True
+    index.update(np.arange(10), active[:10])
+    check_queries(index, points, active)
+    # and inactive again
+    active[:10] = False
+    index.update(np.arange(10), active[:10])
+    check_queries(index, points, active)
@@ -0,0 +1,158 @@
+import numpy as np
+import numpy.random as rdn
+import pytest
+
+pytest.importorskip('galry')
+from views.common import SpikeDataOrganizer
+
+
+def create_organizer(nspikes=1000, nclusters=10, nchannels=4, seed=0,
+                     **kwargs):
+    rdn.seed(seed)
+    data = rdn.randn(nspikes, nchannels).astype(np.float32)
+    masks = rdn.rand(nspikes, nchannels).astype(np.float32)
+    clusters = rdn.randint(nclusters, size=nspikes)
+    organizer = SpikeDataOrganizer(data, clusters=clusters, masks=masks,
+                                   nchannels=nchannels, **kwargs)
+    return organizer, data, masks, clusters
+
+
+def check_layout(organizer, data, masks, clusters):
+    """Check the reordered arrays of an organizer against the cluster of
+    every spike, and against a full reordering of the same data."""
+    permutation = organizer.permutation
+    nspikes = len(clusters)
+    # the spikes of every cluster are contiguous, in the order of the
+    # relative indices
+    assert np.all(np.diff(organizer.clusters_rel) >= 0)
+    assert np.array_equal(np.sort(permutation), np.arange(nspikes))
+    assert np.array_equal(organizer.spike_positions[permutation],
+                          np.arange(nspikes))
+    assert np.array_equal(organizer.clusters, clusters[permutation])
+    assert np.array_equal(
+        organizer.clusters_unique[organizer.clusters_rel],
+        organizer.clusters)
+    assert np.array_equal(organizer.data_reordered, data[permutation])
+    assert np.array_equal(organizer.masks, masks[permutation])
+    # cluster sizes and offsets
+    sizes = np.bincount(organizer.clusters_rel, minlength=organizer.nclusters)
+    assert np.array_equal(organizer.cluster_sizes, sizes)
+    assert np.array_equal(organizer.cluster_sizes_cum,
+                          np.hstack(([0], np.cumsum(sizes)[:-1])))
+    # same clusters as a full reordering, empty clusters aside
+    full = SpikeDataOrganizer(data, clusters=clusters, masks=masks,
+                              nchannels=masks.shape[1])
+    for cluster in np.unique(clusters):
+        rel = organizer.get_clusters_rel(cluster)
+        start = organizer.cluster_sizes_cum[rel]
+        end = start + organizer.cluster_sizes[rel]
+        full_start = full.cluster_sizes_cum[np.searchsorted(
+            full.clusters_unique, cluster)]
+        full_end = full_start + full.cluster_sizes_dict[cluster]
+        assert np.array_equal(np.sort(permutation[start:end]),
+                              np.sort(full.permutation[full_start:full_end]))
+    for cluster in np.setdiff1d(organizer.clusters_unique, clusters):
+        assert organizer.cluster_sizes_dict[cluster] == 0
+
+
+def test_reassign_random():
+    organizer, data, masks, clusters = create_organizer()
+    clusters = clusters.copy()
+    for i in xrange(20):
+        spikes = rdn.choice(len(clusters), size=rdn.randint(1, 100),
+                            replace=False)
+        new_clusters = rdn.randint(10, size=len(spikes))
+        organizer.reassign(spikes, new_clusters)
+        clusters[spikes] = new_clusters
+        check_layout(organizer, data, masks, clusters)
+
+
+def test_reassign_empty_and_new_clusters():
+    organizer, data, masks, clusters = create_organizer()
+    clusters = clusters.copy()
+    # cluster 3 becomes empty, its spikes go to a brand new cluster
+    spikes = np.nonzero(clusters == 3)[0]
+    organizer.reassign(spikes, 25, cluster_colors=np.zeros((1, 3)))
+    clusters[spikes] = 25
+    check_layout(organizer, data, masks, clusters)
+    assert organizer.nclusters == 11
+    assert organizer.cluster_sizes_dict[3] == 0
+    assert organizer.cluster_sizes_dict[25] == len(spikes)
+    # the new cluster comes after the existing ones
+    assert organizer.get_clusters_rel(25) == 10
+    # the empty cluster gets spikes again, from several clusters
+    spikes = np.nonzero(np.in1d(clusters, [0, 25]))[0][::3]
+    organizer.reassign(spikes, 3)
+    clusters[spikes] = 3
+    check_layout(organizer, data, masks, clusters)
+
+
+def test_reassign_changed_positions():
+    organizer, data, masks, clusters = create_organizer()
+    clusters = clusters.copy()
+    # moving spikes from the first to the last cluster shifts every cluster
+    # boundary, so that spikes which did not move are misplaced
+    spikes = np.nonzero(clusters == 0)[0][:5]
+    permutation = organizer.permutation.copy()
+    changed = organizer.reassign(spikes, 9)
+    clusters[spikes] = 9
+    check_layout(organizer, data, masks, clusters)
+    # every position whose spike changed is returned, the moved spikes
+    # included
+    assert np.all(np.diff(changed) > 0)
+    moved = np.nonzero(organizer.permutation != permutation)[0]
+    assert np.all(np.in1d(moved, changed))
+    assert np.all(np.in1d(organizer.spike_positions[spikes], changed))
+    # at most one spike per cluster boundary and moved spike
+    assert len(changed) <= len(spikes) * 10
+
+
+def test_reassign_unchanged():
+    organizer, data, masks, clusters = create_organizer()
+    permutation = organizer.permutation.copy()
+    # spikes reassigned to their own cluster do not move
+    spikes = np.arange(0, 1000, 7)
+    changed = organizer.reassign(spikes, clusters[spikes])
+    assert len(changed) == 0
+    assert np.array_equal(organizer.permutation, permutation)
+    # only the spikes whose cluster changes are moved
+    new_clusters = clusters[spikes].copy()
+    new_clusters[::2] = (new_clusters[::2] + 1) % 10
+    changed = organizer.reassign(spikes, new_clusters)
+    clusters = clusters.copy()
+    clusters[spikes] = new_clusters
+    check_layout(organizer, data, masks, clusters)
+    unmoved = spikes[1::2]
+    assert np.array_equal(
+        organizer.clusters[organizer.spike_positions[unmoved]],
+        clusters[unmoved])
+
+
+def test_reassign_column_major():
+    organizer, data, masks, clusters = create_organizer(column_major=True)
+    clusters = clusters.copy()
+    # the reordered data is the transposed view of a column major array
+    assert organizer.data_reordered.T.flags['C_CONTIGUOUS']
+    for i in xrange(5):
+        spikes = rdn.choice(len(clusters), size=50, replace=False)
+        new_clusters = rdn.randint(12, size=len(spikes))
+        organizer.reassign(spikes, new_clusters)
+        clusters[spikes] = new_clusters
+        check_layout(organizer, data, masks, clusters)
+
+
+def test_add_clusters():
+    organizer, data, masks, clusters = create_organizer(nclusters=3)
+    organizer.add_clusters(np.array([7, 4]))
+    assert organizer.nclusters == 5
+    assert np.array_equal(organizer.get_clusters_rel([0, 1, 2, 7, 4]),
+                          np.arange(5))
+    assert np.array_equal(organizer.cluster_sizes[3:], [0, 0])
+    assert np.array_equal(organizer.cluster_sizes_cum[3:], [1000, 1000])
+    spikes = np.nonzero(clusters == 1)[0]
+    organizer.reassign(spikes, 4)
+    clusters = clusters.copy()
+    clusters[spikes] = 4
+    check_layout(organizer, data, masks, clusters)
+    assert organizer.cluster_sizes_dict[1] == 0
+    assert organizer.cluster_sizes_dict[7] == 0
@@ -0,0 +1,52 @@
+import os
+
+import numpy as np
+import pytest
+
+pytest.importorskip('galry')
+from views.profiling import Profiler, get_resident_memory, reset_resident_peak
+
+
+# size of the allocation measured
+NBYTES = 100 * 1024 * 1024
+
+
+@pytest.fixture
+def resident_memory():
+    """Skip the tests when the peak resident memory cannot be reset, outside
+    Linux or on restricted kernels."""
+    if not os.path.exists('/proc/self/status'):
+        pytest.skip("/proc is not available.")
+    try:
+        reset_resident_peak()
+    except (IOError, OSError) as e:
+        pytest.skip("The peak resident memory cannot be reset: %s." % e)
+
+
+def test_resident_peak(resident_memory):
+    reset_resident_peak()
+    current, peak = get_resident_memory()
+    data = np.ones(NBYTES // 8)
+    _, new_peak = get_resident_memory()
+    del data
+    assert new_peak - peak >= .9 * NBYTES
+    # the peak is reset to the current memory
+    reset_resident_peak()
+    current, peak = get_resident_memory()
+    assert peak - current < .5 * NBYTES
+
+
+def test_profiler_memory(resident_memory):
+    profiler = Profiler(enabled=True)
+    profiler.start_memory()
+    assert profiler.memory_source == 'resident'
+    outer = profiler.enter()
+    inner = profiler.enter()
+    data = np.ones(NBYTES // 8)
+    del data
+    profiler.exit('inner', inner)
+    profiler.exit('outer', outer)
+    # the peak of a nested call is also the peak of its caller
+    for name in ('inner', 'outer'):
+        memory = profiler.get_records(name)[0]['memory']
+        assert .9 * NBYTES <= memory <= 1.5 * NBYTES
@@ -0,0 +1,107 @@
+import numpy as np
+import numpy.random as rdn
+import pytest
+
+pytest.importorskip('galry')
+from views.waveformview import (COMPACT_MAX_CLUSTERS, WaveformDataManager,
+    WaveformHighlightManager, encode_clusters)
+
+
+class Manager(object):
+    """Position or highlight manager doing nothing."""
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
+
+
+class PositionManager(Manager):
+    """Position manager with one box per channel (horizontally) and cluster
+    (vertically)."""
+    def __init__(self, nchannels, nclusters, size=(.2, .1)):
+        Tx, Ty = np.meshgrid(np.linspace(-.8, .8, nchannels),
+                             np.linspace(-.8, .8, nclusters), indexing='ij')
+        self.box_positions, self.box_size = (Tx, Ty), size
+
+    def get_transformation(self):
+        return self.box_positions, self.box_size
+
+
+def create_data_manager(nspikes=1000, nsamples=8, nchannels=4, nclusters=10,
+                        compact=True):
+    rdn.seed(0)
+    dm = WaveformDataManager()
+    dm.position_manager = Manager()
+    dm.highlight_manager = Manager()
+    dm.set_data(rdn.randn(nspikes, nsamples, nchannels),
+                clusters=rdn.randint(nclusters, size=nspikes),
+                masks=rdn.rand(nspikes, nchannels), compact=compact)
+    return dm
+
+
+def decode_clusters(texels):
+    """Decode the cluster texture like the vertex shader."""
+    return np.floor(texels * 255. + .5).astype(np.int64)
+
+
+def test_encode_clusters():
+    clusters_rel = np.arange(COMPACT_MAX_CLUSTERS)
+    values = encode_clusters(clusters_rel)
+    assert np.all((values >= 0) & (values <= 1))
+    # galry converts the textures to 8 bits, by truncation or rounding
+    for texels in (np.array(255 * values, dtype=np.uint8),
+                   np.round(255 * values).astype(np.uint8)):
+        assert np.array_equal(decode_clusters(texels / 255.), clusters_rel)
+    # float textures
+    assert np.array_equal(decode_clusters(values.astype(np.float32)),
+                          clusters_rel)
+    with pytest.raises(AssertionError):
+        encode_clusters([COMPACT_MAX_CLUSTERS])
+
+
+def test_compact_reassign():
+    dm = create_data_manager()
+    spikes = np.arange(0, 1000, 13)
+    dm.reassign_spikes(spikes, 3)
+    dm.reassign_spikes(spikes[::2], 12)
+    assert dm.compact
+    assert np.array_equal(decode_clusters(dm.cluster_data), dm.clusters_rel)
+    assert np.array_equal(dm.mask_data.reshape((dm.nchannels, -1)),
+                          dm.masks.T)
+
+
+def test_compact_max_clusters():
+    dm = create_data_manager(nclusters=COMPACT_MAX_CLUSTERS - 6)
+    assert dm.compact
+    # new clusters beyond the maximum number of clusters of the compact
+    # layout
+    spikes = np.arange(20)
+    dm.reassign_spikes(spikes, 1000 + spikes)
+    assert dm.nclusters > COMPACT_MAX_CLUSTERS
+    assert not dm.compact
+    assert np.array_equal(dm.full_clusters.reshape((dm.nchannels, -1,
+        dm.nsamples))[:,:,0], np.tile(dm.clusters_rel, (dm.nchannels, 1)))
+    # too many clusters for the compact layout from the start
+    dm = create_data_manager(nclusters=COMPACT_MAX_CLUSTERS + 100)
+    assert not dm.compact
+
+
+def test_find_enclosed_spikes_single_sample():
+    dm = create_data_manager(nspikes=200, nsamples=1, nclusters=3)
+    hm = WaveformHighlightManager.__new__(WaveformHighlightManager)
+    hm.data_manager = dm
+    hm.position_manager = PositionManager(dm.nchannels, dm.nclusters)
+    hm.set_info()
+    (Tx, Ty), (w, h) = hm.position_manager.get_transformation()
+    # position of the single sample of every unmasked waveform
+    positions = np.arange(dm.nspikes)
+    channel, position = np.nonzero(dm.masks.T[:, positions] > 0)
+    cluster = dm.clusters_rel[position]
+    x = Tx[channel, cluster] + w / 2 * dm.x_samples[0]
+    y = Ty[channel, cluster] + h / 2 * dm.normalized_y[channel * dm.nspikes +
+                                                       position]
+    for box in [(-1, -1, 1, 1), (-.95, -.85, -.85, -.75), (-.95, -.8, 0, .8),
+                (.8, .8, -.8, 0), (-.85, 0, 1, 1)]:
+        x0, y0, x1, y1 = box
+        inside = ((x >= min(x0, x1)) & (x <= max(x0, x1)) &
+                  (y >= min(y0, y1)) & (y <= max(y0, y1)))
+        assert np.array_equal(hm.find_enclosed_spikes(box),
+                              np.unique(position[inside]))